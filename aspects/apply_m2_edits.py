@@ -1,76 +1,160 @@
 import argparse
 
 
-# Input: A list of edit lines for a sentence in an m2 file.
-# Output: An edit dictionary; key is coder id, value is a list of edits.
-def processEdits(edits):
-    edit_dict = {}
+# Edit types that are not applied.
+NOOP_EDIT_TYPES = {"noop", "Um"}
+
+
+class Edit:
+    '''
+    Edit of an M2 sentence: original tokens orig_start:orig_end are replaced by cor_tok (tokens separated by spaces), which are the tokens
+    cor_start:cor_end of the corrected sentence. cor_start and cor_end are -1 for noop edits, which are not applied.
+    '''
+    __slots__ = ("orig_start", "orig_end", "error_type", "cor_tok", "cor_start", "cor_end")
+
+    def __init__(self, orig_start, orig_end, error_type, cor_tok, cor_start=-1, cor_end=-1):
+        self.orig_start = orig_start
+        self.orig_end = orig_end
+        self.error_type = error_type
+        self.cor_tok = cor_tok
+        self.cor_start = cor_start
+        self.cor_end = cor_end
+
+    def __repr__(self):
+        return "Edit({}, {}, {!r}, {!r}, {}, {})".format(self.orig_start, self.orig_end, self.error_type, self.cor_tok, self.cor_start,
+                                                        self.cor_end)
+
+
+class M2Sentence:
+    '''
+    Sentence of an M2 file. orig is the original sentence (a list of tokens), coders maps coder id to a tuple of the corrected sentence (a
+    list of tokens) and the list of Edits of the coder. cor and edits are the corrected sentence and the edits of the first coder (None and
+    an empty list for a sentence without edits).
+    '''
+    __slots__ = ("orig", "coders", "cor", "edits")
+
+    def __init__(self, orig, coders):
+        self.orig = orig
+        self.coders = coders
+        self.cor, self.edits = next(iter(coders.values())) if coders else (None, [])
+
+
+def _isIgnored(error_type, ignore_edit_types):
+    return error_type in NOOP_EDIT_TYPES or (ignore_edit_types and any(ignore_edit_type in error_type  # substring match
+                                                                       for ignore_edit_type in ignore_edit_types))
+
+
+# Input 1: The original sentence (a list of tokens)
+# Input 2: A list of edits (with orig_start, orig_end and cor_tok) to apply, in the order of the m2 file.
+# Input 3: Whether to set the cor token start and end positions of the edits.
+# Output: The corrected sentence (a list of tokens)
+def _correct(orig_sent, edits, set_cor_offsets):
+    cor_sent = orig_sent[:]
+    offset = 0
     for edit in edits:
-        edit = edit.split("|||")
-        span = edit[0][2:].split()  # [2:] ignore the leading "A "
-        start = int(span[0])
-        end = int(span[1])
-        cat = edit[1]
-        cor = edit[2]
-        id = edit[-1]
-        # Save the useful info as a list
-        proc_edit = [start, end, cat, cor]
-        # Save the proc edit inside the edit_dict using coder id.
-        if id in edit_dict.keys():
-            edit_dict[id].append(proc_edit)
+        cor_toks = edit.cor_tok.split()
+        # Apply the edit.
+        cor_sent[edit.orig_start + offset:edit.orig_end + offset] = cor_toks
+        if set_cor_offsets:
+            # Get the cor token start and end positions in cor_sent
+            edit.cor_start = edit.orig_start + offset
+            edit.cor_end = edit.cor_start + len(cor_toks)
+        # Keep track of how this affects orig edit offsets.
+        offset = offset - (edit.orig_end - edit.orig_start) + len(cor_toks)
+    return cor_sent
+
+
+# Input 1: A sentence + edit block in an m2 file.
+# Input 2: A list of edit types that are not applied (substring match), noop and Um edits are never applied.
+# Output: An M2Sentence with the original sentence and the corrected sentence and edits (with cor token start and end positions) of each
+# coder. Edits of ignore_edit_types are not in the edits, noop and Um edits are (with cor token positions -1).
+def parseM2(info, ignore_edit_types=None):
+    lines = info.split("\n")
+    orig_sent = lines[0][2:].split()  # [2:] ignore the leading "S "
+    num_orig_tokens = len(orig_sent)
+    # For each coder id, the corrected sentence, the edits and the end of the last applied edit in orig_sent. Edits are usually sorted and
+    # do not overlap, so the corrected sentence is built while parsing from the original spans between them (otherwise the end is None
+    # and the edits are applied after parsing).
+    coder_states = {}
+    for line in lines[1:]:
+        fields = line.split("|||")
+        span = fields[0][2:].split()  # [2:] ignore the leading "A "
+        orig_start, orig_end, error_type, cor_tok = int(span[0]), int(span[1]), fields[1], fields[2]
+        coder_state = coder_states.get(fields[-1])
+        if coder_state is None:
+            coder_state = coder_states[fields[-1]] = [[], [], 0]
+
+        # Edits of an empty span with empty correction (used in Russian RULEC-GEC) change nothing, treat them as noop
+        if orig_start == orig_end and not cor_tok.strip():
+            error_type = "noop"
+        # Do not apply noop or Um edits, but save them
+        if error_type in NOOP_EDIT_TYPES:
+            coder_state[1].append(Edit(orig_start, orig_end, error_type, cor_tok))
+            continue
+        if ignore_edit_types and _isIgnored(error_type, ignore_edit_types):
+            continue
+
+        orig_position = coder_state[2]
+        if orig_position is not None and orig_position <= orig_start <= orig_end <= num_orig_tokens:
+            cor_sent = coder_state[0]
+            cor_sent.extend(orig_sent[orig_position:orig_start])
+            cor_toks = cor_tok.split()
+            coder_state[1].append(Edit(orig_start, orig_end, error_type, cor_tok, len(cor_sent), len(cor_sent) + len(cor_toks)))
+            cor_sent.extend(cor_toks)
+            coder_state[2] = orig_end
         else:
-            edit_dict[id] = [proc_edit]
-    return edit_dict
+            coder_state[1].append(Edit(orig_start, orig_end, error_type, cor_tok))
+            coder_state[2] = None
+
+    coders = {}
+    for coder, (cor_sent, edits, orig_position) in coder_states.items():
+        if orig_position is None:
+            cor_sent = _correct(orig_sent, [edit for edit in edits if edit.error_type not in NOOP_EDIT_TYPES], True)
+        else:
+            cor_sent.extend(orig_sent[orig_position:])
+        coders[coder] = (cor_sent, edits)
+    return M2Sentence(orig_sent, coders)
 
 
 # Input: A sentence + edit block in an m2 file.
 # Output 1: The original sentence (a list of tokens)
 # Output 2: A dictionary; key is coder id, value is a tuple.
 # tuple[0] is the corrected sentence (a list of tokens), tuple[1] is the edits.
-# Process M2 to extract sentences and edits.
+# Process M2 to extract sentences and edits (see parseM2).
 def processM2(info, ignore_edit_types):
-    info = info.split("\n")
-    orig_sent = info[0][2:].split()  # [2:] ignore the leading "S "
-    all_edits = info[1:]
-    # Simplify the edits and group by coder id.
-    edit_dict = processEdits(all_edits)
-    out_dict = {}
-    # Loop through each coder and their edits.
-    for coder, edits in edit_dict.items():
-        # Copy orig_sent. We will apply the edits to it to make cor_sent
-        cor_sent = orig_sent[:]
-        gold_edits = []
-        offset = 0
-        for edit in edits:
-            # Do not apply noop or Um edits, but save them
-            if edit[2] in {"noop", "Um"}:
-                gold_edits.append(edit + [-1, -1])
-                continue
-
-            if ignore_edit_types:
-                is_ignore_edit_type = False
-                for ignore_edit_type in ignore_edit_types:
-                    if ignore_edit_type in edit[2]: # substring match
-                        is_ignore_edit_type = True
-
-                if is_ignore_edit_type:
-                    continue
-
-            orig_start = edit[0]
-            orig_end = edit[1]
-            cor_toks = edit[3].split()
-            # Apply the edit.
-            cor_sent[orig_start + offset:orig_end + offset] = cor_toks
-            # Get the cor token start and end positions in cor_sent
-            cor_start = orig_start + offset
-            cor_end = cor_start + len(cor_toks)
-            # Keep track of how this affects orig edit offsets.
-            offset = offset - (orig_end - orig_start) + len(cor_toks)
-            # Save the edit with cor_start and cor_end
-            gold_edits.append(edit + [cor_start] + [cor_end])
-        # Save the cor_sent and gold_edits for each annotator in the out_dict.
-        out_dict[coder] = (cor_sent, gold_edits)
-    return orig_sent, out_dict
+    sentence = parseM2(info, ignore_edit_types)
+    return sentence.orig, sentence.coders
+
+
+# Input 1: The original sentence (a list of tokens)
+# Input 2: Edits of a coder, as parsed by parseM2
+# Output: The corrected sentence (a list of tokens) with edits of ignore_edit_types not applied, as parsed by parseM2 with these types.
+def applyEdits(orig_sent, edits, ignore_edit_types):
+    return _correct(orig_sent, [edit for edit in edits if not _isIgnored(edit.error_type, ignore_edit_types)], False)
+
+
+# Input: An open m2 file (or any iterable of its lines).
+# Output: A generator of sentence + edit blocks in the m2 file, read lazily line by line.
+# Blocks are separated by one or more empty lines. A sentence without any edit is a block of its "S" line only.
+def readM2Blocks(m2_file):
+    block = []
+    for line in m2_file:
+        if line.strip():
+            block.append(line.rstrip("\r\n"))
+        elif block:
+            yield "\n".join(block)
+            block = []
+    if block:
+        yield "\n".join(block)
+
+
+# Input 1: Path to an m2 file.
+# Input 2: A list of edit types that are not applied (see parseM2).
+# Output: A generator of M2Sentences of the m2 file, parsed lazily.
+def readM2(m2_path, ignore_edit_types=None):
+    with open(m2_path) as m2_file:
+        for info in readM2Blocks(m2_file):
+            yield parseM2(info, ignore_edit_types)
 
 
 def main(args):
@@ -78,19 +162,16 @@ def main(args):
     out_parallel = open(args.out, "w")
 
     print("Processing files...")
-    # Open the m2 file and split into sentence+edit chunks.
-    m2_file = open(args.m2).read().strip().split("\n\n")
-    for info in m2_file:
-        # Get the original and corrected sentence + edits for each annotator.
-        orig_sent, coder_dict = processM2(info, args.ignore_edit_types)
+    # Read the m2 file by sentence+edit chunks and get the original and corrected sentence + edits for each annotator.
+    for sentence in readM2(args.m2, args.ignore_edit_types):
         # Save info about types of edit groups seen
         # Only process sentences with edits.
-        if coder_dict:
+        if sentence.coders:
             # Save marked up original sentence here, if required.
             # Loop through the annotators
-            for coder, coder_info in sorted(coder_dict.items()):
+            for coder, coder_info in sorted(sentence.coders.items()):
                 cor_sent = coder_info[0]
-                out_parallel.write(" ".join(orig_sent) + "\t" + " ".join(cor_sent) + "\n")
+                out_parallel.write(" ".join(sentence.orig) + "\t" + " ".join(cor_sent) + "\n")
 
     out_parallel.close()
 
@@ -1,21 +1,122 @@
 from abc import ABC
 
+from aspects import utils
+
+
+class NoisedSentence:
+    """
+        Sentence passed through the aspects: list of tokens, whitespace info (whether there is space between each two adjacent tokens)
+        and list of the changes introduced so far. Aspects modify it in place.
+    """
+
+    def __init__(self, tokens, whitespace_info, changes=None):
+        self.tokens = list(tokens)
+        self.whitespace_info = list(whitespace_info)
+        self.changes = list(changes) if changes else []
+
+    def copy(self):
+        return NoisedSentence(self.tokens, self.whitespace_info, self.changes)
+
+    def text(self):
+        """
+            Tokens separated by spaces.
+        """
+        return " ".join(self.tokens)
+
+    def detokenize(self):
+        """
+            Tokens separated according to the whitespace info.
+        """
+        detokenized = []
+        for i, token in enumerate(self.tokens):
+            detokenized.append(token)
+            if i < len(self.whitespace_info) and self.whitespace_info[i]:
+                detokenized.append(" ")
+
+        return "".join(detokenized)
+
+    def check(self, producer):
+        """
+            Check that the tokens and whitespace info are consistent, producer (e.g. aspect name) is used in the error message.
+        """
+        assert all(' ' not in token for token in self.tokens), "{} produced token containing space".format(producer)
+        assert len(self.whitespace_info) == len(self.tokens) - 1, "{} produced whitespace info not matching the tokens".format(producer)
+
 
 class Aspect(ABC):
     """
         Base, abstract class.
     """
 
-    def __init__(self, profile, lang, alpha=1, beta=0):
+    def __init__(self, profile, lang, alpha=1, beta=0, prepared=None):
+        pass
+
+    @staticmethod
+    def prepare(profile, lang):
+        """
+            Prepare structures of the aspect that do not depend on alpha and beta (e.g. indices of profile tables). They are built only
+            once per profile and passed to the constructor of the aspect for each alpha as prepared.
+        """
+        return None
+
+    def build_all_tables(self):
+        """
+            Build all tables the aspect otherwise builds lazily when they are needed for the first time (e.g. before compiling it).
+        """
         pass
 
     def apply(self, text, whitespace_info):
         """
             Apply specific noise to given tokenized text.
             Whitespace_info stores information on whether space should be inserted between adjacent tokens when detokenizing.
+            Aspects override either this method or apply_sentence.
         """
-        pass
+        sentence = NoisedSentence(text.split(' '), whitespace_info)
+        self.apply_sentence(sentence)
+        return sentence.text(), sentence.changes, sentence.whitespace_info
+
+    def apply_sentence(self, sentence):
+        """
+            Apply specific noise to given NoisedSentence in place.
+            Aspects that process the text token by token override this, so that the text is not joined and split again for each aspect.
+        """
+        text, changes, sentence.whitespace_info = self.apply(sentence.text(), sentence.whitespace_info)
+        sentence.tokens = text.split(' ')
+        sentence.changes.extend(changes)
+
+    def apply_batch(self, sentences):
+        """
+            Apply specific noise to given list of NoisedSentences in place.
+            Aspects that are able to process the whole batch at once override this.
+        """
+        for sentence in sentences:
+            self.apply_sentence(sentence)
+
+    @classmethod
+    def estimate_probabilities(cls, m2_records):
+        """
+            Estimate probabilities from parsed M2 files, returns the key of the aspect in profile and its estimated values.
+        """
+        return cls.finalize(cls.accumulate(m2_records))
 
     @staticmethod
-    def estimate_probabilities(m2_records):
-        pass
+    def accumulate(m2_records):
+        """
+            Count statistics of the aspect in parsed M2 files. Returned partial counts are nested dicts with numbers in leaves
+            (serializable to JSON), so that counts of several parts of data can be merged.
+        """
+        raise NotImplementedError()
+
+    @staticmethod
+    def merge(partial_counts):
+        """
+            Merge list of partial counts (of different parts of data) into counts of all the data.
+        """
+        return utils.merge_counts(partial_counts)
+
+    @staticmethod
+    def finalize(counts):
+        """
+            Compute the estimated probabilities from counts, returns the key of the aspect in profile and its estimated values.
+        """
+        raise NotImplementedError()
@@ -1,4 +1,3 @@
-from aspects import apply_m2_edits
 import numpy as np
 from aspects.base import Aspect
 from aspects import utils
@@ -7,7 +6,7 @@ from aspects import utils
 # TODO ta distribuce char_change_case_probs asi neni uplne to prave orechove, protoze v nekterych slovech to bude asi treba cele upper, nebo jenom malo lower
 
 class Casing(Aspect):
-    def __init__(self, profile, lang, alpha=1, beta=0):
+    def __init__(self, profile, lang, alpha=1, beta=0, prepared=None):
         super(Casing, self).__init__(profile, alpha, beta)
 
         word_casing_probs = profile['casing']['word_casing_probs']
@@ -34,19 +33,19 @@ class Casing(Aspect):
             else:
                 applicability_place = 'other'
 
-            if len(word) > 0 and word[0].isupper() and np.random.uniform(0, 1) < self.word_casing_probs[applicability_place]['first_lower']:
+            if len(word) > 0 and word[0].isupper() and utils.trigger(self.word_casing_probs[applicability_place]['first_lower']):
                 new_text.append(word[0].lower() + word[1:])
                 changes.append(['CASING', 'first_lower {}'.format(word)])
-            elif len(word) > 0 and word.lower() != word and np.random.uniform(0, 1) < self.word_casing_probs[applicability_place]['all_lower']:
+            elif len(word) > 0 and word.lower() != word and utils.trigger(self.word_casing_probs[applicability_place]['all_lower']):
                 new_text.append(word.lower())
                 changes.append(['CASING', 'all_lower {}'.format(word)])
             # note that when doing mixed casing, we need to check that the word's upper- and lower- cased version actually differ (e.g. 鈔)
-            elif word.lower() != word.upper() and np.random.uniform(0, 1) < self.word_casing_probs[applicability_place]['other']:
+            elif word.lower() != word.upper() and utils.trigger(self.word_casing_probs[applicability_place]['other']):
                 new_word = list(word)
 
                 while new_word == list(word):
                     for char_ind, char in enumerate(word):
-                        if np.random.uniform(0, 1) < self.char_change_case_prob:
+                        if utils.uniform() < self.char_change_case_prob:
                             if char.isupper():
                                 new_word[char_ind] = char.lower()
                             else:
@@ -60,12 +59,11 @@ class Casing(Aspect):
         return " ".join(new_text), changes, whitespace_info
 
     @staticmethod
-    def estimate_probabilities(m2_records):
+    def accumulate(m2_records):
         '''
 
-            :param m2_files_loaded: list of loaded m2_files
-             i.e. one item of the list was obtained by sequence of:
-                m2_file = open(m2_file).read().strip().split("\n\n")
+            :param m2_records: list of parsed m2_files
+             i.e. one item of the list is a list of apply_m2_edits.M2Sentence for each sentence of the file
             :return:
             '''
 
@@ -93,9 +91,10 @@ class Casing(Aspect):
 
         '''
         First lower and all_lower are revertible (we know what to do), but other is non-revertible, so we estimate
-        number of chars that changed its casing
+        number of chars that changed its casing (their mean is computed from their sum and count)
         '''
-        char_change_case_probs = []
+        char_change_case_probs_sum = 0
+        num_char_change_case_probs = 0
 
         def get_change_char_case_prob_for_pair(orig, cor):
             num_change = 0
@@ -109,33 +108,31 @@ class Casing(Aspect):
 
         for m2_file in m2_records:
 
-            for info in m2_file:
-                orig_sent, coder_dict = apply_m2_edits.processM2(info, [])
+            for sentence in m2_file:
+                orig_sent = sentence.orig
 
-                if coder_dict:
-                    coder_id = list(coder_dict.keys())[0]
-                    cor_sent = coder_dict[coder_id][0]
+                if sentence.coders:
+                    cor_sent = sentence.cor
 
-                    for edit in coder_dict[coder_id][1]:
-                        orig_start, orig_end, error_type, cor_tok, cor_start, cor_end = edit
-
-                        if 'ORTH:CASING' in error_type or (
-                                        'ORTH' in error_type and " ".join(orig_sent[orig_start:orig_end]).lower() == " ".join(
-                                    cor_sent[cor_start:cor_end]).lower()):
-                            if (orig_start == 0) or (orig_sent[orig_start - 1] in final_punctuation_marks):
+                    for edit in sentence.edits:
+                        if 'ORTH:CASING' in edit.error_type or (
+                                        'ORTH' in edit.error_type and " ".join(orig_sent[edit.orig_start:edit.orig_end]).lower() == " ".join(
+                                    cor_sent[edit.cor_start:edit.cor_end]).lower()):
+                            if (edit.orig_start == 0) or (orig_sent[edit.orig_start - 1] in final_punctuation_marks):
                                 applicability_place = 'start'
                             else:
                                 applicability_place = 'other'
 
-                            cor_tok_first_lower = cor_tok[0].lower() + cor_tok[1:]
-                            if " ".join(orig_sent[orig_start:orig_end]) == cor_tok_first_lower:
+                            orig_tok = " ".join(orig_sent[edit.orig_start:edit.orig_end])
+                            cor_tok_first_lower = edit.cor_tok[0].lower() + edit.cor_tok[1:]
+                            if orig_tok == cor_tok_first_lower:
                                 diacr_type = 'first_lower'
-                            elif " ".join(orig_sent[orig_start:orig_end]) == cor_tok.lower():
+                            elif orig_tok == edit.cor_tok.lower():
                                 diacr_type = 'all_lower'
                             else:
                                 diacr_type = 'other'
-                                char_change_case_probs.append(
-                                    get_change_char_case_prob_for_pair(" ".join(orig_sent[orig_start:orig_end]), cor_tok))
+                                char_change_case_probs_sum += get_change_char_case_prob_for_pair(orig_tok, edit.cor_tok)
+                                num_char_change_case_probs += 1
 
                             casing_errors[applicability_place][diacr_type] += 1
 
@@ -151,6 +148,24 @@ class Casing(Aspect):
                     num_all_alpha_words_wo_start += sum([1 for x in orig_sent if
                                                          x.isalpha()]) - 1  # -1 for the first token (punct tokens are filtered out as they are not alpha)
 
+        return {
+            'casing_errors': casing_errors,
+            'num_all_alpha_words_wo_start': num_all_alpha_words_wo_start,
+            'num_tokens_with_first_upper_wo_start': num_tokens_with_first_upper_wo_start,
+            'num_tokens_with_any_upper_wo_start': num_tokens_with_any_upper_wo_start,
+            'num_start_tokens': num_start_tokens,
+            'char_change_case_probs_sum': char_change_case_probs_sum,
+            'num_char_change_case_probs': num_char_change_case_probs
+        }
+
+    @staticmethod
+    def finalize(counts):
+        casing_errors = counts['casing_errors']
+        num_all_alpha_words_wo_start = counts['num_all_alpha_words_wo_start']
+        num_tokens_with_first_upper_wo_start = counts['num_tokens_with_first_upper_wo_start']
+        num_tokens_with_any_upper_wo_start = counts['num_tokens_with_any_upper_wo_start']
+        num_start_tokens = counts['num_start_tokens']
+
         word_casing_probs = {}
         for applicability_place in casing_errors:
             word_casing_probs[applicability_place] = {}
@@ -169,7 +184,8 @@ class Casing(Aspect):
                         word_casing_probs[applicability_place][diacr_type] = casing_errors[applicability_place][
                                                                                  diacr_type] / num_all_alpha_words_wo_start
 
-        char_change_case_prob = np.mean(char_change_case_probs)
+        char_change_case_prob = counts['char_change_case_probs_sum'] / counts['num_char_change_case_probs'] \
+            if counts['num_char_change_case_probs'] else np.nan
         return 'casing', {'word_casing_probs': word_casing_probs,
                           'char_change_case_prob': char_change_case_prob
                           }
@@ -1,103 +1,133 @@
-from aspects import apply_m2_edits
+from collections import Counter
+
 import numpy as np
 from aspects.base import Aspect
 from aspects import utils
 
 
 class CommonOther(Aspect):
-    def __init__(self, profile, lang, alpha=1, beta=0):
+    def __init__(self, profile, lang, alpha=1, beta=0, prepared=None):
         super(CommonOther, self).__init__(profile, alpha, beta)
 
-        common_other_all_pairs_probs = profile['common_other']['all_pairs_probs']
+        self.alpha = alpha
+        self.beta = beta
+        self.unsmoothed_all_pairs_probs = profile['common_other']['all_pairs_probs']
 
-        self.common_other_all_pairs_probs = {}
-        for cor_from in common_other_all_pairs_probs:
-            self.common_other_all_pairs_probs[cor_from] = utils._apply_smoothing_on_simple_dict(common_other_all_pairs_probs[cor_from],
-                                                                                                alpha, beta)
+        # inserts are smoothed right away, substitutes / deletes are sampled from tables (whose total is the probability of changing the
+        # tokens at all) smoothed when their tokens are found in text for the first time
+        self.common_other_insert_probs = None
+        if '' in self.unsmoothed_all_pairs_probs:
+            self.common_other_insert_probs = utils._apply_smoothing_on_simple_dict(self.unsmoothed_all_pairs_probs[''], alpha, beta)
+        self.common_other_all_pairs_tables = {}
+        self.phrase_matcher = prepared if prepared is not None else CommonOther.prepare(profile, lang)
 
-    def apply(self, text, whitespace_info):
-        def _get_occurence_start_indices_of_tokens_in_text(text, substring):
-            '''
-            Return all occurences of substring in text, but make sure that each occurence of substring is bordered by non-alpha characters, so
-            that substring is not a part of another word (e.g. for substring "se" we do not want to count its occurence in text "prase")
-            '''
-            occurence_start_indices = []
-            last_occurence_start_index = -1
-            while substring in text[last_occurence_start_index + 1:]:
-                start_index = text.index(substring, last_occurence_start_index + 1)
+    @staticmethod
+    def prepare(profile, lang):
+        return CommonOther.build_phrase_matcher(profile['common_other']['all_pairs_probs'])
 
-                if (start_index == 0 or (start_index != 0 and [start_index - 1] == ' ')) and (
-                            (start_index + len(substring) == len(text)) or text[start_index + len(substring)] == ' '):
-                    occurence_start_indices.append(start_index)
+    @staticmethod
+    def build_phrase_matcher(all_pairs_probs):
+        return utils.PhraseMatcher([cor_from for cor_from in all_pairs_probs if cor_from])
 
-                last_occurence_start_index = start_index
+    def build_all_tables(self):
+        for cor_from in self.unsmoothed_all_pairs_probs:
+            if cor_from:
+                self._get_replace_table(cor_from)
 
-            return occurence_start_indices
+    def _get_replace_table(self, cor_tok):
+        if cor_tok not in self.common_other_all_pairs_tables:
+            replace_probs = utils._apply_smoothing_on_simple_dict(self.unsmoothed_all_pairs_probs[cor_tok], self.alpha, self.beta)
+            self.common_other_all_pairs_tables[cor_tok] = utils.SamplingTable(replace_probs.keys(), replace_probs.values())
+        return self.common_other_all_pairs_tables[cor_tok]
 
+    def apply(self, text, whitespace_info):
         changes = []
         '''
-        Go over all keys (corrected tokens) in all_pairs_probs and try to apply each of them on its each occurence in text.
+        Find all occurences of keys (corrected tokens) of all_pairs_probs in text at once and try to apply each of them. Occurences are
+        processed from left to right (longer first when starting at the same token), each token is changed at most once.
+
+        Only the occurences at the start of the text are used, as by the original implementation (whose check of the space before an
+        occurence never held). The alphas precomputed for the profiles are calibrated with this behaviour.
         '''
-        # substitutes / deletes
-        for cor_tok in self.common_other_all_pairs_probs:
-            if not cor_tok:  # insertions are done separately
+        # substitutes / deletes (insertions are done separately)
+        tokens = text.split(' ')
+        lowered_tokens = [token.lower() for token in tokens]
+
+        token_start_indices = {}
+        char_index = 0
+        for token_ind, token in enumerate(lowered_tokens):
+            token_start_indices[char_index] = token_ind
+            char_index += len(token) + 1
+
+        occurences = self.phrase_matcher.find_at_start(" ".join(lowered_tokens), lambda c: c == ' ')
+
+        # new tokens with whitespace info of the space before each of them
+        new_tokens, new_tokens_whitespace_info = [], []
+        pending_whitespace_info = None  # whitespace info for the next new token (if it differs from the original one)
+        num_remaining_tokens = len(tokens)
+        next_token_ind = 0
+
+        def _copy_tokens(until_token_ind):
+            nonlocal next_token_ind, pending_whitespace_info
+            for token_ind in range(next_token_ind, until_token_ind):
+                new_tokens.append(tokens[token_ind])
+                if pending_whitespace_info is not None:
+                    new_tokens_whitespace_info.append(pending_whitespace_info)
+                    pending_whitespace_info = None
+                else:
+                    new_tokens_whitespace_info.append(whitespace_info[token_ind - 1] if token_ind > 0 else True)
+            next_token_ind = max(next_token_ind, until_token_ind)
+
+        for start_index, cor_tok in occurences:
+            start_token_ind = token_start_indices[start_index]
+            if start_token_ind < next_token_ind:  # overlaps with already changed tokens
                 continue
 
-            occurence_start_indices = _get_occurence_start_indices_of_tokens_in_text(text.lower(), cor_tok)
-            if len(occurence_start_indices) > 0:
-                char_relative_change = 0
-                for start_index in occurence_start_indices:
-                    start_index = start_index + char_relative_change
-                    if np.random.uniform(0, 1) < np.sum(list(self.common_other_all_pairs_probs[cor_tok].values())):
-                        replace_tokens_probs = np.array(list(self.common_other_all_pairs_probs[cor_tok].values()))
-                        replace_tokens_probs_normalized = replace_tokens_probs / np.sum(replace_tokens_probs)
-
-                        chosen_replace_tokens = np.random.choice(list(self.common_other_all_pairs_probs[cor_tok].keys()),
-                                                                 p=replace_tokens_probs_normalized)
-
-                        # if this is delete and would delete whole text, do not perform it
-                        if len(chosen_replace_tokens) == 0 and len(cor_tok) == len(text):
-                            continue
-
-                        if text[start_index].isupper() and len(chosen_replace_tokens) > 0:
-                            chosen_replace_tokens = chosen_replace_tokens[0].upper() + chosen_replace_tokens[1:]
-
-                        if len(chosen_replace_tokens) == 0:  # delete
-                            if start_index == 0:
-                                text = text[start_index + 1 + len(cor_tok):]
-                            else:
-                                text = text[:start_index - 1] + chosen_replace_tokens + text[start_index + len(cor_tok):]
-                        else:
-                            text = text[:start_index] + chosen_replace_tokens + text[start_index + len(cor_tok):]
-
-                        # fix whitespace info
-                        num_tokens_in_correct = len(cor_tok.split(' '))
-                        num_tokens_in_noised = len(chosen_replace_tokens.split(' ')) if chosen_replace_tokens else 0
-
-                        start_index_token_num = np.sum([1 for x in text[:start_index] if x == ' '], dtype=np.int32)
-                        if num_tokens_in_correct > num_tokens_in_noised:
-                            for _ in range(num_tokens_in_correct - num_tokens_in_noised):
-                                del whitespace_info[start_index_token_num]
-                        elif num_tokens_in_correct < num_tokens_in_noised:
-                            for _ in range(num_tokens_in_noised - num_tokens_in_correct):
-                                whitespace_info.insert(start_index_token_num, True)
-
-                        char_relative_change += len(chosen_replace_tokens) - len(cor_tok)
-                        if len(chosen_replace_tokens) == 0:
-                            char_relative_change -= 1  # if we delete a token, we also remove one space next to it
-
-                        if len(chosen_replace_tokens) == 0:
-                            changes.append(['COMMON-OTHER', 'delete {}'.format(cor_tok)])
-                        else:
-                            changes.append(['COMMON-OTHER', 'change {} -> {}'.format(cor_tok, chosen_replace_tokens)])
+            replace_table = self._get_replace_table(cor_tok)
+            num_tokens_in_correct = len(cor_tok.split(' '))
+
+            # delete that would delete whole text is not performed, so only the other replacements can introduce an error
+            delete_not_allowed = num_tokens_in_correct == num_remaining_tokens and '' in replace_table.keys
+            change_prob = replace_table.total - (replace_table.probs[replace_table.keys.index('')] if delete_not_allowed else 0)
+            if not utils.trigger(change_prob):
+                continue
+
+            chosen_replace_tokens = replace_table.sample()
+            while delete_not_allowed and len(chosen_replace_tokens) == 0:
+                chosen_replace_tokens = replace_table.sample()
+
+            if tokens[start_token_ind][:1].isupper() and len(chosen_replace_tokens) > 0:
+                chosen_replace_tokens = chosen_replace_tokens[0].upper() + chosen_replace_tokens[1:]
+
+            _copy_tokens(start_token_ind)
+            if pending_whitespace_info is None:
+                pending_whitespace_info = whitespace_info[start_token_ind - 1] if start_token_ind > 0 else True
+
+            if len(chosen_replace_tokens) == 0:  # delete, whitespace before the deleted tokens is kept for the next token
+                changes.append(['COMMON-OTHER', 'delete {}'.format(cor_tok)])
+            else:
+                for token in chosen_replace_tokens.split(' '):
+                    new_tokens.append(token)
+                    new_tokens_whitespace_info.append(pending_whitespace_info)
+                    pending_whitespace_info = True
+                pending_whitespace_info = None
+                changes.append(['COMMON-OTHER', 'change {} -> {}'.format(cor_tok, chosen_replace_tokens)])
+
+            next_token_ind = start_token_ind + num_tokens_in_correct
+            num_remaining_tokens -= num_tokens_in_correct - (len(chosen_replace_tokens.split(' ')) if chosen_replace_tokens else 0)
+
+        if changes:
+            _copy_tokens(len(tokens))
+            text = " ".join(new_tokens)
+            whitespace_info = new_tokens_whitespace_info[1:]
 
         # inserts
         insert_into_whitespace = [None] * len(whitespace_info)
-        if '' in self.common_other_all_pairs_probs:
+        if self.common_other_insert_probs is not None:
             for whitespace_ind in range(len(insert_into_whitespace)):
-                for tokens_to in np.random.permutation(
-                        list(self.common_other_all_pairs_probs[''].keys())):  # do permutation to allow all tokens when alpha-smoothing is high
-                    if np.random.uniform(0, 1) < self.common_other_all_pairs_probs[''][tokens_to]:
+                for tokens_to in utils.permutation(
+                        list(self.common_other_insert_probs.keys())):  # do permutation to allow all tokens when alpha-smoothing is high
+                    if utils.trigger(self.common_other_insert_probs[tokens_to]):
                         insert_into_whitespace[whitespace_ind] = tokens_to
                         break  # do just one insert per each whitespace
 
@@ -122,70 +152,88 @@ class CommonOther(Aspect):
         return new_text, changes, whitespace_info
 
     @staticmethod
-    def _get_occurence_count_of_tokens_in_text(text, substring):
+    def _get_occurence_counts_of_tokens_in_text(text, phrase_matcher):
         '''
-        Get all occurences of substring in text, but make sure that each occurence of substring is bordered by non-alpha characters, so that
-        substring is not a part of another word (e.g. for substring "se" we do not want to count its occurence in text "prase")
+        Get number of occurences of each phrase of phrase_matcher in text, but make sure that each occurence of phrase is bordered by non-alpha
+        characters, so that phrase is not a part of another word (e.g. for phrase "se" we do not want to count its occurence in text "prase")
         '''
-        num_occurences_of_cor_tok_in_cor = 0
-        last_occurence_start_index = -1
-        while substring in text[last_occurence_start_index + 1:]:
-            start_index = text.index(substring, last_occurence_start_index + 1)
+        return Counter(phrase for _, phrase in phrase_matcher.find(text, lambda c: not c.isalpha()))
 
-            if (start_index == 0 or (start_index != 0 and not text[start_index - 1].isalpha())) and (
-                        (start_index + len(substring) == len(text)) or not text[start_index + len(substring)].isalpha()):
-                num_occurences_of_cor_tok_in_cor += 1
+    @staticmethod
+    def _get_corrected_sentences(m2_records):
+        '''
+        Lowercased corrected sentences of parsed M2 files in which the occurences of phrases are counted.
+        '''
+        for m2_file in m2_records:
+            for sentence in m2_file:
+                if sentence.coders:
+                    yield " ".join(sentence.cor).lower()
 
-            last_occurence_start_index = start_index
+    @staticmethod
+    def _count_occurences(corrected_sentences, cor_toks):
+        num_occurence = {cor_tok: 0 for cor_tok in cor_toks if cor_tok.strip()}
+        phrase_matcher = utils.PhraseMatcher(list(num_occurence.keys()))
 
-        return num_occurences_of_cor_tok_in_cor
+        for cor_sent, sentence_count in corrected_sentences:
+            for cor_tok, count in CommonOther._get_occurence_counts_of_tokens_in_text(cor_sent, phrase_matcher).items():
+                num_occurence[cor_tok] += count * sentence_count
+        return {'num_occurence': num_occurence}
 
     @staticmethod
-    def _get_occurence_counts(cor_toks, coder_dicts):
-        num_occurence = {}
-
-        for coder_dict in coder_dicts:
-            if coder_dict:
-                coder_id = list(coder_dict.keys())[0]
+    def accumulate_occurences(m2_records, cor_toks):
+        '''
+        Count occurences of (non-empty) corrected phrases cor_toks in corrected sentences of parsed M2 files. Returns partial counts
+        mergeable with the counts returned by accumulate.
 
-                cor_sent = coder_dict[coder_id][0]
+        Counts of different parts of data must contain occurences of the same phrases to be merged. When the parts are counted separately,
+        the occurences of phrases of other parts (missing in the counts of a part) can be added by merging counts of this method.
+        '''
+        return CommonOther._count_occurences(((cor_sent, 1) for cor_sent in CommonOther._get_corrected_sentences(m2_records)), cor_toks)
 
-                cor_sent = " ".join(cor_sent).lower()
+    @staticmethod
+    def accumulate_corrected_sentences(m2_records):
+        '''
+        Count the corrected sentences of parsed M2 files (lowercased, as the phrases are counted in them). Returns partial counts mergeable
+        with the counts returned by accumulate, so that occurences of phrases of data added to the counts later can be counted in this
+        data without its M2 files (see count_stored_occurences).
+        '''
+        return {'corrected_sentences': dict(Counter(CommonOther._get_corrected_sentences(m2_records)))}
 
-                for cor_tok in cor_toks:
-                    if cor_tok not in num_occurence:
-                        num_occurence[cor_tok] = 0
+    @staticmethod
+    def count_stored_occurences(counts, cor_toks):
+        '''
+        Count occurences of corrected phrases cor_toks in the corrected sentences stored in counts (see accumulate_corrected_sentences),
+        returns partial counts as accumulate_occurences.
+        '''
+        return CommonOther._count_occurences(counts['corrected_sentences'].items(), cor_toks)
 
-                    if not cor_tok.strip():  # replace empty string with some tokens (= insert)
-                        num_occurence[cor_tok] += len(cor_sent.split(' ')) + 1  # number of places where the token could be inserted
-                    else:
-                        num_occurence[cor_tok] += CommonOther._get_occurence_count_of_tokens_in_text(cor_sent, cor_tok)
-        return num_occurence
+    @staticmethod
+    def get_missing_occurences(counts, partial_counts):
+        '''
+        Get corrected phrases of (merged) counts whose occurences are not counted in partial_counts (see accumulate_occurences).
+        '''
+        return [cor_toks for cor_toks in counts['all_pairs'] if cor_toks.strip() and cor_toks not in partial_counts['num_occurence']]
 
     @staticmethod
-    def estimate_probabilities(m2_records):
-        num_files = 0
+    def accumulate(m2_records):
+        '''
+            Count pairs of corrected and original phrases and the occurences of the corrected phrases of these pairs (empty phrase, i.e.
+            insertion, is estimated from the number of alpha words, its occurences are not counted).
+            '''
         exclude_error_types = ['noop', 'PUNCT', 'CASING']
         num_all_alpha_words = 0
 
         all_pairs = {}
-        cached_coder_dicts = []
 
         for m2_file in m2_records:
-            num_files += 1
+            for sentence in m2_file:
+                orig_sent = sentence.orig
+                if sentence.coders:
+                    for edit in sentence.edits:
+                        cor_tok = edit.cor_tok.lower()
 
-            for info in m2_file:
-                orig_sent, coder_dict = apply_m2_edits.processM2(info, [])
-                if coder_dict:
-                    cached_coder_dicts.append(coder_dict)
-                    coder_id = list(coder_dict.keys())[0]
-
-                    for edit in coder_dict[coder_id][1]:
-                        orig_start, orig_end, error_type, cor_tok, cor_start, cor_end = edit
-                        cor_tok = cor_tok.lower()
-
-                        if all([x not in error_type for x in exclude_error_types]):
-                            orig_toks = " ".join(orig_sent[orig_start:orig_end]).lower()
+                        if all([x not in edit.error_type for x in exclude_error_types]):
+                            orig_toks = " ".join(orig_sent[edit.orig_start:edit.orig_end]).lower()
 
                             # # check that this error is not already handled by suffix/prefix estimator
                             # if (orig_end - orig_start == 0) or (cor_end - cor_start == 0) or (
@@ -201,7 +249,17 @@ class CommonOther(Aspect):
 
                 num_all_alpha_words += sum([1 for x in orig_sent if x.isalpha()])
 
-        num_occurence = CommonOther._get_occurence_counts(list(all_pairs.keys()), cached_coder_dicts)
+        return {
+            'all_pairs': all_pairs,
+            'num_all_alpha_words': num_all_alpha_words,
+            'num_occurence': CommonOther.accumulate_occurences(m2_records, all_pairs.keys())['num_occurence']
+        }
+
+    @staticmethod
+    def finalize(counts):
+        all_pairs = counts['all_pairs']
+        num_all_alpha_words = counts['num_all_alpha_words']
+        num_occurence = counts['num_occurence']
 
         all_pairs_probs = {}
         filter_out_min_occ_count = 3
@@ -0,0 +1,150 @@
+'''
+Compiled profile stores all aspects of a profile already smoothed for a given alpha and beta. All sampling tables (and other float arrays)
+are packed into a single block of float64 values that is memory-mapped when loading, the rest of aspects' attributes is stored in a JSON
+header.
+
+File layout:
+    MAGIC (8 bytes) | header length (uint64, little-endian) | JSON header | padding to 8 bytes | float64 block
+'''
+import json
+
+import numpy as np
+from aspects import utils
+from aspects.casing import Casing
+from aspects.common_other import CommonOther
+from aspects.diacritics import Diacritics
+from aspects.punctuation import Punctuation
+from aspects.spelling import Spelling
+from aspects.suffix_prefix import SuffixPrefix
+from aspects.whitespace import Whitespace
+from aspects.word_order import WordOrder
+
+MAGIC = b'KAZIPRF3'
+
+ASPECT_CLASSES = {
+    'casing': Casing,
+    'common_other': CommonOther,
+    'diacritics': Diacritics,
+    'punctuation': Punctuation,
+    'spelling': Spelling,
+    'suffix_prefix': SuffixPrefix,
+    'whitespace': Whitespace,
+    'word_order': WordOrder
+}
+
+# attributes holding external resources or structures derived from other attributes, these are not compiled and are set up again when
+# loading
+NOT_COMPILED_ATTRIBUTES = {
+    'common_other': ['phrase_matcher'],
+    'spelling': ['aspell_speller']
+}
+
+
+def _encode(value, arrays):
+    if isinstance(value, utils.SamplingTable):
+        table = {'keys': [_encode(k, arrays) for k in value.keys], 'total': value.total}
+        for name in utils.SamplingTable.ARRAYS:
+            table[name] = [sum(len(a) for a in arrays), len(getattr(value, name))]
+            arrays.append(getattr(value, name).astype(np.float64))
+        return {'table': table}
+    elif isinstance(value, np.ndarray):
+        arrays.append(value.astype(np.float64).ravel())
+        return {'array': [sum(len(a) for a in arrays[:-1]), list(value.shape)]}
+    elif isinstance(value, dict):
+        return {'dict': [[_encode(k, arrays), _encode(v, arrays)] for k, v in value.items()]}
+    elif isinstance(value, tuple):
+        return {'tuple': [_encode(x, arrays) for x in value]}
+    elif isinstance(value, list):
+        return {'list': [_encode(x, arrays) for x in value]}
+    elif isinstance(value, (np.integer, np.floating)):
+        return value.item()
+
+    return value
+
+
+def _decode(value, data):
+    if not isinstance(value, dict):
+        return value
+
+    value_type, value = next(iter(value.items()))
+    if value_type == 'table':
+        arrays = {}
+        for name in utils.SamplingTable.ARRAYS:
+            offset, length = value[name]
+            arrays[name] = data[offset:offset + length]
+        return utils.SamplingTable([_decode(k, data) for k in value['keys']], total=value['total'], **arrays)
+    elif value_type == 'array':
+        offset, shape = value
+        return data[offset:offset + int(np.prod(shape))].reshape(shape)
+    elif value_type == 'dict':
+        return {_decode(k, data): _decode(v, data) for k, v in value}
+    elif value_type == 'tuple':
+        return tuple(_decode(x, data) for x in value)
+    else:
+        return [_decode(x, data) for x in value]
+
+
+def is_compiled_profile(profile_file):
+    with open(profile_file, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def save_compiled_profile(aspects, outfile, lang, alpha, beta):
+    arrays = []
+    encoded_aspects = {}
+    for aspect_name, aspect in aspects.items():
+        aspect.build_all_tables()
+        encoded_aspects[aspect_name] = {attribute: _encode(value, arrays) for attribute, value in aspect.__dict__.items() if
+                                        attribute not in NOT_COMPILED_ATTRIBUTES.get(aspect_name, [])}
+
+    header = json.dumps({'lang': lang, 'alpha': alpha, 'beta': beta, 'aspects': encoded_aspects}).encode('utf-8')
+    header += b' ' * (-(len(MAGIC) + 8 + len(header)) % 8)  # float64 block must be aligned
+
+    with open(outfile, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        for array in arrays:
+            f.write(np.ascontiguousarray(array, dtype='<f8').tobytes())
+
+
+def _read_header(profile_file):
+    with open(profile_file, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a compiled profile".format(profile_file))
+
+        header_len = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+        header = json.loads(f.read(header_len).decode('utf-8'))
+
+    return header, len(MAGIC) + 8 + header_len
+
+
+def get_compiled_profile_smoothing(profile_file):
+    '''
+    Returns alpha and beta the compiled profile was smoothed with (without loading its aspects).
+    '''
+    header, _ = _read_header(profile_file)
+    return header['alpha'], header['beta']
+
+
+def load_compiled_profile(profile_file, aspell_speller=None):
+    '''
+    Load aspects stored in compiled profile together with the alpha and beta they were smoothed with. Sampling tables are backed by
+    memory-mapped file, so loading is cheap and the tables are shared by all processes using the same compiled profile.
+    '''
+    header, data_offset = _read_header(profile_file)
+    try:
+        data = np.memmap(profile_file, dtype='<f8', mode='r', offset=data_offset)
+    except ValueError:  # there are no sampling tables at all (empty file cannot be memory-mapped)
+        data = np.zeros(0)
+
+    aspects = {}
+    for aspect_name, encoded_attributes in header['aspects'].items():
+        aspect = ASPECT_CLASSES[aspect_name].__new__(ASPECT_CLASSES[aspect_name])
+        aspect.__dict__.update({attribute: _decode(value, data) for attribute, value in encoded_attributes.items()})
+        aspects[aspect_name] = aspect
+
+    aspects['common_other'].phrase_matcher = CommonOther.build_phrase_matcher(aspects['common_other'].unsmoothed_all_pairs_probs)
+    aspects['spelling'].aspell_speller = aspell_speller if aspell_speller is not None else Spelling.load_aspell_speller(header['lang'])
+
+    return aspects, header['alpha'], header['beta']
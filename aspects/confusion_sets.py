@@ -0,0 +1,86 @@
+'''
+Confusion sets store top Aspell suggestions for words of a vocabulary, so that Spelling aspect can use them instead of a live Aspell
+speller. The file is memory-mapped when loading and words are looked up by binary search, so nothing needs to be parsed in advance.
+
+File layout:
+    MAGIC (8 bytes) | header length (uint64, little-endian) | JSON header | padding to 8 bytes | entry offsets (uint64, num_words + 1) |
+    entries
+Each entry is UTF-8 encoded word followed by its suggestions, separated by tabs. Entries are sorted by UTF-8 encoded words.
+'''
+import json
+import mmap
+
+import numpy as np
+
+MAGIC = b'KAZICNF1'
+
+
+def is_confusion_sets_file(confusion_sets_file):
+    with open(confusion_sets_file, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def save_confusion_sets(suggestions, outfile, lang, dictionary):
+    '''
+    Save confusion sets given as dict mapping words to lists of their suggestions.
+    '''
+    entries = sorted("\t".join([word] + list(word_suggestions)).encode('utf-8') for word, word_suggestions in suggestions.items())
+    offsets = np.cumsum([0] + [len(entry) for entry in entries], dtype=np.uint64)
+
+    header = json.dumps({'lang': lang, 'dictionary': dictionary, 'num_words': len(entries)}).encode('utf-8')
+    header += b' ' * (-(len(MAGIC) + 8 + len(header)) % 8)  # offsets must be aligned
+
+    with open(outfile, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        f.write(offsets.astype('<u8').tobytes())
+        for entry in entries:
+            f.write(entry)
+
+
+class ConfusionSets:
+    '''
+    Memory-mapped confusion sets, offering the suggest method of Aspell speller. Words missing in the confusion sets have no suggestions.
+    '''
+
+    def __init__(self, confusion_sets_file):
+        with open(confusion_sets_file, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("{} is not a confusion sets file".format(confusion_sets_file))
+
+            header_len = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+            header = json.loads(f.read(header_len).decode('utf-8'))
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.lang = header['lang']
+        self.dictionary = header['dictionary']
+        self.num_words = header['num_words']
+
+        offsets_start = len(MAGIC) + 8 + header_len
+        self.entries_start = offsets_start + 8 * (self.num_words + 1)
+        self.offsets = np.frombuffer(self.data, dtype='<u8', count=self.num_words + 1, offset=offsets_start).tolist()
+
+    def __len__(self):
+        return self.num_words
+
+    def _get_entry(self, entry_ind):
+        return self.data[self.entries_start + self.offsets[entry_ind]:self.entries_start + self.offsets[entry_ind + 1]]
+
+    def suggest(self, word):
+        encoded_word = word.encode('utf-8')
+        low, high = 0, self.num_words
+        while low < high:
+            middle = (low + high) // 2
+            if self._get_entry(middle) < encoded_word:
+                low = middle + 1
+            else:
+                high = middle
+
+        # the found entry is the first one not smaller than the word, so it either starts with the word, or the word is missing
+        if low < self.num_words:
+            entry = self._get_entry(low).split(b'\t')
+            if entry[0] == encoded_word:
+                return [suggestion.decode('utf-8') for suggestion in entry[1:]]
+
+        return []
@@ -6,7 +6,7 @@ from aspects.diacritization_stripping import strip_diacritics_single_line
 
 
 class Diacritics(Aspect):
-    def __init__(self, profile, lang, alpha=1, beta=0):
+    def __init__(self, profile, lang, alpha=1, beta=0, prepared=None):
         super(Diacritics, self).__init__(profile, alpha, beta)
 
         all_wo_diacritics_perc = profile['diacritics']['all_wo_diacritics_perc']
@@ -16,49 +16,111 @@ class Diacritics(Aspect):
         self.wrong_char_diacritics_perc = utils._apply_smoothing([wrong_char_diacritics_perc], alpha, beta)[0]
 
         wrongly_diacritized_chars_probs = profile['diacritics']['wrongly_diacritized_chars_probs']
-        self.wrongly_diacritized_chars_probs = {
-            k: utils._apply_smoothing_on_simple_dict(wrongly_diacritized_chars_probs[k], alpha, beta) for k in
-            wrongly_diacritized_chars_probs}
+        self.wrongly_diacritized_chars_tables = {
+            k: utils._build_sampling_table(wrongly_diacritized_chars_probs[k], alpha, beta) for k in wrongly_diacritized_chars_probs}
 
-    def apply(self, text, whitespace_info):
-        changes = []
+        self.diacritizable_chars = prepared if prepared is not None else Diacritics.prepare(profile, lang)
 
-        if strip_diacritics_single_line(text) != text and np.random.uniform(0, 1) < self.all_wo_diacritics_perc:
-            changes.append(['DIACR', 'all_strip_diacritics'])
-            return strip_diacritics_single_line(text), changes, whitespace_info
-
-        new_text = ''
-
-        for c in text:
-            if c in self.wrongly_diacritized_chars_probs:
-                if np.random.uniform(0, 1) < self.wrong_char_diacritics_perc:
-                    new_text += np.random.choice(list(self.wrongly_diacritized_chars_probs[c].keys()),
-                                                 p=list(self.wrongly_diacritized_chars_probs[c].values()))
-                else:
-                    new_text += c
-            elif c.lower() in self.wrongly_diacritized_chars_probs:
-                if np.random.uniform(0, 1) < self.wrong_char_diacritics_perc:
-                    new_text += np.random.choice(list(self.wrongly_diacritized_chars_probs[c.lower()].keys()),
-                                                 p=list(self.wrongly_diacritized_chars_probs[c.lower()].values())).upper()
-                else:
-                    new_text += c
-            elif c.upper() in self.wrongly_diacritized_chars_probs:
-                if np.random.uniform(0, 1) < self.wrong_char_diacritics_perc:
-                    new_text += np.random.choice(list(self.wrongly_diacritized_chars_probs[c.upper()].keys()),
-                                                 p=list(self.wrongly_diacritized_chars_probs[c.upper()].values())).lower()
-                else:
-                    new_text += c
+    @staticmethod
+    def prepare(profile, lang):
+        # for each char that may get wrong diacritics: the table to sample from and how to change the case of the sampled char
+        wrongly_diacritized_chars_probs = profile['diacritics']['wrongly_diacritized_chars_probs']
+        diacritizable_chars = {}
+        for k in wrongly_diacritized_chars_probs:
+            for c in [k, k.upper(), k.lower()]:
+                if len(c) != 1 or c in diacritizable_chars:
+                    continue
+
+                if c in wrongly_diacritized_chars_probs:
+                    diacritizable_chars[c] = (c, '')
+                elif c.lower() in wrongly_diacritized_chars_probs:
+                    diacritizable_chars[c] = (c.lower(), 'upper')
+                elif c.upper() in wrongly_diacritized_chars_probs:
+                    diacritizable_chars[c] = (c.upper(), 'lower')
+
+        return diacritizable_chars
+
+    def apply_sentence(self, sentence):
+        self.apply_batch([sentence])
+
+    def apply_batch(self, sentences):
+        '''
+        All random numbers for the batch are drawn at once. Diacritizable chars of all texts are located with numpy and the new chars
+        are sampled for each of the wrongly diacritized chars tables in a single call.
+        '''
+        batch = [sentence.text() for sentence in sentences]
+        results = [None] * len(batch)
+
+        # only texts that change by stripping diacritics may be stripped
+        stripped_texts = [strip_diacritics_single_line(text) for text in batch]
+        strippable = [i for i, text in enumerate(batch) if stripped_texts[i] != text]
+        stripped = set(np.array(strippable)[utils.triggers(np.full(len(strippable), self.all_wo_diacritics_perc))].tolist())
+
+        texts_to_diacritize = []
+        for i, text in enumerate(batch):
+            if i in stripped:
+                results[i] = (stripped_texts[i], [['DIACR', 'all_strip_diacritics']])
             else:
-                new_text += c
-
-            if new_text[-1] != c:
-                changes.append(['DIACR', 'replace {} with {}'.format(c, new_text[-1])])
-
-        return new_text, changes, whitespace_info
+                texts_to_diacritize.append(i)
+
+        all_text = ''.join(batch[i] for i in texts_to_diacritize)
+        text_ends = np.cumsum([len(batch[i]) for i in texts_to_diacritize])
+
+        codes = np.frombuffer(all_text.encode('utf-32-le'), dtype='<u4')
+        diacritizable_codes = np.array([ord(c) for c in self.diacritizable_chars], dtype='<u4')
+        positions = np.flatnonzero(np.isin(codes, diacritizable_codes))
+        positions = positions[utils.triggers(np.full(len(positions), self.wrong_char_diacritics_perc))].tolist()
+
+        positions_per_table = {}
+        for position in positions:
+            positions_per_table.setdefault(self.diacritizable_chars[all_text[position]][0], []).append(position)
+
+        new_chars = {}
+        for table_key, table_positions in positions_per_table.items():
+            sampled_chars = self.wrongly_diacritized_chars_tables[table_key].sample_many(len(table_positions))
+            for position, new_char in zip(table_positions, sampled_chars):
+                case = self.diacritizable_chars[all_text[position]][1]
+                if case == 'upper':
+                    new_char = new_char.upper()
+                elif case == 'lower':
+                    new_char = new_char.lower()
+
+                if new_char != all_text[position]:
+                    new_chars[position] = new_char
+
+        changed_positions = sorted(new_chars)
+        changed_positions_text_inds = np.searchsorted(text_ends, changed_positions, side='right').tolist()
+        changes_per_text = [[] for _ in texts_to_diacritize]
+        for position, text_ind in zip(changed_positions, changed_positions_text_inds):
+            changes_per_text[text_ind].append(position)
+
+        text_start = 0
+        for text_ind, i in enumerate(texts_to_diacritize):
+            text = batch[i]
+            changes = []
+            new_text = []
+            last_end = 0
+            for position in changes_per_text[text_ind]:
+                position_in_text = position - text_start
+                new_text.append(text[last_end:position_in_text])
+                new_text.append(new_chars[position])
+                changes.append(['DIACR', 'replace {} with {}'.format(text[position_in_text], new_chars[position][-1])])
+                last_end = position_in_text + 1
+            new_text.append(text[last_end:])
+
+            results[i] = (''.join(new_text), changes)
+            text_start += len(text)
+
+        for sentence, (text, changes) in zip(sentences, results):
+            sentence.tokens = text.split(' ')
+            sentence.changes.extend(changes)
 
     @staticmethod
-    def estimate_probabilities(m2_records):
-
+    def accumulate(m2_records):
+        '''
+        Whether a text is written all without diacritics is decided for each M2 file as a whole, so M2 files must not be split into parts
+        whose counts are merged.
+        '''
         czech_diacritics_tuples = [('a', 'á'), ('c', 'č'), ('d', 'ď'), ('e', 'é', 'ě'), ('i', 'í'), ('n', 'ň'), ('o', 'ó'), ('r', 'ř'),
                                    ('s', 'š'), ('t', 'ť'), ('u', 'ů', 'ú'), ('y', 'ý'), ('z', 'ž')]
         czech_diacritizables_chars = [char for sublist in czech_diacritics_tuples for char in sublist] + [char.upper() for sublist in
@@ -75,26 +137,19 @@ class Diacritics(Aspect):
             num_files += 1
 
             original_paragraphs, corrected_paragraphs_wo_diacr, corrected_paragraphs = [], [], []
-            for info in m2_file:
-                # Get the original and corrected sentence + edits for each annotator.
-                orig_sent, coder_dict = apply_m2_edits.processM2(info, ["DIACR"])
-                orig_sent = " ".join(orig_sent)
-                if coder_dict:
-                    coder_id = list(coder_dict.keys())[0]
-                    cor_sent = " ".join(coder_dict[coder_id][0])
+            for sentence in m2_file:
+                # the corrected sentence without diacritics corrections is obtained by applying all but DIACR edits of the first annotator
+                if sentence.coders:
+                    corrected_paragraphs.append(" ".join(sentence.cor))
+                    if any("DIACR" in edit.error_type for edit in sentence.edits):
+                        corrected_paragraphs_wo_diacr.append(" ".join(apply_m2_edits.applyEdits(sentence.orig, sentence.edits, ["DIACR"])))
+                    else:
+                        corrected_paragraphs_wo_diacr.append(corrected_paragraphs[-1])
                 else:
-                    cor_sent = orig_sent
+                    corrected_paragraphs_wo_diacr.append(" ".join(sentence.orig))
+                    corrected_paragraphs.append(" ".join(sentence.orig))
 
-                original_paragraphs.append(orig_sent)
-                corrected_paragraphs_wo_diacr.append(cor_sent)
-
-                _, coder_dict = apply_m2_edits.processM2(info, [])
-                if coder_dict:
-                    coder_id = list(coder_dict.keys())[0]
-                    cor_sent = " ".join(coder_dict[coder_id][0])
-                else:
-                    cor_sent = orig_sent
-                corrected_paragraphs.append(cor_sent)
+                original_paragraphs.append(" ".join(sentence.orig))
 
             this_text_is_all_wo_diacritics_and_should_contain_some = False
             # if original sentence does not contain diacritics
@@ -122,8 +177,20 @@ class Diacritics(Aspect):
                         elif c_cor in czech_diacritizables_chars:
                             num_could_be_diacritized_char += 1
 
-        all_wo_diacritics_perc = num_all_wo_diacritics / num_files
-        wrong_char_diacritics_perc = num_badly_diacritized_chars / num_could_be_diacritized_char
+        return {
+            'num_all_wo_diacritics': num_all_wo_diacritics,
+            'num_files': num_files,
+            'num_badly_diacritized_chars': num_badly_diacritized_chars,
+            'num_could_be_diacritized_char': num_could_be_diacritized_char,
+            'wrongly_diacritized_chars_map': wrongly_diacritized_chars_map
+        }
+
+    @staticmethod
+    def finalize(counts):
+        wrongly_diacritized_chars_map = counts['wrongly_diacritized_chars_map']
+
+        all_wo_diacritics_perc = counts['num_all_wo_diacritics'] / counts['num_files']
+        wrong_char_diacritics_perc = counts['num_badly_diacritized_chars'] / counts['num_could_be_diacritized_char']
 
         # filter out characters whose correction in diacritics appeared too little (<3)
         filtered_wrongly_diacritized_chars_map = {}
@@ -1,24 +1,26 @@
 import sys
 
-from aspects import diacritization_stripping_data
+# translation table built from diacritization_stripping_data.strip_diacritization_uninames, see _get_strip_diacritics_table
+_strip_diacritics_table = None
+
+
+def _get_strip_diacritics_table():
+    '''
+    The (large) data module is imported and compiled into a str.translate table only when diacritics are stripped for the first time.
+    '''
+    global _strip_diacritics_table
+    if _strip_diacritics_table is None:
+        from aspects import diacritization_stripping_data
+        _strip_diacritics_table = str.maketrans(diacritization_stripping_data.strip_diacritization_uninames)
+
+    return _strip_diacritics_table
+
 
 def strip_diacritics(list_of_texts):
+    strip_diacritics_table = _get_strip_diacritics_table()
     for line in list_of_texts:
-        output = ""
-        for c in line:
-            if c in diacritization_stripping_data.strip_diacritization_uninames:
-                output += diacritization_stripping_data.strip_diacritization_uninames[c]
-            else:
-                output += c
+        yield line.translate(strip_diacritics_table)
 
-        yield output
 
 def strip_diacritics_single_line(textline):
-    output = ""
-    for c in textline:
-        if c in diacritization_stripping_data.strip_diacritization_uninames:
-            output += diacritization_stripping_data.strip_diacritization_uninames[c]
-        else:
-           output += c
-
-    return output
+    return textline.translate(_get_strip_diacritics_table())
@@ -1,7 +1,6 @@
 from collections import Counter
 
 import numpy as np
-from aspects import apply_m2_edits
 from aspects import utils
 from aspects.base import Aspect
 
@@ -10,7 +9,7 @@ from aspects.base import Aspect
 # TODO ted ignoruju next_token_change_casing
 
 class Punctuation(Aspect):
-    def __init__(self, profile, lang, alpha=1, beta=0):
+    def __init__(self, profile, lang, alpha=1, beta=0, prepared=None):
         super(Punctuation, self).__init__(profile, alpha, beta)
 
         punct_errors_aggregated_probs = profile['punctuation']['punct_errors_aggregated_probs']
@@ -29,8 +28,7 @@ class Punctuation(Aspect):
         for k in punct_errors_detailed_probs:
             self.punct_errors_detailed_probs[k] = {}
 
-            self.punct_errors_detailed_probs[k]['I'] = utils._apply_smoothing_on_simple_dict(punct_errors_detailed_probs[k]['I'],
-                                                                                              alpha, beta)
+            self.punct_errors_detailed_probs[k]['I'] = utils._build_sampling_table(punct_errors_detailed_probs[k]['I'], alpha, beta)
             self.punct_errors_detailed_probs[k]['D'] = {}
             for kk in punct_errors_detailed_probs[k]['D']:
                 self.punct_errors_detailed_probs[k]['D'][kk] = \
@@ -38,8 +36,8 @@ class Punctuation(Aspect):
 
             self.punct_errors_detailed_probs[k]['S'] = {}
             for kk in punct_errors_detailed_probs[k]['S']:
-                self.punct_errors_detailed_probs[k]['S'][kk] = utils._apply_smoothing_on_simple_dict(
-                    punct_errors_detailed_probs[k]['S'][kk], alpha, beta)
+                self.punct_errors_detailed_probs[k]['S'][kk] = utils._build_sampling_table(punct_errors_detailed_probs[k]['S'][kk],
+                                                                                           alpha, beta)
 
         self.final_punctuation_marks = ['.', '!', '?'] + ["\"", "„"]
 
@@ -66,16 +64,15 @@ class Punctuation(Aspect):
                 applicability_place = 'middle'
 
             # Insert
-            if np.random.uniform(0, 1) < self.punct_errors_aggregated_probs[applicability_place]['I']:
+            if utils.trigger(self.punct_errors_aggregated_probs[applicability_place]['I']):
                 # select one of punctuation-tokens according to its distribution
-                punct_token = np.random.choice(list(self.punct_errors_detailed_probs[applicability_place]['I'].keys()),
-                                               p=list(self.punct_errors_detailed_probs[applicability_place]['I'].values()))
+                punct_token = self.punct_errors_detailed_probs[applicability_place]['I'].sample()
 
                 punct_token = punct_token.replace(" ", "")
 
                 # do not insert anything before the first token (and do not insert anything after the last token)
                 if (token_ind == 0 and num_tokens_in_original_text > 1) or (
-                            (token_ind != num_tokens_in_original_text - 1) and np.random.uniform(0, 1) < 0.5):
+                            (token_ind != num_tokens_in_original_text - 1) and utils.uniform() < 0.5):
                     new_text[
                         token_ind] = token + " " + punct_token
 
@@ -109,8 +106,8 @@ class Punctuation(Aspect):
                 changes.append(['PUNCT', 'insert {} around {}'.format(punct_token, token)])
 
             # Delete
-            elif delete_applicable and token in self.punct_errors_detailed_probs[applicability_place]['D'] and np.random.uniform(0, 1) < \
-                    self.punct_errors_detailed_probs[applicability_place]['D'][token]:
+            elif delete_applicable and token in self.punct_errors_detailed_probs[applicability_place]['D'] and utils.trigger(
+                    self.punct_errors_detailed_probs[applicability_place]['D'][token]):
                 # if we are about to delete a "final-punctuation" token, we need to lower-case the following letter
                 if token in self.final_punctuation_marks and token_ind < num_tokens_in_original_text - 1:
                     new_text[token_ind + 1] = new_text[token_ind + 1][0].lower() + new_text[token_ind + 1][1:]
@@ -128,10 +125,9 @@ class Punctuation(Aspect):
                      'delete {} around {}'.format(token, " ".join(original_text_splitted_into_tokens[token_ind - 4: token_ind + 4]))])
 
             # Substitute
-            elif token in self.punct_errors_detailed_probs[applicability_place]['S'] and np.random.uniform(0, 1) < \
-                    self.punct_errors_aggregated_probs[applicability_place]['S'][token]:
-                replace_token = np.random.choice(list(self.punct_errors_detailed_probs[applicability_place]['S'][token].keys()),
-                                                 p=list(self.punct_errors_detailed_probs[applicability_place]['S'][token].values()))
+            elif token in self.punct_errors_detailed_probs[applicability_place]['S'] and utils.trigger(
+                    self.punct_errors_aggregated_probs[applicability_place]['S'][token]):
+                replace_token = self.punct_errors_detailed_probs[applicability_place]['S'][token].sample()
 
                 new_text[token_ind] = replace_token
 
@@ -161,66 +157,7 @@ class Punctuation(Aspect):
         return " ".join([x for x in new_text if x]), changes, whitespace_info  # ignore empty (deleted) tokens
 
     @staticmethod
-    def _get_punctuation_probabilities(punct_errors, coder_dicts):
-        punct_errors_chars_only = {}
-        for applicability_place, v in punct_errors.items():
-            punct_errors_chars_only[applicability_place] = {}
-            for op_type, v1 in punct_errors[applicability_place].items():
-                if op_type == 'I' or op_type == 'D':
-                    punct_errors_chars_only[applicability_place][op_type] = Counter(list(map(lambda x: x[0], v1)))
-                else:  # S
-                    punct_errors_chars_only[applicability_place][op_type] = {}
-                    for tok in v1:
-                        token_from, token_to = tok[0].split('SEPARATOR')
-                        if token_from not in punct_errors_chars_only[applicability_place][op_type]:
-                            punct_errors_chars_only[applicability_place][op_type][token_from] = Counter()
-
-                        punct_errors_chars_only[applicability_place][op_type][token_from][token_to] += 1
-
-        # # verbose dump
-        # for applicability_place, v in punct_errors.items():
-        #     print(applicability_place)
-        #     for op_type, v1 in punct_errors[applicability_place].items():
-        #         print(op_type)
-        #         if op_type == 'I' or op_type == 'D':
-        #             for k, v in punct_errors_chars_only[applicability_place][op_type].most_common():
-        #                 print(k, v)
-        #         else:
-        #             for token_from in punct_errors_chars_only[applicability_place][op_type]:
-        #                 print(token_from)
-        #                 for k,v in punct_errors_chars_only[applicability_place][op_type][token_from].most_common():
-        #                     print("   -> {} {}".format(k,v))
-
-
-        num_applicable = {
-            'eos': {
-                'I': 0,  # num_para
-                'D': {},
-                'S': {}
-            },
-            'middle': {
-                'I': 0,  # num_tokens - 1 (last one is separated)
-                'D': {},
-                'S': {}
-            },
-        }
-
-        for coder_dict in coder_dicts:  # coder dict for each corrected sentence (paragraph)
-            if coder_dict:
-                coder_id = list(coder_dict.keys())[0]
-                cor_sent = coder_dict[coder_id][0]
-
-                num_applicable['eos']['I'] += 1
-                num_applicable['middle']['I'] += len(cor_sent) - 1  # -1 as we do not apply it on the last token
-
-                for tok in cor_sent:
-                    for applicability_place in punct_errors_chars_only:  # for each applicability type
-                        for op_type in ['S', 'D']:
-                            if tok in punct_errors_chars_only[applicability_place][op_type]:
-                                if tok not in num_applicable[applicability_place][op_type]:
-                                    num_applicable[applicability_place][op_type][tok] = 0
-
-                                num_applicable[applicability_place][op_type][tok] += 1
+    def _get_punctuation_probabilities(punct_errors_chars_only, num_applicable):
 
         # create detailed (up to [applicability_place][op_type][token_from][token_to]) probability dictionary
         punct_errors_detailed_probs = {}
@@ -242,15 +179,14 @@ class Punctuation(Aspect):
                                                                                      tok] / \
                                                                                  num_applicable[applicability_place][op_type][tok]
             op_type = 'S'
-            for tok in punct_errors[applicability_place][op_type]:
-                token_from, token_to = tok[0].split('SEPARATOR')
-                if token_from not in punct_errors_detailed_probs[applicability_place][op_type]:
-                    punct_errors_detailed_probs[applicability_place][op_type][token_from] = {}
+            for token_from in punct_errors_chars_only[applicability_place][op_type]:
+                punct_errors_detailed_probs[applicability_place][op_type][token_from] = {}
 
                 if token_from in num_applicable[applicability_place][op_type]:
-                    punct_errors_detailed_probs[applicability_place][op_type][token_from][token_to] = \
-                        punct_errors_chars_only[applicability_place][op_type][token_from][token_to] / \
-                        num_applicable[applicability_place][op_type][token_from]
+                    for token_to in punct_errors_chars_only[applicability_place][op_type][token_from]:
+                        punct_errors_detailed_probs[applicability_place][op_type][token_from][token_to] = \
+                            punct_errors_chars_only[applicability_place][op_type][token_from][token_to] / \
+                            num_applicable[applicability_place][op_type][token_from]
 
         # create shallow (up to [applicability_place][op_type]) probability dictionary
         punct_errors_aggregated_probs = {}
@@ -284,7 +220,7 @@ class Punctuation(Aspect):
         final_punctuation_marks = ['.', '!', '?']
         quotation_marks = ["\"", "„"]
 
-        orig_start, orig_end, error_type, cor_tok, cor_start, cor_end = edit
+        orig_start, orig_end, cor_tok = edit.orig_start, edit.orig_end, edit.cor_tok
 
         if orig_start == orig_end:
             op_type = 'I'
@@ -296,7 +232,7 @@ class Punctuation(Aspect):
             char = cor_tok
             next_token_change_casing = False
 
-        elif cor_start == cor_end:
+        elif edit.cor_start == edit.cor_end:
             op_type = 'D'
             char = " ".join(orig[orig_start:orig_end])
             next_token_change_casing = False
@@ -349,7 +285,7 @@ class Punctuation(Aspect):
                     char = orig[orig_start] + "SEPARATOR" + cor_tok.split()[0]
                     next_token_change_casing = True
                 # In all other cases, we cannot be more specific, but for the sake of simplicity, we allow only 1:1 punctuation substititions
-                elif orig_end - orig_start == 1 and cor_end - cor_start == 1:
+                elif orig_end - orig_start == 1 and edit.cor_end - edit.cor_start == 1:
                     char = orig[orig_start] + "SEPARATOR" + cor_tok
                     next_token_change_casing = False
                 else:
@@ -370,55 +306,89 @@ class Punctuation(Aspect):
         return op_type, char, next_token_change_casing
 
     @staticmethod
-    def estimate_probabilities(m2_records):
+    def accumulate(m2_records):
         '''
-            We differentiate between punctuation errors on the end of the text and in the middle of the text.
+            We differentiate between punctuation errors on the end of the text and in the middle of the text. Errors are counted per
+            character (substitutions per pair of characters), together with the counts of all tokens of the corrected sentences, from which
+            the numbers of places where the errors are applicable are computed.
             '''
-        punct_errors = {
+        punct_errors_chars_only = {
             'eos': {
-                'I': [],
-                'D': [],
-                'S': []
+                'I': {},
+                'D': {},
+                'S': {}
             },
             'middle': {
-                'I': [],
-                'D': [],
-                'S': []
+                'I': {},
+                'D': {},
+                'S': {}
             },
         }
 
         num_files = 0  # where eos is applicable
         num_tokens = 0  # where middle is applicable
-
-        cached_edits = []
+        cor_tokens_counter = Counter()
 
         for m2_file in m2_records:
-            for info in m2_file:
-                orig_sent, coder_dict = apply_m2_edits.processM2(info, [])
+            for sentence in m2_file:
 
-                cached_edits.append(coder_dict)
-
-                if coder_dict:
+                if sentence.coders:
                     num_files += 1
-                    coder_id = list(coder_dict.keys())[0]
-                    cor_sent = coder_dict[coder_id][0]
-                    num_tokens += len(cor_sent)
-
-                    for edit in coder_dict[coder_id][1]:
-                        orig_start, orig_end, error_type, cor_tok, cor_start, cor_end = edit
+                    num_tokens += len(sentence.cor)
+                    cor_tokens_counter.update(sentence.cor)
 
-                        if 'PUNCT' in error_type:
-                            if cor_end >= len(cor_sent):
+                    for edit in sentence.edits:
+                        if 'PUNCT' in edit.error_type:
+                            if edit.cor_end >= len(sentence.cor):
                                 applicability_place = 'eos'
                             else:
                                 applicability_place = 'middle'
 
-                            op_type, char, next_token_change_casing = Punctuation._get_operation_type_and_char(edit, orig_sent)
+                            op_type, char, next_token_change_casing = Punctuation._get_operation_type_and_char(edit, sentence.orig)
+
+                            # TODO next_token_change_casing is not used in noising yet, so it is not counted
+                            if op_type == 'I' or op_type == 'D':
+                                chars_counts = punct_errors_chars_only[applicability_place][op_type]
+                            elif op_type == 'S':
+                                token_from, char = char.split('SEPARATOR')
+                                chars_counts = punct_errors_chars_only[applicability_place][op_type].setdefault(token_from, {})
+                            else:
+                                continue
+
+                            chars_counts[char] = chars_counts.get(char, 0) + 1
 
-                            if op_type:
-                                punct_errors[applicability_place][op_type].append([char, next_token_change_casing])
+        return {
+            'punct_errors_chars_only': punct_errors_chars_only,
+            'num_files': num_files,
+            'num_tokens': num_tokens,
+            'cor_tokens_counter': dict(cor_tokens_counter)
+        }
+
+    @staticmethod
+    def finalize(counts):
+        punct_errors_chars_only = counts['punct_errors_chars_only']
+        cor_tokens_counter = counts['cor_tokens_counter']
+
+        num_applicable = {
+            'eos': {
+                'I': counts['num_files'],  # num_para
+                'D': {},
+                'S': {}
+            },
+            'middle': {
+                'I': counts['num_tokens'] - counts['num_files'],  # num_tokens - 1 (last one is separated) for each paragraph
+                'D': {},
+                'S': {}
+            },
+        }
+        for applicability_place in punct_errors_chars_only:  # for each applicability type
+            for op_type in ['S', 'D']:
+                for tok in punct_errors_chars_only[applicability_place][op_type]:
+                    if tok in cor_tokens_counter:
+                        num_applicable[applicability_place][op_type][tok] = cor_tokens_counter[tok]
 
-        punct_errors_aggregated_probs, punct_errors_detailed_probs = Punctuation._get_punctuation_probabilities(punct_errors, cached_edits)
+        punct_errors_aggregated_probs, punct_errors_detailed_probs = Punctuation._get_punctuation_probabilities(punct_errors_chars_only,
+                                                                                                                num_applicable)
 
         return 'punctuation', {
             'punct_errors_aggregated_probs': punct_errors_aggregated_probs,
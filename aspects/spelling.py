@@ -1,16 +1,122 @@
+import json
+import multiprocessing.util
+import os
+import sqlite3
 import string
-from collections import Counter
+from collections import Counter, OrderedDict
 from difflib import SequenceMatcher
 
-import aspell
 import numpy as np
-from aspects import apply_m2_edits, utils
+from aspects import utils
+from aspects.confusion_sets import ConfusionSets
 from aspects.base import Aspect
-from aspects.utils import get_cheapest_align_seq
+from aspects.utils import get_cheapest_align_seqs
+
+# number of top Aspell suggestions a word may be replaced with
+NUM_TOP_SUGGESTIONS = 10
+
+# number of newly suggested words that are collected before they are added to the persistent suggestions store in one transaction
+STORE_BATCH_SIZE = 1000
+
+
+def get_aspell_dictionary_version(speller):
+    '''
+    Aspell does not expose version of its dictionaries, so the dictionary is identified by path, size and modification time of its master
+    file.
+    '''
+    config = {key: value[2] for key, value in speller.ConfigKeys().items()}
+    master = os.path.join(str(config.get('dict-dir', '')), str(config.get('master', '')))
+    if os.path.exists(master):
+        return '{}:{}:{}'.format(master, os.path.getsize(master), int(os.path.getmtime(master)))
+
+    return master
+
+
+class SuggestionCache:
+    '''
+    Speller wrapper that keeps top suggestions of recently used words in a bounded LRU cache.
+
+    Optionally, suggestions are also kept in a persistent SQLite store (keyed by language and Aspell dictionary version), which may be
+    shared by several processes and runs. Words missing in the store are suggested by the speller and added to it in batches of
+    STORE_BATCH_SIZE words, the rest is added by close() (which is called when the process exits).
+    '''
+
+    def __init__(self, speller, lang, max_size=100000, store_file=None):
+        self.speller = speller
+        self.max_size = max_size
+        self.cache = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.store_hits = 0
+
+        self.store = None
+        self.store_pending = {}
+        if store_file is not None:
+            self.dictionary = '{}:{}'.format(lang, get_aspell_dictionary_version(speller))
+            self.store = sqlite3.connect(store_file, timeout=60)
+            self.store.execute('PRAGMA journal_mode=WAL')
+            self.store.execute('CREATE TABLE IF NOT EXISTS suggestions (dictionary TEXT, word TEXT, suggestions TEXT, '
+                               'PRIMARY KEY (dictionary, word))')
+            self.store.commit()
+
+            # run also at exit of multiprocessing workers, which skip atexit handlers
+            multiprocessing.util.Finalize(self, self.close, exitpriority=10)
+
+    def _suggest_uncached(self, word):
+        if self.store is not None:
+            row = self.store.execute('SELECT suggestions FROM suggestions WHERE dictionary = ? AND word = ?',
+                                     (self.dictionary, word)).fetchone()
+            if row is not None:
+                self.store_hits += 1
+                return json.loads(row[0])
+
+            if word in self.store_pending:
+                return json.loads(self.store_pending[word])
+
+        suggestions = self.speller.suggest(word)[:NUM_TOP_SUGGESTIONS]
+        if self.store is not None:
+            self.store_pending[word] = json.dumps(suggestions)
+            if len(self.store_pending) >= STORE_BATCH_SIZE:
+                self.flush_store()
+
+        return suggestions
+
+    def flush_store(self):
+        '''
+        Adds the suggestions not yet written to the persistent store.
+        '''
+        if self.store is None or not self.store_pending:
+            return
+
+        self.store.executemany('INSERT OR IGNORE INTO suggestions VALUES (?, ?, ?)',
+                               [(self.dictionary, word, suggestions) for word, suggestions in self.store_pending.items()])
+        self.store.commit()
+        self.store_pending = {}
+
+    def close(self):
+        if self.store is not None:
+            self.flush_store()
+            self.store.close()
+            self.store = None
+
+    def suggest(self, word):
+        if word in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(word)
+            return list(self.cache[word])
+
+        self.misses += 1
+        suggestions = tuple(self._suggest_uncached(word))
+        self.cache[word] = suggestions
+        if len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+        return list(suggestions)
 
 
 class Spelling(Aspect):
-    def __init__(self, profile, lang, alpha=1, beta=0):
+    def __init__(self, profile, lang, alpha=1, beta=0, aspell_speller=None, prepared=None):
         super(Spelling, self).__init__(profile, alpha, beta)
 
         spelling_word_to_invalid_word = profile['spelling']['spelling_word_to_invalid_word']
@@ -29,14 +135,22 @@ class Spelling(Aspect):
             self.spelling_noise_operation_detailed_probs['D'][char] = utils._apply_smoothing([char_delete_prob], alpha, beta)[0]
 
         for from_char, v in self.spelling_noise_operation_detailed_probs['S'].items():
-            self.spelling_noise_operation_detailed_probs['S'][from_char] = utils._apply_smoothing_on_simple_dict(v, alpha,
-                                                                                                                 beta)
+            self.spelling_noise_operation_detailed_probs['S'][from_char] = utils._build_sampling_table(v, alpha, beta)
 
         for context, v in self.spelling_noise_operation_detailed_probs['I'].items():
-            self.spelling_noise_operation_detailed_probs['I'][context] = utils._apply_smoothing_on_simple_dict(v, alpha,
-                                                                                                               beta)
-
-        self.aspell_speller = aspell.Speller('lang', lang)
+            self.spelling_noise_operation_detailed_probs['I'][context] = utils._build_sampling_table(v, alpha, beta)
+
+        # distribution of operations used by the generalized (not character specific) spelling errors
+        no_op_prob = max(0, 1 - self.spelling_noise_operation_probs['S'] - self.spelling_noise_operation_probs['T'] -
+                         self.spelling_noise_operation_probs['I'] - self.spelling_noise_operation_probs['D'])
+        self.spelling_noise_operation_table = utils.SamplingTable(['0', 'S', 'T', 'T', 'D'],
+                                                                  [no_op_prob, self.spelling_noise_operation_probs['S'],
+                                                                   self.spelling_noise_operation_probs['T'],
+                                                                   self.spelling_noise_operation_probs['I'],
+                                                                   self.spelling_noise_operation_probs['D']])
+
+        # speller is costly to create, so it may be passed from outside and shared among several instances
+        self.aspell_speller = aspell_speller if aspell_speller is not None else Spelling.load_aspell_speller(lang)
         self.spelling_detailed_ratio = 0.3
 
         if lang == 'cs':
@@ -55,36 +169,53 @@ class Spelling(Aspect):
         else:
             self.all_chars_in_language = None
 
-    def apply(self, text, whitespace_info):
-
-        changes = []
+    @staticmethod
+    def load_aspell_speller(lang, suggestions_cache_size=100000, suggestions_store=None, confusion_sets_file=None):
+        '''
+        Aspell speller with cached suggestions, see SuggestionCache. If confusion sets file (see build_confusion_sets.py) is given,
+        suggestions are taken from it instead of a live Aspell speller.
+        '''
+        if confusion_sets_file is not None:
+            confusion_sets = ConfusionSets(confusion_sets_file)
+            if confusion_sets.lang != lang:
+                raise ValueError("Confusion sets {} were built for language {}, not {}".format(confusion_sets_file, confusion_sets.lang,
+                                                                                               lang))
+            return SuggestionCache(confusion_sets, lang, suggestions_cache_size)
+
+        # aspell is imported only when needed, so that it does not have to be installed when noising with confusion sets
+        import aspell
+        return SuggestionCache(aspell.Speller('lang', lang), lang, suggestions_cache_size, suggestions_store)
+
+    def _get_valid_suggestions(self, word):
+        top_aspell_suggestions = self.aspell_speller.suggest(word)[:NUM_TOP_SUGGESTIONS]
+
+        # for some Words, Aspell does not provide any alternative and it also sometimes provides "multi-token alternatives" (e.g "zažívacího" -> "zažívací ho")
+        return [suggestion for suggestion in top_aspell_suggestions if suggestion != word and suggestion.isalpha()]
+
+    def apply_sentence(self, sentence):
+        changes = sentence.changes
         new_text = []
-        all_alpha_chars_in_text_and_language = set([c for c in text if c.isalpha()])
+        # note that the characters are sorted whenever sampled from, so that the noising does not depend on hash randomization
+        all_alpha_chars_in_text_and_language = set([c for token in sentence.tokens for c in token if c.isalpha()])
         if self.all_chars_in_language:
             all_alpha_chars_in_text_and_language.update(self.all_chars_in_language)
 
-        for word in text.split():
+        for word in sentence.tokens:
             if not word.isalpha():
                 new_text.append(word)
                 continue
 
-            if np.random.uniform(0, 1) < self.spelling_word_to_other_valid_word:
-                top_aspell_suggestions = self.aspell_speller.suggest(word)[:10]
-
-                if word in top_aspell_suggestions:
-                    top_aspell_suggestions.remove(word)
-
-                # for some Words, Aspell does not provide any alternative and it also sometimes provides "multi-token alternatives" (e.g "zažívacího" -> "zažívací ho")
-                if len(top_aspell_suggestions) > 0 and any([x.isalpha() for x in top_aspell_suggestions]):
-                    chosen_suggestion = np.random.choice(top_aspell_suggestions)
-                    while not chosen_suggestion.isalpha():
-                        chosen_suggestion = np.random.choice(top_aspell_suggestions)
-
+            # Aspell is asked only when the word is to be replaced by another valid word (if it provides none, the word is kept)
+            if utils.trigger(self.spelling_word_to_other_valid_word):
+                valid_suggestions = self._get_valid_suggestions(word)
+                if valid_suggestions:
+                    chosen_suggestion = utils.choice(valid_suggestions)
                     new_text.append(chosen_suggestion)
                     changes.append(['SPELL', 'Aspell replace {} with {}'.format(word, chosen_suggestion)])
                 else:
+                    utils.cancel_trigger()
                     new_text.append(word)
-            elif np.random.uniform(0, 1) < self.spelling_word_to_invalid_word:
+            elif utils.trigger(self.spelling_word_to_invalid_word):
                 new_word = list(word)
 
                 detailed_spelling_applicable = False
@@ -92,8 +223,8 @@ class Spelling(Aspect):
                     detailed_spelling_applicable = True
                 elif len(word) == 1:
                     # we need to be sure that the substitute/delete probability is high enough (so that we do not cycle here too long)
-                    if new_word[0] in self.spelling_noise_operation_detailed_probs['S'] and np.sum(
-                            list(self.spelling_noise_operation_detailed_probs['S'][new_word[0]].values())) > 0.1:
+                    if new_word[0] in self.spelling_noise_operation_detailed_probs['S'] and \
+                                    self.spelling_noise_operation_detailed_probs['S'][new_word[0]].total > 0.1:
                         detailed_spelling_applicable = True
 
                     if new_word[0] in self.spelling_noise_operation_detailed_probs['D'] and \
@@ -101,7 +232,7 @@ class Spelling(Aspect):
                                         new_word[0]] > 0.1:
                         detailed_spelling_applicable = True
 
-                if detailed_spelling_applicable and np.random.uniform(0, 1) < 1 - self.spelling_detailed_ratio:
+                if detailed_spelling_applicable and utils.uniform() < 1 - self.spelling_detailed_ratio:
                     num_iterations_spent = 0
                     # we must ensure that once we select the word to noisy, it will be actually noised and not an empty world
                     while ''.join(new_word) == word or not ''.join(new_word).strip():
@@ -114,24 +245,18 @@ class Spelling(Aspect):
                         for i in range(len(new_word)):
                             # try substitute
                             if new_word[i] in self.spelling_noise_operation_detailed_probs['S'] \
-                                    and np.random.uniform(0, 1) < np.sum(
-                                        list(self.spelling_noise_operation_detailed_probs['S'][new_word[i]].values())):
+                                    and utils.uniform() < self.spelling_noise_operation_detailed_probs['S'][new_word[i]].total:
 
-                                substitute_probabilites = np.array(
-                                    list(self.spelling_noise_operation_detailed_probs['S'][new_word[i]].values()))
-                                substitute_probabilites_normalized = substitute_probabilites / np.sum(substitute_probabilites)
-
-                                new_word[i] = np.random.choice(list(self.spelling_noise_operation_detailed_probs['S'][new_word[i]].keys()),
-                                                               p=substitute_probabilites_normalized)
+                                new_word[i] = self.spelling_noise_operation_detailed_probs['S'][new_word[i]].sample()
                                 continue
                             # try delete
                             elif new_word[i] in self.spelling_noise_operation_detailed_probs['D'] \
-                                    and np.random.uniform(0, 1) < self.spelling_noise_operation_detailed_probs['D'][new_word[i]]:
+                                    and utils.uniform() < self.spelling_noise_operation_detailed_probs['D'][new_word[i]]:
 
                                 new_word[i] = ''
                                 continue
                             # try transpose
-                            elif i < len(word) - 1 and np.random.uniform(0, 1) < self.spelling_noise_operation_probs['T']:
+                            elif i < len(word) - 1 and utils.uniform() < self.spelling_noise_operation_probs['T']:
                                 temp = new_word[i]
                                 new_word[i] = new_word[i + 1]
                                 new_word[i + 1] = temp
@@ -143,14 +268,8 @@ class Spelling(Aspect):
                                 context = left_context + right_context
 
                                 if context in self.spelling_noise_operation_detailed_probs['I'] \
-                                        and np.random.uniform(0, 1) < np.sum(
-                                            list(self.spelling_noise_operation_detailed_probs['I'][context].values())):
-                                    insert_probabilites = np.array(
-                                        list(self.spelling_noise_operation_detailed_probs['I'][context].values()))
-                                    insert_probabilites_normalized = insert_probabilites / np.sum(insert_probabilites)
-
-                                    insert_char = np.random.choice(list(self.spelling_noise_operation_detailed_probs['I'][context].keys()),
-                                                                   p=insert_probabilites_normalized)
+                                        and utils.uniform() < self.spelling_noise_operation_detailed_probs['I'][context].total:
+                                    insert_char = self.spelling_noise_operation_detailed_probs['I'][context].sample()
                                     new_word[i] = insert_char + new_word[i]
                                 continue
 
@@ -167,18 +286,11 @@ class Spelling(Aspect):
                             break
 
                         for i in range(len(new_word)):
-
-                            no_op_prob = max(0, 1 - self.spelling_noise_operation_probs['S'] - self.spelling_noise_operation_probs['T'] - \
-                                             self.spelling_noise_operation_probs['I'] - self.spelling_noise_operation_probs['D'])
-                            op_type = np.random.choice(['0', 'S', 'T', 'T', 'D'],
-                                                       p=[no_op_prob, self.spelling_noise_operation_probs['S'],
-                                                          self.spelling_noise_operation_probs['T'],
-                                                          self.spelling_noise_operation_probs['I'],
-                                                          self.spelling_noise_operation_probs['D']])
+                            op_type = self.spelling_noise_operation_table.sample()
                             # substitute
                             if op_type == 'S':
                                 if all_alpha_chars_in_text_and_language.difference(word[i]):
-                                    new_word[i] = np.random.choice(list(all_alpha_chars_in_text_and_language.difference(word[i])))
+                                    new_word[i] = utils.choice(sorted(all_alpha_chars_in_text_and_language.difference(word[i])))
                                 continue
                             # transpose
                             elif op_type == 'T' and i < len(word) - 1:
@@ -188,12 +300,12 @@ class Spelling(Aspect):
                                 continue
                             # insert
                             elif op_type == 'I':
-                                if np.random.uniform(0, 1) < 0.5:  # insert to the left of the current char
-                                    new_word[i] = np.random.choice(list(all_alpha_chars_in_text_and_language.difference(word[i]))) + \
+                                if utils.uniform() < 0.5:  # insert to the left of the current char
+                                    new_word[i] = utils.choice(sorted(all_alpha_chars_in_text_and_language.difference(word[i]))) + \
                                                   new_word[i]
                                 else:
-                                    new_word[i] = new_word[i] + np.random.choice(
-                                        list(all_alpha_chars_in_text_and_language.difference(word[i])))
+                                    new_word[i] = new_word[i] + utils.choice(
+                                        sorted(all_alpha_chars_in_text_and_language.difference(word[i])))
                                 continue
                             # delete
                             elif op_type == 'D':
@@ -205,22 +317,23 @@ class Spelling(Aspect):
             else:
                 new_text.append(word)
 
-        return " ".join(new_text), changes, whitespace_info
+        sentence.tokens = new_text
 
     @staticmethod
-    def estimate_probabilities(m2_records):
-        num_files = 0
+    def accumulate(m2_records):
         num_spelling_incorrect_word = 0  # number of words that contain spelling error and the misspelled word is not a valid word
         num_spelling_valid_word = 0  # number of words that contain spelling error but the misspelled word is a valid word
 
         num_all_alpha_words = 0
 
+        # sums of ratios of operations to the length of corrected word, their means are computed in finalize
         spelling_noise_operation_distrib = {
-            'S': [],
-            'I': [],
-            'D': [],
-            'T': []
+            'S': 0,
+            'I': 0,
+            'D': 0,
+            'T': 0
         }
+        num_spelling_noise_operation_words = 0
 
         spelling_noise_operation_detailed = {
             'S': {},
@@ -231,19 +344,15 @@ class Spelling(Aspect):
         character_counter_in_corrected_spelling = Counter()
         twocharacter_counter_in_corrected_spelling = Counter()
 
-        cached_coder_dicts = []
         for m2_file in m2_records:
-            num_files += 1
+            spelling_original_words, spelling_corrected_words = [], []
 
-            for info in m2_file:
-                orig_sent, coder_dict = apply_m2_edits.processM2(info, [])
-                if coder_dict:
-                    coder_id = list(coder_dict.keys())[0]
-                    cor_sent = coder_dict[coder_id][0]
-
-                    for edit in coder_dict[coder_id][1]:
-                        orig_start, orig_end, error_type, cor_tok, cor_start, cor_end = edit
+            for sentence in m2_file:
+                orig_sent = sentence.orig
+                if sentence.coders:
+                    cor_sent = sentence.cor
 
+                    for edit in sentence.edits:
                         exclude_error_types = ['noop', 'DIACR', 'PUNCT', 'ORTH']
                         # print(orig_sent, orig_start)
                         # print(cor_sent, cor_start)
@@ -255,82 +364,20 @@ class Spelling(Aspect):
                         For the first type, we also estimate the noise in terms of number of bad insertions, deletions and transpositions.
 
                         '''
-                        if "SPELL" in error_type and "WO:SPELL" not in error_type:
+                        if "SPELL" in edit.error_type and "WO:SPELL" not in edit.error_type:
                             num_spelling_incorrect_word += 1
 
-                            cached_coder_dicts.append(coder_dict)
-
-                            # ! NOTE that it is important to calculate it from corrected to original (as we are gonna use it in this way)
-                            align_seq = get_cheapest_align_seq(" ".join(cor_sent[cor_start:cor_end]),
-                                                               " ".join(orig_sent[orig_start:orig_end]))
-
-                            # first fill in spelling_noise_operation (which only stores probabilities of substituting individual char, inserting ...)
-                            cor_len = len(" ".join(cor_sent[cor_start:cor_end]))
-
-                            num_substitute = sum([1 for x in align_seq if x[0] == 'S'])
-                            num_insert = sum([1 for x in align_seq if x[0] == 'I'])
-                            num_delete = sum([1 for x in align_seq if x[0] == 'D'])
-                            num_transpose = sum([1 for x in align_seq if x[0] == 'T'])
-
-                            spelling_noise_operation_distrib['S'].append(num_substitute / cor_len)
-                            spelling_noise_operation_distrib['I'].append(num_insert / cor_len)
-                            spelling_noise_operation_distrib['D'].append(num_delete / cor_len)
-                            spelling_noise_operation_distrib['T'].append(num_transpose / cor_len)
-
-                            # then fill in detailed occurence counts for substitute, insert and delete
-                            original_word = " ".join(orig_sent[orig_start:orig_end])
-                            corrected_word = " ".join(cor_sent[cor_start:cor_end])
-                            character_counter_in_corrected_spelling.update(corrected_word)
-                            twocharacter_counter_in_corrected_spelling.update(
-                                [corrected_word[i] + corrected_word[i + 1] for i in range(len(corrected_word) - 1)])
-                            twocharacter_counter_in_corrected_spelling.update(['^' + corrected_word[0], corrected_word[-1] + '$'])
-
-                            for operation in align_seq:
-                                op_type, cor_start, cor_end, orig_start, orig_end = operation
+                            original_word = " ".join(orig_sent[edit.orig_start:edit.orig_end])
+                            corrected_word = " ".join(cor_sent[edit.cor_start:edit.cor_end])
 
-                                if op_type == 'S':
-                                    cor_char = corrected_word[cor_start]
-                                    orig_char = original_word[orig_start]
+                            # the words are aligned all at once after counting the file
+                            spelling_original_words.append(original_word)
+                            spelling_corrected_words.append(corrected_word)
 
-                                    if cor_char not in spelling_noise_operation_detailed['S']:
-                                        spelling_noise_operation_detailed['S'][cor_char] = {}
-
-                                    if orig_char not in spelling_noise_operation_detailed['S'][cor_char]:
-                                        spelling_noise_operation_detailed['S'][cor_char][orig_char] = 0
-
-                                    spelling_noise_operation_detailed['S'][cor_char][orig_char] += 1
-                                elif op_type == 'I':
-                                    left_context = "^" if cor_start == 0 else corrected_word[cor_start - 1]
-                                    right_context = "$" if cor_start >= cor_len else corrected_word[cor_start]
-
-                                    insert_into_tuple = left_context + right_context
-                                    if insert_into_tuple not in spelling_noise_operation_detailed['I']:
-                                        spelling_noise_operation_detailed['I'][insert_into_tuple] = {}
-
-                                    insert_char = original_word[orig_start]
-
-                                    if insert_char not in spelling_noise_operation_detailed['I'][insert_into_tuple]:
-                                        spelling_noise_operation_detailed['I'][insert_into_tuple][insert_char] = 0
-
-                                    spelling_noise_operation_detailed['I'][insert_into_tuple][insert_char] += 1
-                                elif op_type == 'D':
-                                    delete_char = corrected_word[cor_start]
-
-                                    if delete_char not in spelling_noise_operation_detailed['D']:
-                                        spelling_noise_operation_detailed['D'][delete_char] = 0
-
-                                    spelling_noise_operation_detailed['D'][delete_char] += 1
-
-                                    # # non alpha edits
-                                    # if not " ".join(cor_sent[cor_start:cor_end]).isalpha():
-                                    #     print('not alpha cor', edit)
-                                    #
-                                    # if not " ".join(orig_sent[orig_start:orig_end]).isalpha():
-                                    #     print('not alpha orig', edit)
-
-                        elif all([x not in error_type for x in exclude_error_types]) and \
-                                        orig_start == orig_end - 1 and orig_start < len(orig_sent) and cor_start == cor_end - 1 and \
-                                        SequenceMatcher(None, orig_sent[orig_start], cor_sent[cor_start]).ratio() > 0.5:
+                        elif all([x not in edit.error_type for x in exclude_error_types]) and \
+                                        edit.orig_start == edit.orig_end - 1 and edit.orig_start < len(orig_sent) and \
+                                        edit.cor_start == edit.cor_end - 1 and \
+                                        SequenceMatcher(None, orig_sent[edit.orig_start], cor_sent[edit.cor_start]).ratio() > 0.5:
                             num_spelling_valid_word += 1
                             # print(orig_sent[orig_start], cor_sent[cor_start])
 
@@ -345,15 +392,100 @@ class Spelling(Aspect):
 
                 num_all_alpha_words += sum([1 for x in orig_sent if x.isalpha()])
 
+            # ! NOTE that it is important to calculate it from corrected to original (as we are gonna use it in this way)
+            align_seqs = get_cheapest_align_seqs(spelling_corrected_words, spelling_original_words)
+            for original_word, corrected_word, align_seq in zip(spelling_original_words, spelling_corrected_words, align_seqs):
+                # first fill in spelling_noise_operation (which only stores probabilities of substituting individual char, inserting ...)
+                cor_len = len(corrected_word)
+
+                num_substitute = sum([1 for x in align_seq if x[0] == 'S'])
+                num_insert = sum([1 for x in align_seq if x[0] == 'I'])
+                num_delete = sum([1 for x in align_seq if x[0] == 'D'])
+                num_transpose = sum([1 for x in align_seq if x[0] == 'T'])
+
+                spelling_noise_operation_distrib['S'] += num_substitute / cor_len
+                spelling_noise_operation_distrib['I'] += num_insert / cor_len
+                spelling_noise_operation_distrib['D'] += num_delete / cor_len
+                spelling_noise_operation_distrib['T'] += num_transpose / cor_len
+                num_spelling_noise_operation_words += 1
+
+                # then fill in detailed occurence counts for substitute, insert and delete
+                character_counter_in_corrected_spelling.update(corrected_word)
+                twocharacter_counter_in_corrected_spelling.update(
+                    [corrected_word[i] + corrected_word[i + 1] for i in range(len(corrected_word) - 1)])
+                twocharacter_counter_in_corrected_spelling.update(['^' + corrected_word[0], corrected_word[-1] + '$'])
+
+                for operation in align_seq:
+                    op_type, cor_start, cor_end, orig_start, orig_end = operation
+
+                    if op_type == 'S':
+                        cor_char = corrected_word[cor_start]
+                        orig_char = original_word[orig_start]
+
+                        if cor_char not in spelling_noise_operation_detailed['S']:
+                            spelling_noise_operation_detailed['S'][cor_char] = {}
+
+                        if orig_char not in spelling_noise_operation_detailed['S'][cor_char]:
+                            spelling_noise_operation_detailed['S'][cor_char][orig_char] = 0
+
+                        spelling_noise_operation_detailed['S'][cor_char][orig_char] += 1
+                    elif op_type == 'I':
+                        left_context = "^" if cor_start == 0 else corrected_word[cor_start - 1]
+                        right_context = "$" if cor_start >= cor_len else corrected_word[cor_start]
+
+                        insert_into_tuple = left_context + right_context
+                        if insert_into_tuple not in spelling_noise_operation_detailed['I']:
+                            spelling_noise_operation_detailed['I'][insert_into_tuple] = {}
+
+                        insert_char = original_word[orig_start]
+
+                        if insert_char not in spelling_noise_operation_detailed['I'][insert_into_tuple]:
+                            spelling_noise_operation_detailed['I'][insert_into_tuple][insert_char] = 0
+
+                        spelling_noise_operation_detailed['I'][insert_into_tuple][insert_char] += 1
+                    elif op_type == 'D':
+                        delete_char = corrected_word[cor_start]
+
+                        if delete_char not in spelling_noise_operation_detailed['D']:
+                            spelling_noise_operation_detailed['D'][delete_char] = 0
+
+                        spelling_noise_operation_detailed['D'][delete_char] += 1
+
+                        # # non alpha edits
+                        # if not " ".join(cor_sent[cor_start:cor_end]).isalpha():
+                        #     print('not alpha cor', edit)
+                        #
+                        # if not " ".join(orig_sent[orig_start:orig_end]).isalpha():
+                        #     print('not alpha orig', edit)
+
+        return {
+            'num_spelling_incorrect_word': num_spelling_incorrect_word,
+            'num_spelling_valid_word': num_spelling_valid_word,
+            'num_all_alpha_words': num_all_alpha_words,
+            'spelling_noise_operation_distrib': spelling_noise_operation_distrib,
+            'num_spelling_noise_operation_words': num_spelling_noise_operation_words,
+            'spelling_noise_operation_detailed': spelling_noise_operation_detailed,
+            'character_counter_in_corrected_spelling': dict(character_counter_in_corrected_spelling),
+            'twocharacter_counter_in_corrected_spelling': dict(twocharacter_counter_in_corrected_spelling)
+        }
+
+    @staticmethod
+    def finalize(counts):
+        num_all_alpha_words = counts['num_all_alpha_words']
+        num_spelling_noise_operation_words = counts['num_spelling_noise_operation_words']
+        spelling_noise_operation_detailed = counts['spelling_noise_operation_detailed']
+        character_counter_in_corrected_spelling = Counter(counts['character_counter_in_corrected_spelling'])
+        twocharacter_counter_in_corrected_spelling = Counter(counts['twocharacter_counter_in_corrected_spelling'])
+
         # normalization to probabilities for word_to_other_valid_word and word_to_invalid_word
-        spelling_word_to_other_valid_word = num_spelling_valid_word / num_all_alpha_words
-        spelling_word_to_invalid_word = num_spelling_incorrect_word / num_all_alpha_words
+        spelling_word_to_other_valid_word = counts['num_spelling_valid_word'] / num_all_alpha_words
+        spelling_word_to_invalid_word = counts['num_spelling_incorrect_word'] / num_all_alpha_words
 
         # normalization to probabilities for aggregated spelling noise operations
         spelling_noise_operation_probs = {}
 
-        for k, v in spelling_noise_operation_distrib.items():
-            spelling_noise_operation_probs[k] = np.mean(v)
+        for k, v in counts['spelling_noise_operation_distrib'].items():
+            spelling_noise_operation_probs[k] = v / num_spelling_noise_operation_words if num_spelling_noise_operation_words else np.nan
 
         # normalization to probabilities for detailed spelling noise operations
         spelling_noise_operation_detailed_probs = {
@@ -1,96 +1,257 @@
+import itertools
+
 import numpy as np
 
-from aspects import apply_m2_edits
 from aspects.base import Aspect
-from aspects import utils
+from aspects import apply_m2_edits, utils
+
+
+def _build_xfix_index(xfix_table, xfix_occurence_counts):
+    '''
+    Build trie of all xfixes in xfix_table (suffix table, or prefix table storing reversed prefixes), walked from the end of a word.
+
+    All xfixes of a word present in the table lie on a single path of the trie, so the candidate xfixes of a word (and their probabilities)
+    are given by the deepest table node reached by the walk. The index does not depend on alpha and beta, so it is built once per profile
+    and shared by the aspects of all alphas, which smooth the probabilities (see _smooth_xfix_change and _smooth_xfix_rewrites).
+    :return: dict with
+        'trie': list of trie nodes, each is a dict mapping char to the index of child node (root is 0)
+        'node_xfixes': for each trie node its xfix, or None if the xfix is not in xfix_table
+        'candidates': for each xfix with an applicable candidate, all xfixes of the table that are its suffixes (longest first)
+        'candidate_probs': for each xfix in candidates, probabilities of applying its candidates estimated from data
+        'rewrites': for each xfix, pair of list of what to rewrite it into and list of their probabilities
+    '''
+    trie = [{}]
+    node_xfixes = [None]
+    for xfix in xfix_table:
+        node = 0
+        for c in reversed(xfix):
+            if c not in trie[node]:
+                trie[node][c] = len(trie)
+                trie.append({})
+                node_xfixes.append(None)
+            node = trie[node][c]
+        node_xfixes[node] = xfix
+
+    # each rewrite that continues with the same char as the longer xfix is counted also for shorter xfixes, see _update_xfix_table
+    sum_rewrites = {xfix: np.sum(list(xfix_table[xfix].values())) for xfix in xfix_table}
+    sum_rewrites_that_go_on = {xfix: sum(count for rewrite, count in xfix_table[xfix].items() if xfix and rewrite[:1] == xfix[0]) for xfix
+                               in xfix_table}
+
+    candidates, candidate_probs = {}, {}
+    for xfix in xfix_table:
+        found_xfixes = [xfix[i:] for i in range(len(xfix)) if xfix[i:] in xfix_table] + ([''] if '' in xfix_table else [])
+
+        found_xfixes_probs = []
+        last_match_sum_rewrites_that_go_on = 0
+        last_match_sum_applicable = 0
+        for found_xfix in found_xfixes:
+            sum_rewrites_in_data = sum_rewrites[found_xfix] - last_match_sum_rewrites_that_go_on
+            sum_applicable_in_data = xfix_occurence_counts[found_xfix] - last_match_sum_applicable
+
+            last_match_sum_rewrites_that_go_on = sum_rewrites_that_go_on[found_xfix]
+            last_match_sum_applicable = sum_applicable_in_data
+
+            if sum_applicable_in_data == 0:
+                found_xfixes_probs.append(0)
+            else:
+                found_xfixes_probs.append(sum_rewrites_in_data / sum_applicable_in_data)
+
+        if np.sum(found_xfixes_probs) <= 0:  # no edit is applicable
+            continue
+
+        candidates[xfix] = found_xfixes
+        candidate_probs[xfix] = np.array(found_xfixes_probs, dtype=np.float64).tolist()
+
+    rewrites = {xfix: (list(xfix_table[xfix].keys()), (np.array(list(xfix_table[xfix].values())) / sum_rewrites[xfix]).tolist()) for xfix
+                in xfix_table}
+
+    # candidate probabilities of all xfixes (padded by zeros), so that their changes are smoothed for each alpha at once
+    num_candidates = [len(candidate_probs[xfix]) for xfix in candidates]
+    candidate_probs_matrix = np.zeros((len(candidates), max(num_candidates, default=0)))
+    for i, xfix in enumerate(candidates):
+        candidate_probs_matrix[i, :num_candidates[i]] = candidate_probs[xfix]
+
+    return {
+        'trie': trie,
+        'node_xfixes': node_xfixes,
+        'candidates': candidates,
+        'candidate_probs': candidate_probs,
+        'candidate_rows': {xfix: i for i, xfix in enumerate(candidates)},
+        'num_candidates': num_candidates,
+        'candidate_probs_matrix': candidate_probs_matrix,
+        'candidate_probs_sums': _sum_rows(candidate_probs_matrix, num_candidates),
+        'rewrites': rewrites
+    }
+
+
+def _sum_rows(matrix, lengths):
+    '''
+    Sum the first lengths[i] values of each row i of matrix, the sums are the same as computed by np.sum for each row alone (which sums
+    fewer than 8 values one by one and more values pairwise), the rest of each row must be zeros.
+    '''
+    sums = matrix[:, 0].copy() if matrix.shape[1] else np.zeros(len(matrix))
+    for column in range(1, matrix.shape[1]):
+        sums += matrix[:, column]
+    for i in np.flatnonzero(np.asarray(lengths) >= 8).tolist():
+        sums[i] = np.sum(matrix[i, :lengths[i]])
+    return sums
+
+
+def _smooth_xfix_change_probs(xfix_index, alpha, beta):
+    '''
+    Smooth the probabilities of changing a word whose deepest xfix is the given one for all xfixes at once, returns list of the
+    probabilities for xfixes in candidate_rows of the index (the same as computed by _smooth_xfix_change for each xfix alone, 0 if the word
+    is never changed).
+    '''
+    candidate_probs = xfix_index['candidate_probs_matrix']
+    num_candidates = np.array(xfix_index['num_candidates'], dtype=np.int64)
+    is_candidate = np.arange(candidate_probs.shape[1]) < num_candidates[:, None]
+
+    def smooth(probs, probs_sums):
+        # _apply_smoothing of each row
+        smoothed_probs = probs * (1 - beta) + beta * (probs_sums / num_candidates)[:, None]
+        multiplication_factors = np.minimum(alpha, 1 / (probs_sums + 1e-6))
+        is_distribution = np.abs(probs_sums - 1.) <= 1e-08 + 1e-05
+        return np.where(is_distribution[:, None], smoothed_probs, smoothed_probs * multiplication_factors[:, None])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        normalized_probs = candidate_probs / xfix_index['candidate_probs_sums'][:, None]
+        normalized_probs_smoothed = smooth(normalized_probs, _sum_rows(normalized_probs, num_candidates))
+        choice_probs = np.where(is_candidate, np.maximum(normalized_probs_smoothed, 0), 0)
+        choice_probs_sums = _sum_rows(choice_probs, num_candidates)
+        choice_probs = choice_probs / choice_probs_sums[:, None]
+
+        candidate_probs_smoothed = smooth(candidate_probs, xfix_index['candidate_probs_sums'])
+        apply_probs = np.clip(utils._apply_smoothing_to_each(candidate_probs_smoothed, alpha, beta), 0, 1)
+        change_probs = _sum_rows(np.where(is_candidate, choice_probs * apply_probs, 0), num_candidates)
+
+    return np.where((choice_probs_sums > 0) & (change_probs > 0), change_probs, 0.).tolist()
+
+
+def _smooth_xfix_change(xfix_index, xfix, alpha, beta):
+    '''
+    Smooth the probabilities of the candidates of xfix, returns pair of the probability of changing a word whose deepest xfix is xfix and
+    SamplingTable for selecting index of the applied candidate (given that one is applied), or None if the word is never changed.
+    '''
+    found_xfixes_probs = np.array(xfix_index['candidate_probs'][xfix])
+
+    # select xfix (according to probability distribution), negative probabilities (caused by filtering of rare rewrites) are ignored
+    found_xfixes_probs_normalized_smoothed = utils._apply_smoothing(found_xfixes_probs / np.sum(found_xfixes_probs), alpha, beta)
+    choice_probs = np.maximum(found_xfixes_probs_normalized_smoothed, 0)
+    if np.sum(choice_probs) <= 0:
+        return None
+    choice_probs = choice_probs / np.sum(choice_probs)
+
+    # probability of applying the selected xfix
+    found_xfixes_probs_smoothed = utils._apply_smoothing(found_xfixes_probs, alpha, beta)
+    apply_probs = np.clip(utils._apply_smoothing_to_each(found_xfixes_probs_smoothed, alpha, beta), 0, 1)
+
+    # selecting a candidate and then tossing a coin for it is merged into a single decision whether to change the word, followed by
+    # selecting the applied candidate, so that the change is a single trigger
+    change_prob = float(np.sum(choice_probs * apply_probs))
+    if change_prob <= 0:
+        return None
+
+    return change_prob, utils.SamplingTable(range(len(found_xfixes_probs)), choice_probs * apply_probs)
+
+
+def _smooth_xfix_rewrites(xfix_index, xfix, alpha, beta):
+    '''
+    SamplingTable of what to rewrite xfix into.
+    '''
+    rewrite_into, rewrite_into_probs = xfix_index['rewrites'][xfix]
+    return utils.SamplingTable(rewrite_into, utils._apply_smoothing(np.array(rewrite_into_probs), alpha, beta))
 
 
 class SuffixPrefix(Aspect):
-    def __init__(self, profile, lang, alpha=1, beta=0):
+    def __init__(self, profile, lang, alpha=1, beta=0, prepared=None):
         super(SuffixPrefix, self).__init__(profile, alpha, beta)
 
-        self.suffix_table = profile['suffix_prefix']['suffix_table']
-        self.suffix_occurence_counts = profile['suffix_prefix']['suffix_occurence_counts']
-        self.prefix_table = profile['suffix_prefix']['prefix_table']
-        self.prefix_occurence_counts = profile['suffix_prefix']['prefix_occurence_counts']
-
-        # alfa-self.beta smoothing must be done inside each call (because of counts instead of probabilities)
+        # prefix table is estimated on reversed words, so prefixes (and their rewrites) are stored reversed
+        self.suffix_index, self.prefix_index = prepared if prepared is not None else SuffixPrefix.prepare(profile, lang)
         self.alpha = alpha
         self.beta = beta
 
-    def apply(self, text, whitespace_info):
-        def _introduce_suffix_errors(local_text, suffix_table, suffix_occurence_counts):
-            new_text = []
+        # probabilities of changing a word with given deepest xfix are smoothed for all xfixes at once, tables of the applied xfixes and
+        # their rewrites only when an xfix is applied for the first time
+        self.suffix_change_probs = _smooth_xfix_change_probs(self.suffix_index, alpha, beta)
+        self.prefix_change_probs = _smooth_xfix_change_probs(self.prefix_index, alpha, beta)
+        self.suffix_change_tables, self.suffix_rewrite_tables = {}, {}
+        self.prefix_change_tables, self.prefix_rewrite_tables = {}, {}
+
+    @staticmethod
+    def prepare(profile, lang):
+        return (_build_xfix_index(profile['suffix_prefix']['suffix_table'], profile['suffix_prefix']['suffix_occurence_counts']),
+                _build_xfix_index(profile['suffix_prefix']['prefix_table'], profile['suffix_prefix']['prefix_occurence_counts']))
+
+    def build_all_tables(self):
+        for xfix_index, change_probs, change_tables, rewrite_tables in [
+                (self.suffix_index, self.suffix_change_probs, self.suffix_change_tables, self.suffix_rewrite_tables),
+                (self.prefix_index, self.prefix_change_probs, self.prefix_change_tables, self.prefix_rewrite_tables)]:
+            for xfix, row in xfix_index['candidate_rows'].items():
+                if change_probs[row] > 0:
+                    self._get_change_table(xfix_index, change_tables, xfix)
+            for xfix in xfix_index['rewrites']:
+                self._get_rewrite_table(xfix_index, rewrite_tables, xfix)
+
+    def _get_change_table(self, xfix_index, change_tables, xfix):
+        if xfix not in change_tables:
+            _, change_tables[xfix] = _smooth_xfix_change(xfix_index, xfix, self.alpha, self.beta)
+        return change_tables[xfix]
+
+    def _get_rewrite_table(self, xfix_index, rewrite_tables, xfix):
+        if xfix not in rewrite_tables:
+            rewrite_tables[xfix] = _smooth_xfix_rewrites(xfix_index, xfix, self.alpha, self.beta)
+        return rewrite_tables[xfix]
+
+    def apply_sentence(self, sentence):
+        def _introduce_xfix_errors(words, xfix_index, change_probs, change_tables, rewrite_tables, prefix):
+            trie, node_xfixes, candidate_rows = xfix_index['trie'], xfix_index['node_xfixes'], xfix_index['candidate_rows']
+
+            new_words = []
             changes = []
-            # first introduce suffix errors
-            for word in local_text.split(' '):
-                word_suffixes = [word[i:] for i in range(1, len(word))] + [""]
-                found_word_suffixes = []
-                word_suffixes_probs = []
-
-                sum_rewrites_that_go_on = 0
-                last_match_sum_applicable = 0
-                for word_suffix in word_suffixes:
-                    if word_suffix in suffix_table:
-                        found_word_suffixes.append(word_suffix)
-                        sum_rewrites_in_data = np.sum(list(suffix_table[word_suffix].values())) - sum_rewrites_that_go_on
-                        sum_applicable_in_data = suffix_occurence_counts[word_suffix] - last_match_sum_applicable
-
-                        sum_rewrites_that_go_on = 0
-                        if word_suffix:  # if empty, this is an inserting of the suffix and is the last element of the for-cycle
-                            for word_suffix_alternative in suffix_table[word_suffix]:
-                                if len(word_suffix_alternative) > 0 and word_suffix_alternative[0] == word_suffix[0]:
-                                    sum_rewrites_that_go_on += suffix_table[word_suffix][word_suffix_alternative]
-
-                        last_match_sum_applicable = sum_applicable_in_data
-
-                        if sum_applicable_in_data == 0:
-                            word_suffixes_probs.append(0)
-                        else:
-                            word_suffixes_probs.append(sum_rewrites_in_data / sum_applicable_in_data)
-
-                if not word_suffixes_probs:
+            for word in words:
+                # walk the trie from the end of the (reversed, if prefixes) word, the whole word is never an xfix of itself
+                deepest_xfix = node_xfixes[0]
+                node = 0
+                for c in (word[:-1] if prefix else reversed(word[1:])):
+                    node = trie[node].get(c)
+                    if node is None:
+                        break
+                    if node_xfixes[node] is not None:
+                        deepest_xfix = node_xfixes[node]
+
+                change_prob = change_probs[candidate_rows[deepest_xfix]] if deepest_xfix in candidate_rows else 0
+                if change_prob <= 0:
                     # no edit is applicable
-                    new_text.append(word)
+                    new_words.append(word)
                     continue
 
-                # select suffix (according to probability distribution)
-                word_suffixes_probs = np.array(word_suffixes_probs)
-                word_suffixes_probs_normalized = word_suffixes_probs / np.sum(word_suffixes_probs)
-                word_suffixes_probs_normalized_smoothed = utils._apply_smoothing(word_suffixes_probs_normalized, self.alpha, self.beta)
-                chosen_suffix_ind = np.random.choice(len(found_word_suffixes), p=word_suffixes_probs_normalized_smoothed)
+                # decide whether to change the word and select the applied xfix (according to probability distribution)
+                if utils.trigger(change_prob):
+                    chosen_xfix_ind = self._get_change_table(xfix_index, change_tables, deepest_xfix).sample()
+                    chosen_xfix = xfix_index['candidates'][deepest_xfix][chosen_xfix_ind]
 
-                word_suffixes_probs_smoothed = utils._apply_smoothing(word_suffixes_probs, self.alpha, self.beta)
-                chosen_suffix, chosen_suffix_sum_prob = found_word_suffixes[chosen_suffix_ind], word_suffixes_probs_smoothed[
-                    chosen_suffix_ind]
+                    # choose what to rewrite the xfix into
+                    chosen_rewrite_into_tokens = self._get_rewrite_table(xfix_index, rewrite_tables, chosen_xfix).sample()
 
-                # toss a coin for the chosen suffix
-                chosen_suffix_sum_prob_smoothed = utils._apply_smoothing([chosen_suffix_sum_prob], self.alpha, self.beta)[0]
-                if np.random.uniform(0, 1) < chosen_suffix_sum_prob_smoothed:
-                    # choose what to rewrite the suffix into
-                    rewrite_into_probs = np.array(list(suffix_table[chosen_suffix].values())) / np.sum(
-                        np.array(list(suffix_table[chosen_suffix].values())))
-
-                    rewrite_into_probs_smoothed = utils._apply_smoothing(rewrite_into_probs, self.alpha, self.beta)
-                    chosen_rewrite_into_tokens = np.random.choice(list(suffix_table[chosen_suffix].keys()), p=rewrite_into_probs_smoothed)
-
-                    if len(chosen_suffix) == 0:  # inserting suffix after this word
-                        new_word = word + chosen_rewrite_into_tokens
+                    if prefix:
+                        new_word = chosen_rewrite_into_tokens[::-1] + word[len(chosen_xfix):]
                     else:
-                        new_word = word[:-len(chosen_suffix)] + chosen_rewrite_into_tokens
-                    new_text.append(new_word)
+                        new_word = word[:len(word) - len(chosen_xfix)] + chosen_rewrite_into_tokens
+                    new_words.append(new_word)
                     changes.append(['SUFFIX', 'change {} -> {}'.format(word, new_word)])
                 else:
-                    new_text.append(word)
-
-            return " ".join(new_text), changes
+                    new_words.append(word)
 
-        text, suffix_changes, = _introduce_suffix_errors(text, self.suffix_table, self.suffix_occurence_counts)
+            return new_words, changes
 
-        text = " ".join(["".join(reversed(word)) for word in text.split(' ')])
-        text, prefix_changes = _introduce_suffix_errors(text, self.prefix_table, self.prefix_occurence_counts)
-        text = " ".join(["".join(reversed(word)) for word in text.split(' ')])
-        return text, suffix_changes + prefix_changes, whitespace_info
+        words, suffix_changes = _introduce_xfix_errors(sentence.tokens, self.suffix_index, self.suffix_change_probs,
+                                                       self.suffix_change_tables, self.suffix_rewrite_tables, prefix=False)
+        words, prefix_changes = _introduce_xfix_errors(words, self.prefix_index, self.prefix_change_probs, self.prefix_change_tables,
+                                                       self.prefix_rewrite_tables, prefix=True)
+        sentence.tokens = words
+        sentence.changes.extend(suffix_changes + prefix_changes)
 
     @staticmethod
     def _get_occurence_count_of_tokens_in_text(text, suffix):
@@ -113,32 +274,34 @@ class SuffixPrefix(Aspect):
         return num_occurences_of_suffix_in_cor
 
     @staticmethod
-    def _get_xfix_occurence_counts(xfix_table, coder_dicts, reverse=False):
-        ''''
-        For each possible xfix (in xfix_table), count, how many times this suffix appeared in all corrected sentences (coder_dicts).
+    def _update_alpha_runs_counter(text, alpha_runs_counter):
         '''
-        num_occurence = {}
-
-        for coder_dict in coder_dicts:
-            if coder_dict:
-                coder_id = list(coder_dict.keys())[0]
-
-                cor_sent = coder_dict[coder_id][0]
-
-                if reverse:
-                    cor_sent = ["".join(reversed(word)) for word in cor_sent]
-
-                cor_sent = " ".join(cor_sent).lower()
+        Count maximal runs of alpha characters in text. An (alpha) xfix occurs in text (as counted by _get_occurence_count_of_tokens_in_text)
+        exactly once for each alpha run ending with it, so the occurence counts can be computed from the runs of all texts.
+        '''
+        for is_alpha, run in itertools.groupby(text, str.isalpha):
+            if is_alpha:
+                run = "".join(run)
+                alpha_runs_counter[run] = alpha_runs_counter.get(run, 0) + 1
 
-                for cor_toks_xfix in xfix_table:
-                    if cor_toks_xfix not in num_occurence:
-                        num_occurence[cor_toks_xfix] = 0
+    @staticmethod
+    def _get_xfix_occurence_counts(xfix_table, alpha_runs_counter, num_alpha_words):
+        '''
+        For each possible xfix (in xfix_table), count, how many times this suffix appeared in all corrected sentences (given by counts of
+        their alpha runs, see _update_alpha_runs_counter).
+        '''
+        ending_counts = {}
+        for run, count in alpha_runs_counter.items():
+            for i in range(len(run)):
+                if run[i:] in xfix_table:
+                    ending_counts[run[i:]] = ending_counts.get(run[i:], 0) + count
 
-                    if not cor_toks_xfix.strip():  # empty suffix replace with some other (=insert some substring after token)
-                        num_alpha_in_sent = sum([1 for x in cor_sent.split(' ') if x.isalpha()])
-                        num_occurence[cor_toks_xfix] += num_alpha_in_sent
-                    else:
-                        num_occurence[cor_toks_xfix] += SuffixPrefix._get_occurence_count_of_tokens_in_text(cor_sent, cor_toks_xfix)
+        num_occurence = {}
+        for cor_toks_xfix in xfix_table:
+            if not cor_toks_xfix.strip():  # empty suffix replace with some other (=insert some substring after token)
+                num_occurence[cor_toks_xfix] = num_alpha_words
+            else:
+                num_occurence[cor_toks_xfix] = ending_counts.get(cor_toks_xfix, 0)
 
         return num_occurence
 
@@ -156,11 +319,9 @@ class SuffixPrefix(Aspect):
         :param xfix_table: dict in format xfix_table[cor_xfix][orig_xfix] = count
         :return:
         '''
-        orig_start, orig_end, error_type, cor_toks, _, _ = edit
-
         # lower down all tokens to cope with lack of data
-        orig_toks = " ".join(orig_sent[orig_start:orig_end]).lower()
-        cor_toks = cor_toks.lower()
+        orig_toks = " ".join(orig_sent[edit.orig_start:edit.orig_end]).lower()
+        cor_toks = edit.cor_tok.lower()
 
         if orig_toks == cor_toks:
             # this should not happen if data were annotated by Errant
@@ -209,34 +370,51 @@ class SuffixPrefix(Aspect):
                 break
 
     @staticmethod
-    def estimate_probabilities(m2_records):
+    def accumulate(m2_records):
+        '''
+            Count (unfiltered) suffix and prefix tables, and alpha runs of the lower-cased corrected sentences (with reversed words for
+            prefixes), from which the occurence counts of the xfixes are computed in finalize.
+            '''
         suffix_table = {}
         prefix_table = {}
+        suffix_alpha_runs_counter = {}
+        prefix_alpha_runs_counter = {}
+        num_alpha_words = 0
 
-        cached_coder_dicts = []
         for m2_file in m2_records:
-            for info in m2_file:
-                orig_sent, coder_dict = apply_m2_edits.processM2(info, [])
-                if coder_dict:
-                    coder_id = list(coder_dict.keys())[0]
-
-                    cached_coder_dicts.append(coder_dict)
-
-                    for edit in coder_dict[coder_id][1]:
-                        orig_start, orig_end, error_type, cor_tok, cor_start, cor_end = edit
-
+            for sentence in m2_file:
+                orig_sent = sentence.orig
+                if sentence.coders:
+                    cor_sent = " ".join(sentence.cor).lower()
+                    SuffixPrefix._update_alpha_runs_counter(cor_sent, suffix_alpha_runs_counter)
+                    SuffixPrefix._update_alpha_runs_counter(" ".join(["".join(reversed(word)) for word in sentence.cor]).lower(),
+                                                            prefix_alpha_runs_counter)
+                    num_alpha_words += sum([1 for x in cor_sent.split(' ') if x.isalpha()])
+
+                    for edit in sentence.edits:
                         exclude_error_types = ['noop', 'PUNCT', 'CASING', 'DIACR', 'UNK']
 
-                        if all([x not in error_type for x in exclude_error_types]):
+                        if all([x not in edit.error_type for x in exclude_error_types]):
                             SuffixPrefix._update_xfix_table(edit, orig_sent, suffix_table)
 
                             # reverse the sentence to update prefix table
                             orig_sent_reversed_words = ["".join(reversed(word)) for word in orig_sent]
-                            cor_tok_reversed = " ".join(["".join(reversed(word)) for word in cor_tok.split(' ')])
-                            edit = (orig_start, orig_end, error_type, cor_tok_reversed, cor_start, cor_end)
+                            cor_tok_reversed = " ".join(["".join(reversed(word)) for word in edit.cor_tok.split(' ')])
+                            edit = apply_m2_edits.Edit(edit.orig_start, edit.orig_end, edit.error_type, cor_tok_reversed, edit.cor_start,
+                                                       edit.cor_end)
 
                             SuffixPrefix._update_xfix_table(edit, orig_sent_reversed_words, prefix_table)
 
+        return {
+            'suffix_table': suffix_table,
+            'prefix_table': prefix_table,
+            'suffix_alpha_runs_counter': suffix_alpha_runs_counter,
+            'prefix_alpha_runs_counter': prefix_alpha_runs_counter,
+            'num_alpha_words': num_alpha_words
+        }
+
+    @staticmethod
+    def finalize(counts):
         # filter out edits that were done not often enough (are rather noise)
         def filter_table_by_min_occurence_count(table, local_filter_out_min_occ_count):
             table_filtered = {}
@@ -254,11 +432,13 @@ class SuffixPrefix(Aspect):
             return table_filtered
 
         filter_out_min_occ_count = 3
-        suffix_table_filtered = filter_table_by_min_occurence_count(suffix_table, filter_out_min_occ_count)
-        prefix_table_filtered = filter_table_by_min_occurence_count(prefix_table, filter_out_min_occ_count)
+        suffix_table_filtered = filter_table_by_min_occurence_count(counts['suffix_table'], filter_out_min_occ_count)
+        prefix_table_filtered = filter_table_by_min_occurence_count(counts['prefix_table'], filter_out_min_occ_count)
 
-        suffix_occurence_counts = SuffixPrefix._get_xfix_occurence_counts(suffix_table_filtered, cached_coder_dicts)
-        prefix_occurence_counts = SuffixPrefix._get_xfix_occurence_counts(prefix_table_filtered, cached_coder_dicts, reverse=True)
+        suffix_occurence_counts = SuffixPrefix._get_xfix_occurence_counts(suffix_table_filtered, counts['suffix_alpha_runs_counter'],
+                                                                          counts['num_alpha_words'])
+        prefix_occurence_counts = SuffixPrefix._get_xfix_occurence_counts(prefix_table_filtered, counts['prefix_alpha_runs_counter'],
+                                                                          counts['num_alpha_words'])
 
         return 'suffix_prefix', {
             'suffix_table': suffix_table_filtered,
@@ -1,3 +1,5 @@
+from collections import deque
+
 import numpy as np
 
 
@@ -60,6 +62,10 @@ def align(orig, cor):
 # align_seq = [(op, o_start, o_end, c_start, c_end), ...]
 def get_cheapest_align_seq(orig, cor):
     _, op_matrix = align(orig, cor)
+    return _get_align_seq(op_matrix)
+
+
+def _get_align_seq(op_matrix):
     i = len(op_matrix) - 1
     j = len(op_matrix[0]) - 1
     align_seq = []
@@ -91,6 +97,80 @@ def get_cheapest_align_seq(orig, cor):
     return align_seq
 
 
+# ops of align, in the order in which the cheapest of the non-matching ops is chosen (after "O" and "M")
+_ALIGN_OPS = np.array(["O", "M", "T", "S", "I", "D"])
+_ALIGN_INF_COST = 1 << 30
+
+
+def _align_batch(origs, cors):
+    '''
+    Compute op matrices of align for a batch of (orig, cor) pairs at once, the cost matrices of all pairs (padded to the longest ones) are
+    filled by anti-diagonals, whose cells do not depend on each other. Returns list of op matrices (as lists of lists of ops), None for
+    pairs that must be aligned by align itself.
+
+    align compares sorted chars of orig[i - 1:i + 1] and cor[j - 1:j + 1] also for i = 0 or j = 0 (where the slices wrap around) and then
+    reads transposition cost from the last row or column of the cost matrix. For the first cell, the read cell is not filled yet, so the
+    transposition costs 1. The other cells of the first row and column can only match when lower-casing changes the number of chars, so
+    such pairs (practically none) are left to align.
+    '''
+    o_max, c_max = max(len(orig) for orig in origs), max(len(cor) for cor in cors)
+
+    # chars and sorted lower-cased pairs of chars (as compared by align) are converted to ids, padding ids do not match anything
+    char_ids, pair_ids = {}, {}
+    o_chars, c_chars = np.full((len(origs), o_max), -1, dtype=np.int64), np.full((len(cors), c_max), -2, dtype=np.int64)
+    o_pairs, c_pairs = np.full((len(origs), o_max), -1, dtype=np.int64), np.full((len(cors), c_max), -2, dtype=np.int64)
+    for words, chars, pairs in [(origs, o_chars, o_pairs), (cors, c_chars, c_pairs)]:
+        for k, word in enumerate(words):
+            chars[k, :len(word)] = [char_ids.setdefault(char, len(char_ids)) for char in word]
+            pairs[k, :len(word)] = [pair_ids.setdefault("".join(sorted(word[i - 1:i + 1].lower())), len(pair_ids))
+                                    for i in range(len(word))]
+
+    cost_matrix = np.zeros((len(origs), o_max + 1, c_max + 1), dtype=np.int64)
+    op_matrix = np.zeros((len(origs), o_max + 1, c_max + 1), dtype=np.int8)
+    cost_matrix[:, :, 0], op_matrix[:, 1:, 0] = np.arange(o_max + 1), 5
+    cost_matrix[:, 0, :], op_matrix[:, 0, 1:] = np.arange(c_max + 1), 4
+    must_align = np.zeros(len(origs), dtype=bool)
+
+    for diagonal in range(2, o_max + c_max + 1):
+        # cells (i + 1, j + 1) of the diagonal, i.e. the loop indices of align
+        i = np.arange(max(1, diagonal - c_max), min(o_max, diagonal - 1) + 1) - 1
+        j = diagonal - 2 - i
+
+        matches = o_chars[:, i] == c_chars[:, j]
+        transposable = o_pairs[:, i] == c_pairs[:, j]
+        first = (i == 0) | (j == 0)
+        must_align |= np.any(transposable[:, first & ((i != 0) | (j != 0))], axis=1)
+
+        costs = np.stack([
+            np.where(transposable, np.where(first, 0, cost_matrix[:, np.maximum(i - 1, 0), np.maximum(j - 1, 0)]) + 1, _ALIGN_INF_COST),
+            cost_matrix[:, i, j] + 1,
+            cost_matrix[:, i + 1, j] + 1,
+            cost_matrix[:, i, j + 1] + 1,
+        ])
+        # the first cheapest op (as align chooses)
+        cheapest = np.argmin(costs, axis=0)
+        cost_matrix[:, i + 1, j + 1] = np.where(matches, cost_matrix[:, i, j], np.take_along_axis(costs, cheapest[None], axis=0)[0])
+        op_matrix[:, i + 1, j + 1] = np.where(matches, 1, cheapest + 2)
+
+    return [None if must_align[k] else _ALIGN_OPS[op_matrix[k, :len(origs[k]) + 1, :len(cors[k]) + 1]].tolist() for k in range(len(origs))]
+
+
+def get_cheapest_align_seqs(origs, cors, batch_size=1024):
+    '''
+    Get the cheapest alignment sequences (see get_cheapest_align_seq) of many pairs of words at once. The pairs are aligned in batches of
+    pairs of similar lengths, each batch vectorized by _align_batch.
+    '''
+    align_seqs = [None] * len(origs)
+    order = sorted(range(len(origs)), key=lambda k: (len(origs[k]), len(cors[k])))
+    for batch_start in range(0, len(order), batch_size):
+        batch = order[batch_start:batch_start + batch_size]
+        op_matrices = _align_batch([origs[k] for k in batch], [cors[k] for k in batch])
+        for k, op_matrix in zip(batch, op_matrices):
+            align_seqs[k] = _get_align_seq(op_matrix) if op_matrix is not None else get_cheapest_align_seq(origs[k], cors[k])
+
+    return align_seqs
+
+
 def _apply_smoothing(unnormalized_probs, alpha, beta):
     '''
     :param unnormalized_probs: list with (un-normalized) "probability" values for each class. This list can also contain counts instead of
@@ -103,8 +183,13 @@ def _apply_smoothing(unnormalized_probs, alpha, beta):
     if len(unnormalized_probs) == 0:
         return []
 
-    # first apply beta uniformity smoothing
-    unnormalized_probs_sum = np.sum(unnormalized_probs)
+    # first apply beta uniformity smoothing (np.sum adds fewer than 8 values one by one, which is much faster in plain python)
+    if len(unnormalized_probs) < 8:
+        unnormalized_probs_sum = 0.
+        for unnormalized_prob in unnormalized_probs:
+            unnormalized_probs_sum += unnormalized_prob
+    else:
+        unnormalized_probs_sum = np.sum(unnormalized_probs)
     smoothed_unnormalized_probs = []
     for unnormalized_prob in unnormalized_probs:
         smoothed_value = unnormalized_prob * (1 - beta) + beta * (unnormalized_probs_sum / len(unnormalized_probs))
@@ -112,7 +197,8 @@ def _apply_smoothing(unnormalized_probs, alpha, beta):
 
     # then apply alpha multiplication (and potential clipping)
     # do not apply it when the sum is already 1 (full distribution)
-    if not np.isclose(unnormalized_probs_sum, 1.):
+    # (same as np.isclose with its default tolerances, which is too slow for scalars)
+    if not abs(unnormalized_probs_sum - 1.) <= 1e-08 + 1e-05:
         multiplication_factor = min(alpha, 1 / (unnormalized_probs_sum + 1e-6))
         for i in range(len(smoothed_unnormalized_probs)):
             smoothed_unnormalized_probs[i] *= multiplication_factor
@@ -120,5 +206,394 @@ def _apply_smoothing(unnormalized_probs, alpha, beta):
     return smoothed_unnormalized_probs
 
 
+def _apply_smoothing_to_each(probs, alpha, beta):
+    '''
+    Apply smoothing to each of probs as a single class distribution, i.e. the same as [_apply_smoothing([prob], alpha, beta)[0] for prob
+    in probs], but vectorized.
+    '''
+    probs = np.asarray(probs, dtype=np.float64)
+    smoothed_probs = probs * (1 - beta) + beta * (probs / 1)
+    return np.where(np.abs(probs - 1.) <= 1e-08 + 1e-05, smoothed_probs, smoothed_probs * np.minimum(alpha, 1 / (probs + 1e-6)))
+
+
 def _apply_smoothing_on_simple_dict(simple_dict, alpha, beta):
     return {k: v for k, v in zip(simple_dict.keys(), _apply_smoothing(list(simple_dict.values()), alpha, beta))}
+
+
+class RandomSource:
+    '''
+    Buffered source of uniform random numbers. Numbers are drawn from the global numpy random state in blocks, which is much cheaper than
+    calling np.random.uniform for every single draw. Use seed() of this module instead of np.random.seed, so that the buffer is discarded.
+
+    Aspects decide whether to introduce an error with trigger() (or triggers()), which allows noising conditioned on introducing at least
+    one error, see sample_with_at_least_one_trigger().
+    '''
+
+    def __init__(self, buffer_size=1024):
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.position = 0
+
+        self.recorded_trigger_probs = None  # list of probabilities of all triggers when recording them
+        self.forced_trigger = None  # index of the trigger that must fire (and triggers before it must not)
+        self.num_fired_triggers = 0  # number of triggers that fired (and were not cancelled) when forcing a trigger
+        self.num_triggers = 0
+
+    def seed(self, seed):
+        np.random.seed(seed)
+        self.buffer = []
+        self.position = 0
+
+    def uniform(self):
+        if self.position == len(self.buffer):
+            self.buffer = np.random.random_sample(self.buffer_size).tolist()
+            self.position = 0
+
+        self.position += 1
+        return self.buffer[self.position - 1]
+
+    def uniforms(self, size):
+        '''
+        Array of size uniform random numbers, taken from the same buffer as uniform().
+        '''
+        if self.position + size > len(self.buffer):
+            self.buffer = self.buffer[self.position:] + np.random.random_sample(max(self.buffer_size, size)).tolist()
+            self.position = 0
+
+        self.position += size
+        return np.array(self.buffer[self.position - size:self.position], dtype=np.float64)
+
+    def trigger(self, prob):
+        '''
+        Decide whether to introduce an error (with probability prob).
+        '''
+        draw = self.uniform()
+        if self.recorded_trigger_probs is not None:
+            self.recorded_trigger_probs.append(prob)
+            return False
+
+        if self.forced_trigger is not None:
+            self.num_triggers += 1
+            fired = self.num_triggers - 1 == self.forced_trigger if self.num_triggers - 1 <= self.forced_trigger else draw < prob
+            self.num_fired_triggers += fired
+            return fired
+
+        return draw < prob
+
+    def triggers(self, probs):
+        '''
+        Vectorized trigger() for an array of probabilities, returns boolean array.
+        '''
+        draws = self.uniforms(len(probs))
+        if self.recorded_trigger_probs is not None:
+            self.recorded_trigger_probs.extend(np.asarray(probs, dtype=np.float64).tolist())
+            return np.zeros(len(probs), dtype=bool)
+
+        fired = draws < probs
+        if self.forced_trigger is not None:
+            first_trigger = self.num_triggers
+            self.num_triggers += len(probs)
+            fired[:max(0, min(len(probs), self.forced_trigger - first_trigger))] = False
+            if first_trigger <= self.forced_trigger < self.num_triggers:
+                fired[self.forced_trigger - first_trigger] = True
+            self.num_fired_triggers += int(fired.sum())
+
+        return fired
+
+    def cancel_trigger(self):
+        '''
+        Report that the error decided by the last trigger (that fired) cannot be introduced after all (e.g. there is nothing to replace the
+        word with), see sample_with_at_least_one_trigger().
+        '''
+        if self.forced_trigger is not None:
+            self.num_fired_triggers -= 1
+
+    def sample_with_at_least_one_trigger(self, function, max_attempts=None):
+        '''
+        Call function (that decides whether to introduce errors only by triggers) conditioned on at least one trigger firing, without
+        retrying it until some trigger fires:
+            1. function is called with no trigger firing, recording the probabilities of all its triggers,
+            2. the first trigger to fire is sampled from these probabilities, conditioned on at least one trigger firing,
+            3. function is called again with the same random numbers; triggers before the selected one do not fire, the selected one fires
+               and all the following fire with their own probabilities.
+        Until the first trigger fires, function behaves the same as when no trigger fires at all, so the probabilities recorded in the
+        first call are valid for the second call. If all the triggers that fired were cancelled (see cancel_trigger), no error was
+        introduced and the steps are repeated with new random numbers (which is rare, as only Aspell replacement of a word without any
+        valid suggestion is cancelled).
+
+        If max_attempts is given, the result is distributed as if function was retried at most max_attempts times until an error is
+        introduced, i.e. None is returned with the probability that all the attempts fail. Returns result of the last call of function,
+        or None if no trigger fires.
+        '''
+        num_attempts = 0
+        while True:
+            draw, attempts_draw = self.uniform(), self.uniform()
+            state = (np.random.get_state(), self.buffer, self.position)
+
+            self.recorded_trigger_probs = []
+            try:
+                function()
+                trigger_probs = np.clip(np.array(self.recorded_trigger_probs, dtype=np.float64), 0, 1)
+            finally:
+                self.recorded_trigger_probs = None
+
+            # probability of each trigger being the first one to fire
+            first_trigger_probs = trigger_probs * np.concatenate([[1.], np.cumprod(1 - trigger_probs)[:-1]])
+            cumulative = np.cumsum(first_trigger_probs)
+            if len(cumulative) == 0 or cumulative[-1] <= 0:
+                return None
+
+            if max_attempts is not None:
+                # number of attempts until some trigger fires is geometrically distributed
+                num_attempts += 1 if cumulative[-1] >= 1 else 1 + int(np.log(1 - attempts_draw) / np.log1p(-cumulative[-1]))
+                if num_attempts > max_attempts:
+                    return None
+
+            np.random.set_state(state[0])
+            self.buffer, self.position = state[1], state[2]
+            self.forced_trigger = min(int(cumulative.searchsorted(draw * cumulative[-1], side='right')), len(cumulative) - 1)
+            self.num_triggers = 0
+            self.num_fired_triggers = 0
+            try:
+                result = function()
+            finally:
+                self.forced_trigger = None
+
+            if self.num_fired_triggers > 0:
+                return result
+
+    def choice(self, seq):
+        return seq[min(int(self.uniform() * len(seq)), len(seq) - 1)]
+
+    def randint(self, low, high):
+        '''
+        Random integer from [low, high), same as np.random.randint(low, high).
+        '''
+        return low + min(int(self.uniform() * (high - low)), high - low - 1)
+
+    def permutation(self, x):
+        '''
+        Randomly permuted copy of sequence x or of range(x) if x is an integer, same as np.random.permutation (Fisher-Yates shuffle).
+        '''
+        permuted = list(range(x)) if isinstance(x, int) else list(x)
+        for i in range(len(permuted) - 1, 0, -1):
+            j = self.randint(0, i + 1)
+            permuted[i], permuted[j] = permuted[j], permuted[i]
+
+        return permuted
+
+    def sample_index(self, probs):
+        '''
+        Random index drawn according to (unnormalized) probs. Meant for distributions that are used just once, so that building
+        a SamplingTable does not pay off.
+        '''
+        threshold = self.uniform() * sum(probs)
+        last_possible_index = 0
+        for i, prob in enumerate(probs):
+            if prob > 0:
+                last_possible_index = i
+                threshold -= prob
+                if threshold < 0:
+                    return i
+
+        return last_possible_index
+
+
+_random_source = RandomSource()
+seed = _random_source.seed
+uniform = _random_source.uniform
+uniforms = _random_source.uniforms
+choice = _random_source.choice
+randint = _random_source.randint
+permutation = _random_source.permutation
+sample_index = _random_source.sample_index
+trigger = _random_source.trigger
+triggers = _random_source.triggers
+cancel_trigger = _random_source.cancel_trigger
+sample_with_at_least_one_trigger = _random_source.sample_with_at_least_one_trigger
+
+
+def _build_alias_table(probs):
+    '''
+    Builds Walker alias table (using Vose's method) for given unnormalized probs. Each of n buckets gets a threshold and an alias index;
+    a draw picks a bucket uniformly and returns either the bucket or its alias, so it takes O(1) time regardless of n.
+    '''
+    num_keys = len(probs)
+    scaled_probs = (np.asarray(probs, dtype=np.float64) * (num_keys / np.sum(probs))).tolist()
+    alias_probs = [1.] * num_keys
+    alias_indices = list(range(num_keys))
+
+    small = [i for i, prob in enumerate(scaled_probs) if prob < 1]
+    large = [i for i, prob in enumerate(scaled_probs) if prob >= 1]
+    while small and large:
+        small_ind, large_ind = small.pop(), large.pop()
+        alias_probs[small_ind] = scaled_probs[small_ind]
+        alias_indices[small_ind] = large_ind
+
+        scaled_probs[large_ind] += scaled_probs[small_ind] - 1
+        if scaled_probs[large_ind] < 1:
+            small.append(large_ind)
+        else:
+            large.append(large_ind)
+
+    # what remains in small or large is (up to rounding errors) exactly 1, so it keeps its own bucket
+    return np.array(alias_probs, dtype=np.float64), np.array(alias_indices, dtype=np.int64)
+
+
+class SamplingTable:
+    '''
+    Categorical distribution with precomputed cumulative probabilities and Walker alias table. Sampling from it uses a single buffered
+    uniform number and takes O(1) time, no lists nor arrays are built.
+
+    Many tables are never sampled from (e.g. tables of rare chars for alphas sampled only a few times), so the cumulative probabilities
+    and alias table are only computed when accessed for the first time.
+    '''
+
+    ARRAYS = ['probs', 'cumulative', 'alias_probs', 'alias_indices']
+    LAZY_ATTRIBUTES = {'cumulative', 'alias_probs', 'alias_indices', '_alias_draws'}
+
+    def __init__(self, keys, probs, cumulative=None, total=None, alias_probs=None, alias_indices=None):
+        self.keys = list(keys)
+        self.probs = np.asarray(probs if isinstance(probs, np.ndarray) else list(probs), dtype=np.float64)
+        self.total = float(np.sum(self.probs)) if total is None else total
+        self._num_keys = len(self.keys)
+
+        if cumulative is not None:
+            self.cumulative = np.asarray(cumulative, dtype=np.float64)
+        if alias_probs is not None:
+            self.alias_probs = np.asarray(alias_probs, dtype=np.float64)
+            self.alias_indices = np.asarray(alias_indices, dtype=np.int64)
+
+    def __getattr__(self, name):
+        # called only for attributes that are not set yet
+        if name not in SamplingTable.LAZY_ATTRIBUTES:
+            raise AttributeError(name)
+
+        if 'cumulative' not in self.__dict__:
+            cumulative = None
+            if self.total > 0:
+                cumulative = np.cumsum(self.probs / self.total)
+                cumulative /= cumulative[-1]
+            self.cumulative = np.asarray(cumulative if cumulative is not None else [], dtype=np.float64)
+
+        if 'alias_probs' not in self.__dict__:
+            alias_probs, alias_indices = _build_alias_table(self.probs) if self.total > 0 else (None, None)
+            self.alias_probs = np.asarray(alias_probs if alias_probs is not None else [], dtype=np.float64)
+            self.alias_indices = np.asarray(alias_indices if alias_indices is not None else [], dtype=np.int64)
+
+        # plain python lists are much faster than numpy arrays when accessing single items
+        self._alias_draws = list(zip(self.alias_probs.tolist(), [self.keys[i] for i in self.alias_indices.tolist()]))
+
+        return self.__dict__[name]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def sample(self):
+        draw = _random_source.uniform() * self._num_keys
+        bucket = min(int(draw), self._num_keys - 1)
+        threshold, alias_key = self._alias_draws[bucket]
+        return self.keys[bucket] if draw - bucket < threshold else alias_key
+
+    def sample_many(self, size):
+        draws = _random_source.uniforms(size) * self._num_keys
+        buckets = np.minimum(draws.astype(np.int64), self._num_keys - 1)
+        indices = np.where(draws - buckets < self.alias_probs[buckets], buckets, self.alias_indices[buckets])
+        return [self.keys[i] for i in indices.tolist()]
+
+
+def _build_sampling_table(simple_dict, alpha, beta):
+    return SamplingTable(simple_dict.keys(), _apply_smoothing(list(simple_dict.values()), alpha, beta))
+
+
+class PhraseMatcher:
+    '''
+    Aho-Corasick automaton that finds all occurences of all given phrases in a text in a single pass over it.
+    '''
+
+    def __init__(self, phrases):
+        self.transitions = [{}]
+        self.fail = [0]
+        self.outputs = [[]]  # phrases ending in given state, longest first
+
+        for phrase in phrases:
+            state = 0
+            for c in phrase:
+                if c not in self.transitions[state]:
+                    self.transitions[state][c] = len(self.transitions)
+                    self.transitions.append({})
+                    self.fail.append(0)
+                    self.outputs.append([])
+                state = self.transitions[state][c]
+            self.outputs[state].append(phrase)
+
+        # compute fail links breadth-first, so that fail states (which are shallower) are always finished first
+        queue = deque(self.transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for c, next_state in self.transitions[state].items():
+                queue.append(next_state)
+
+                fail_state = self.fail[state]
+                while fail_state != 0 and c not in self.transitions[fail_state]:
+                    fail_state = self.fail[fail_state]
+                self.fail[next_state] = self.transitions[fail_state].get(c, 0)
+                self.outputs[next_state] = self.outputs[next_state] + self.outputs[self.fail[next_state]]
+
+    def find(self, text, is_boundary):
+        '''
+        Return (start index, phrase) pairs of all (possibly overlapping) occurences of phrases in text, that are bordered by chars for
+        which is_boundary holds (or by start/end of the text). Occurences are ordered by their end index.
+        '''
+        transitions, fail, outputs = self.transitions, self.fail, self.outputs
+
+        occurences = []
+        state = 0
+        for i, c in enumerate(text):
+            while state != 0 and c not in transitions[state]:
+                state = fail[state]
+            state = transitions[state].get(c, 0)
+
+            if outputs[state] and (i + 1 == len(text) or is_boundary(text[i + 1])):
+                for phrase in outputs[state]:
+                    start_index = i + 1 - len(phrase)
+                    if start_index == 0 or is_boundary(text[start_index - 1]):
+                        occurences.append((start_index, phrase))
+
+        return occurences
+
+    def find_at_start(self, text, is_boundary):
+        '''
+        Return (0, phrase) pairs of the phrases that occur at the start of text and are followed by a char for which is_boundary holds (or by
+        end of the text), longest first.
+        '''
+        transitions, outputs = self.transitions, self.outputs
+
+        occurences = []
+        state = 0
+        for i, c in enumerate(text):
+            if c not in transitions[state]:
+                break
+            state = transitions[state][c]
+
+            # the phrase of the state itself (if any) is the first of its outputs, the others are its suffixes
+            if outputs[state] and len(outputs[state][0]) == i + 1 and (i + 1 == len(text) or is_boundary(text[i + 1])):
+                occurences.append((0, outputs[state][0]))
+
+        return occurences[::-1]
+
+
+def merge_counts(partial_counts):
+    '''
+    Merge partial counts (nested dicts with numbers in leaves) by summing the numbers with the same keys. Keys are ordered by their first
+    occurence in the partial counts.
+    '''
+    merged = {}
+    for counts in partial_counts:
+        for key, value in counts.items():
+            if isinstance(value, dict):
+                merged[key] = merge_counts([merged.get(key, {}), value])
+            else:
+                merged[key] = merged.get(key, 0) + value
+
+    return merged
@@ -1,13 +1,12 @@
 from collections import Counter
 
 import numpy as np
-from aspects import apply_m2_edits
 from aspects import utils
 from aspects.base import Aspect
 
 
 class WordOrder(Aspect):
-    def __init__(self, profile, lang, alpha=1, beta=0):
+    def __init__(self, profile, lang, alpha=1, beta=0, prepared=None):
         super(WordOrder, self).__init__(profile, alpha, beta)
 
         tuples_with_wo_percentage = profile['word_order']['tuples_with_wo_percentage']
@@ -16,11 +15,22 @@ class WordOrder(Aspect):
         num_words_per_wo_change_distrib = profile['word_order']['num_words_per_wo_change_distrib']
         self.num_words_per_wo_change_distrib = utils._apply_smoothing_on_simple_dict(num_words_per_wo_change_distrib, alpha, beta)
 
-    def apply(self, text, whitespace_info):
-        changes = []
-        text_words = text.split(' ')
+        # distributions of number of words in word-order error for each number of words remaining in text (anything above the longest
+        # possible error shares the same distribution)
+        self.max_num_words_per_wo_change = max(map(int, self.num_words_per_wo_change_distrib.keys()), default=0)
+        self.num_words_per_wo_change_tables = {}
+        for remaining_words in range(self.max_num_words_per_wo_change + 1):
+            this_wo_possible_tuples_probs = {int(k): v for k, v in self.num_words_per_wo_change_distrib.items() if int(k) <= remaining_words}
+            normalized_probabilities = np.array(list(this_wo_possible_tuples_probs.values())) / np.sum(
+                list(this_wo_possible_tuples_probs.values()))
+            self.num_words_per_wo_change_tables[remaining_words] = utils.SamplingTable(this_wo_possible_tuples_probs.keys(),
+                                                                                       normalized_probabilities)
+
+    def apply_sentence(self, sentence):
+        tokens, whitespace_info = sentence.tokens, sentence.whitespace_info
+        text_words = list(tokens)
         if len(text_words) < 2:
-            return text, changes, whitespace_info
+            return
 
         for start_word_i, start_word in enumerate(text_words):
             remaining_words = len(text_words) - 1 - start_word_i
@@ -28,17 +38,14 @@ class WordOrder(Aspect):
             if remaining_words < 2:
                 continue
 
-            if np.random.uniform(0, 1) < self.tuples_with_wo_percentage:
-                this_wo_possible_tuples_probs = {k: v for k, v in self.num_words_per_wo_change_distrib.items() if int(k) <= remaining_words}
-                normalized_probabilities = np.array(list(this_wo_possible_tuples_probs.values())) / np.sum(
-                    list(this_wo_possible_tuples_probs.values()))
-                num_words_in_word_order_error = int(np.random.choice(list(this_wo_possible_tuples_probs.keys()),
-                                                                     p=normalized_probabilities))
+            if utils.trigger(self.tuples_with_wo_percentage):
+                num_words_in_word_order_error = self.num_words_per_wo_change_tables[
+                    min(remaining_words, self.max_num_words_per_wo_change)].sample()
 
                 while True:
                     # we do not want the permutation to "do nothing"
-                    perm = np.random.permutation(num_words_in_word_order_error)
-                    if not np.array_equal(perm, np.array(range(num_words_in_word_order_error))):
+                    perm = utils.permutation(num_words_in_word_order_error)
+                    if perm != list(range(num_words_in_word_order_error)):
                         break
 
                 new_words = [''] * num_words_in_word_order_error
@@ -57,47 +64,55 @@ class WordOrder(Aspect):
                     if (start_word_i + i) < len(whitespace_info) and (start_word_i + p_index) < len(whitespace_info):
                         whitespace_info[start_word_i + i] = whitespace_info[start_word_i + p_index]
 
-                changes.append(['WO', 'replace {} with {}'.format(
-                    " ".join(text.split(' ')[start_word_i:start_word_i + num_words_in_word_order_error]),
+                sentence.changes.append(['WO', 'replace {} with {}'.format(
+                    " ".join(tokens[start_word_i:start_word_i + num_words_in_word_order_error]),
                     " ".join(text_words[start_word_i:start_word_i + num_words_in_word_order_error]))])
 
-        return ' '.join(text_words), changes, whitespace_info
+        sentence.tokens = text_words
 
     @staticmethod
-    def estimate_probabilities(m2_records):
-        num_words_per_wo_errors = []
-        wo_percentage = []
+    def accumulate(m2_records):
+        # numbers of words of word-order errors are stored as strings, so that the counts are serializable to JSON
+        num_words_per_wo_errors = {}
+        wo_percentage_sum = 0
+        num_paragraphs = 0
 
         for m2_file in m2_records:
 
-            for info in m2_file:
-                orig_sent, coder_dict = apply_m2_edits.processM2(info, [])
+            for sentence in m2_file:
 
-                if coder_dict:
-                    coder_id = list(coder_dict.keys())[0]
-                    cor_sent = coder_dict[coder_id][0]
-                    paragraph_len = len(cor_sent)
+                if sentence.coders:
+                    paragraph_len = len(sentence.cor)
 
                     if paragraph_len < 2:
                         continue
 
                     num_wo_in_paragraph = 0
-                    for edit in coder_dict[coder_id][1]:
-                        orig_start, orig_end, error_type, cor_tok, cor_start, cor_end = edit
-
-                        if 'WO' in error_type:
-                            num_words_per_wo_errors.append(orig_end - orig_start)
+                    for edit in sentence.edits:
+                        if 'WO' in edit.error_type:
+                            num_words = str(edit.orig_end - edit.orig_start)
+                            num_words_per_wo_errors[num_words] = num_words_per_wo_errors.get(num_words, 0) + 1
                             num_wo_in_paragraph += 1
 
-                    wo_percentage.append(num_wo_in_paragraph / (paragraph_len - 1))
+                    wo_percentage_sum += num_wo_in_paragraph / (paragraph_len - 1)
+                    num_paragraphs += 1
+
+        return {
+            'num_words_per_wo_errors': num_words_per_wo_errors,
+            'wo_percentage_sum': wo_percentage_sum,
+            'num_paragraphs': num_paragraphs
+        }
 
-        tuples_with_wo_percentage = np.mean(wo_percentage)
+    @staticmethod
+    def finalize(counts):
+        tuples_with_wo_percentage = counts['wo_percentage_sum'] / counts['num_paragraphs'] if counts['num_paragraphs'] else np.nan
 
-        cnt_num_words_per_wo_errors = Counter(num_words_per_wo_errors)
+        cnt_num_words_per_wo_errors = Counter(counts['num_words_per_wo_errors'])
+        num_wo_errors = sum(cnt_num_words_per_wo_errors.values())
 
         num_words_per_wo_change_distrib = {}
         for k, v in cnt_num_words_per_wo_errors.most_common():
-            num_words_per_wo_change_distrib[k] = v / len(num_words_per_wo_errors)
+            num_words_per_wo_change_distrib[int(k)] = v / num_wo_errors
 
         return 'word_order', {
             'tuples_with_wo_percentage': tuples_with_wo_percentage,
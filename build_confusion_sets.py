@@ -0,0 +1,61 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import aspell
+from aspects.confusion_sets import save_confusion_sets
+from aspects.spelling import NUM_TOP_SUGGESTIONS, get_aspell_dictionary_version
+
+# speller of a process computing the suggestions
+_speller = {}
+
+
+def _init_speller(lang):
+    _speller['speller'] = aspell.Speller('lang', lang)
+
+
+def _suggest_words(words):
+    return [_speller['speller'].suggest(word)[:NUM_TOP_SUGGESTIONS] for word in words]
+
+
+def load_vocabulary(vocabulary_file, max_words=None):
+    '''
+    Load words from vocabulary file with one word per line (possibly followed by a tab and e.g. its count). Only alphabetic words are kept,
+    as only these are replaced by Aspell suggestions.
+    '''
+    words = []
+    seen_words = set()
+    with open(vocabulary_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            word = line.rstrip('\n').split('\t')[0].strip()
+            if word.isalpha() and word not in seen_words:
+                seen_words.add(word)
+                words.append(word)
+
+                if max_words is not None and len(words) == max_words:
+                    break
+
+    return words
+
+
+def build_confusion_sets(words, lang, workers=1, words_per_chunk=1000):
+    chunks = [words[i:i + words_per_chunk] for i in range(0, len(words), words_per_chunk)]
+    with ProcessPoolExecutor(workers, initializer=_init_speller, initargs=(lang,)) as executor:
+        suggestions = {}
+        for chunk, chunk_suggestions in zip(chunks, executor.map(_suggest_words, chunks)):
+            suggestions.update(zip(chunk, chunk_suggestions))
+
+    return suggestions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("vocabulary_file", type=str,
+                        help="Path to file with vocabulary (e.g. the most frequent words of a monolingual corpus), one word per line.")
+    parser.add_argument("outfile", type=str, help="Path to file to store confusion sets.")
+    parser.add_argument("lang", type=str, help="Language. E.g. cs, en, de, ru.")
+    parser.add_argument("--max-words", type=int, default=None, help="Use only this number of first words of the vocabulary.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes to query Aspell with.")
+    args = parser.parse_args()
+
+    suggestions = build_confusion_sets(load_vocabulary(args.vocabulary_file, args.max_words), args.lang, args.workers)
+    save_confusion_sets(suggestions, args.outfile, args.lang, get_aspell_dictionary_version(aspell.Speller('lang', args.lang)))
@@ -0,0 +1,218 @@
+'''
+Calibrates alphas of a profile to reach required error rates, in the format of the .csv files in profiles. It does what estimate_alpha.sh
+does, but keeps the profile, Aspell and tokenizer loaded in a pool of worker processes, which noise a sample of monolingual data for each
+candidate alpha. Error rate of the noised sample is measured in memory by aligning its tokens to the clean ones (instead of by ERRANT, see
+compute_error_rate.get_sentence_edits_info), so the reference error rate is measured by aligning the original and corrected sentences of
+the reference M2 files in the same way (see compute_error_rate.get_aligned_edits_info). As the error rate grows with alpha, each alpha is
+searched for by false position steps (with Illinois modification) on the alpha -> error rate curve instead of measuring a grid of alphas.
+'''
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import compute_error_rate
+from aspects import Spelling, compiled_profile, utils
+from introduce_errors import TOKENIZERS, get_profile_aspects_generator, introduce_errors_in_line, load_profile, load_tokenizer, \
+    prepare_aspects, tokenize_lines
+
+# state of a process that noises the sample (either the main process, or a worker of the process pool)
+_calibration_state = {}
+
+
+def _init_calibration_state(profile_file, lang, tokenizer_name, sample, random_seed, aspell_options):
+    _calibration_state['profile'] = load_profile(profile_file)
+    _calibration_state['lang'] = lang
+    _calibration_state['aspell_speller'] = Spelling.load_aspell_speller(lang, *aspell_options)
+    _calibration_state['prepared_aspects'] = prepare_aspects(_calibration_state['profile'], lang)
+    _calibration_state['tokenizer'] = load_tokenizer(lang, tokenizer_name)
+    _calibration_state['sample'] = sample
+    _calibration_state['random_seed'] = random_seed
+    _calibration_state['aspects_generators'] = {}
+
+
+def _get_aspects_generator(alpha, alpha_std):
+    # chunks of the sample are noised by the same alphas one after another, so only the aspects for the last alphas are kept
+    key = (alpha, alpha_std)
+    if key not in _calibration_state['aspects_generators']:
+        _calibration_state['aspects_generators'] = {key: get_profile_aspects_generator(
+            _calibration_state['profile'], _calibration_state['lang'], alpha, 0., False, 0.3, _calibration_state['aspell_speller'],
+            alpha_std=alpha_std, prepared_aspects=_calibration_state['prepared_aspects'])}
+
+    return _calibration_state['aspects_generators'][key]
+
+
+def _measure_sample_chunk(start, end, alpha, alpha_std, no_error_sentence_boost):
+    '''
+     Noises lines [start, end) of the sample (each with random generator seeded from the random seed and the line index, so that all alphas
+     are measured on the same random numbers) and returns simple and detailed edits ratio of each of them.
+    '''
+    aspects_generator = _get_aspects_generator(alpha, alpha_std)
+    tokenizer = _calibration_state['tokenizer']
+
+    noised_lines = []
+    for line_ind in range(start, end):
+        line, tokenized = _calibration_state['sample'][line_ind]
+        utils.seed([_calibration_state['random_seed'], line_ind])
+        noised_line, _ = introduce_errors_in_line(line, tokenizer, aspects_generator(), False, False, False, False, False, False, False, False,
+                                                  no_error_sentence_boost=no_error_sentence_boost, tokenized=tokenized)
+        noised_lines.append(noised_line)
+
+    # noised lines are tokenized again, as they would be by ERRANT
+    return [compute_error_rate.get_sentence_edits_info(noised_tokens, tokens) for (noised_tokens, _), (_, (tokens, _)) in
+            zip(tokenize_lines(noised_lines, tokenizer), _calibration_state['sample'][start:end])]
+
+
+def search_increasing(function, target, low, high, upper_limit, tolerance, max_evaluations):
+    '''
+     Returns x from [low, upper_limit] whose value of (increasing) function is closest to the target. The bracket [low, high] is first
+     extended by doubling high until it contains the target, and then narrowed by false position steps. Illinois modification halves the value
+     at the end of the bracket that stays unchanged in two consecutive steps, so that the search does not get stuck at one end.
+    '''
+    evaluated = {}
+
+    def evaluate(x):
+        evaluated[x] = function(x) - target
+        return evaluated[x]
+
+    f_low, f_high = evaluate(low), evaluate(high)
+    while f_high < 0 and high < upper_limit:
+        low, f_low = high, f_high
+        high = min(2 * high, upper_limit)
+        f_high = evaluate(high)
+
+    last_moved = None
+    while f_low < 0 < f_high and len(evaluated) < max_evaluations and min(abs(value) for value in evaluated.values()) > tolerance:
+        x = (low * f_high - high * f_low) / (f_high - f_low)
+        f_x = evaluate(x)
+        if f_x < 0:
+            low, f_low = x, f_x
+            if last_moved == 'low':
+                f_high /= 2
+            last_moved = 'low'
+        else:
+            high, f_high = x, f_x
+            if last_moved == 'high':
+                f_low /= 2
+            last_moved = 'high'
+
+    return min(evaluated, key=lambda x: abs(evaluated[x]))
+
+
+def calibrate_alpha(monolingual_file, profile_file, lang, reference_m2_pattern, required_error_levels, outfile, tokenizer='udpipe',
+                    num_lines=20000, num_boost_lines=40000, workers=1, lines_per_chunk=500, random_seed=42, max_alpha=16., tolerance=0.1,
+                    max_evaluations=10, aspell_suggestions_cache_size=100000, aspell_suggestions_store=None, aspell_confusion_sets=None):
+    '''
+     Finds reference alpha (reaching the error rate of the reference M2 files), alphas reaching the required error levels (in percentages),
+     standard deviation of alpha reaching the standard deviation of the reference and no-error-sentence-boost reaching its ratio of
+     sentences without errors, and writes them to outfile in the format of the .csv files in profiles.
+    '''
+    if compiled_profile.is_compiled_profile(profile_file):
+        raise ValueError("Compiled profile {} has its alpha fixed, calibrate the JSON profile it was compiled from".format(profile_file))
+
+    reference_simple_edits, reference_detailed_edits = compute_error_rate.get_aligned_edits_info(reference_m2_pattern)
+    reference_error_rate = compute_error_rate.get_error_rate(reference_simple_edits, reference_detailed_edits)
+    reference_std = np.std(reference_simple_edits)
+    reference_no_edit_ratio = np.mean(np.array(reference_simple_edits) == 0)
+    print("Reference error rate is {}, std {}".format(reference_error_rate, reference_std), flush=True)
+
+    # the sample is tokenized only once, empty lines are not noised
+    with open(monolingual_file, 'r', encoding='utf-8') as f:
+        lines = []
+        for line in f:
+            if len(lines) == max(num_lines, num_boost_lines):
+                break
+            if line.strip():
+                lines.append(line.rstrip('\n'))
+    sample = list(zip(lines, tokenize_lines(lines, load_tokenizer(lang, tokenizer))))
+
+    init_args = (profile_file, lang, tokenizer, sample, random_seed,
+                 (aspell_suggestions_cache_size, aspell_suggestions_store, aspell_confusion_sets))
+    if workers <= 1:
+        _init_calibration_state(*init_args)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(workers, initializer=_init_calibration_state, initargs=init_args)
+
+    measured = {}
+
+    def measure(alpha, alpha_std=0., no_error_sentence_boost=0., sample_size=num_lines):
+        key = (alpha, alpha_std, no_error_sentence_boost, sample_size)
+        if key not in measured:
+            chunks = [(start, min(start + lines_per_chunk, sample_size, len(sample))) for start in
+                      range(0, min(sample_size, len(sample)), lines_per_chunk)]
+            chunk_args = [[arg] * len(chunks) for arg in (alpha, alpha_std, no_error_sentence_boost)]
+            chunks_edits = executor.map(_measure_sample_chunk, *zip(*chunks), *chunk_args) if executor else \
+                map(_measure_sample_chunk, *zip(*chunks), *chunk_args)
+            simple_edits, detailed_edits = zip(*[edits for chunk_edits in chunks_edits for edits in chunk_edits])
+            measured[key] = simple_edits, detailed_edits
+            print("alpha {}, alpha std {}: error rate {}, std {}".format(alpha, alpha_std, compute_error_rate.get_error_rate(
+                simple_edits, detailed_edits), np.std(simple_edits)), flush=True)
+
+        return measured[key]
+
+    def error_rate(alpha):
+        return compute_error_rate.get_error_rate(*measure(alpha))
+
+    try:
+        reference_alpha = search_increasing(error_rate, reference_error_rate, 0., 1., max_alpha, tolerance, max_evaluations)
+        level_alphas = [search_increasing(error_rate, float(level), 0., 1., max_alpha, tolerance, max_evaluations)
+                        for level in required_error_levels]
+
+        # standard deviation of alpha is searched for the reference alpha (error rates of more distant alphas differ more)
+        alpha_std = search_increasing(lambda std: np.std(measure(reference_alpha, std)[0]), reference_std, 0., 1., 1., tolerance / 100,
+                                      max_evaluations)
+
+        # finally, set the boost so that the ratio of sentences without errors is the same as in the reference
+        simple_edits, _ = measure(reference_alpha, alpha_std, sample_size=num_boost_lines)
+        no_edit_ratio = np.mean(np.array(simple_edits) == 0)
+        if reference_no_edit_ratio > no_edit_ratio:
+            # the given ratio of noised sentences are output without errors
+            no_error_sentence_boost = (reference_no_edit_ratio - no_edit_ratio) / (1 - no_edit_ratio)
+        elif no_edit_ratio > 0:
+            # the given ratio of not noised sentences are noised (negative boost)
+            no_error_sentence_boost = (reference_no_edit_ratio - no_edit_ratio) / no_edit_ratio
+        else:
+            no_error_sentence_boost = 0.
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    with open(outfile, 'w', encoding='utf-8') as f:
+        f.write("reference-alpha;{:g}\n".format(round(reference_alpha, 2)))
+        for level, level_alpha in zip(required_error_levels, level_alphas):
+            f.write("{};{:g}\n".format(level, round(level_alpha, 2)))
+        f.write("reference-std;{:g}\n".format(round(alpha_std, 2)))
+        f.write("no-error-sentence-boost;{}\n".format(no_error_sentence_boost))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("monolingual_file", type=str, help="Path to clean monolingual text, whose first lines are noised.")
+    parser.add_argument("profile_file", type=str, help="Path to file storing precomputed error statistics (in JSON format).")
+    parser.add_argument("lang", type=str, help="Language. E.g. cs, en, de, ru.")
+    parser.add_argument("reference_m2_pattern", type=str, help="Pattern matching M2 files the profile was estimated from.")
+    parser.add_argument("outfile", type=str, help="Path to .csv file to store the calibrated alphas.")
+    parser.add_argument("required_error_levels", type=str, nargs='*', help="Error levels (in percentages) to find alphas for.")
+    parser.add_argument("--tokenizer", default='udpipe', choices=sorted(TOKENIZERS), help="Tokenizer of the monolingual text.")
+    parser.add_argument("--lines", default=20000, type=int, help="Number of lines to measure error rates of alphas on.")
+    parser.add_argument("--boost-lines", default=40000, type=int, help="Number of lines to measure no-error-sentence-boost on.")
+    parser.add_argument("--workers", default=1, type=int, help="Number of processes to noise the lines with.")
+    parser.add_argument("--seed", default=42, type=int, help="Random seed.")
+    parser.add_argument("--max-alpha", default=16., type=float, help="Maximum alpha to search.")
+    parser.add_argument("--tolerance", default=0.1, type=float,
+                        help="Error rates (in percentages) closer than this to the required one are not refined any further.")
+    parser.add_argument("--max-evaluations", default=10, type=int, help="Maximum number of alphas measured when searching for one alpha.")
+    parser.add_argument("--aspell-suggestions-cache-size", default=100000, type=int,
+                        help="Number of words whose Aspell suggestions are cached (in each worker).")
+    parser.add_argument("--aspell-suggestions-store", default=None, type=str,
+                        help="Path to SQLite file persistently storing Aspell suggestions.")
+    parser.add_argument("--aspell-confusion-sets", default=None, type=str,
+                        help="Path to confusion sets built by build_confusion_sets.py, used instead of Aspell.")
+    args = parser.parse_args()
+
+    calibrate_alpha(args.monolingual_file, args.profile_file, args.lang, args.reference_m2_pattern, args.required_error_levels, args.outfile,
+                    args.tokenizer, args.lines, args.boost_lines, args.workers, random_seed=args.seed, max_alpha=args.max_alpha,
+                    tolerance=args.tolerance, max_evaluations=args.max_evaluations,
+                    aspell_suggestions_cache_size=args.aspell_suggestions_cache_size,
+                    aspell_suggestions_store=args.aspell_suggestions_store, aspell_confusion_sets=args.aspell_confusion_sets)
@@ -0,0 +1,18 @@
+import argparse
+
+from aspects import compiled_profile
+from introduce_errors import load_profile, create_aspects
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("profile_file", type=str, help="Path to file storing precomputed error statistics (in JSON format).")
+    parser.add_argument("outfile", type=str, help="Path to file to store compiled profile.")
+    parser.add_argument("lang", type=str, help="Language. E.g. cs, en, de, ru.")
+    parser.add_argument("--alpha", type=float, default=1.,
+                        help="Chance multiplication factor. Compiled profile can be used only with this alpha.")
+    parser.add_argument("--beta", type=float, default=0.,
+                        help="Uniformity smoothing factor. Compiled profile can be used only with this beta.")
+    args = parser.parse_args()
+
+    aspects = create_aspects(load_profile(args.profile_file), args.lang, args.alpha, args.beta, False, 0.3)
+    compiled_profile.save_compiled_profile(aspects, args.outfile, args.lang, args.alpha, args.beta)
@@ -1,30 +1,26 @@
 import argparse
 import glob
+from difflib import SequenceMatcher
+
 import numpy as np
-import apply_m2_edits
+from aspects import apply_m2_edits
 
 def get_edits_info(m2_pattern):
     simple_edits = []  # ratios of bad / all_tokens
     detailed_edits = []  # in each edit we also count its span both in original and corrected (whole sentence rewrite is one simple but many detailed edits)
 
     for f in glob.glob(m2_pattern + "*"):
-        m2_file = open(f).read().strip().split("\n\n")
-        for info in m2_file:
-            orig_sent, coder_dict = apply_m2_edits.processM2(info, [])
-            num_tokens = len(orig_sent)  # in tokens
-
-            if coder_dict:
-                coder_id = list(coder_dict.keys())[0]
+        for sentence in apply_m2_edits.readM2(f):
+            num_tokens = len(sentence.orig)  # in tokens
 
-                edits = coder_dict[coder_id][1]
-                filtered_edits = [edit for edit in edits if edit[2] != 'noop']
+            if sentence.coders:
+                filtered_edits = [edit for edit in sentence.edits if edit.error_type != 'noop']
                 simple_edits.append(len(filtered_edits) / num_tokens)
 
                 num_detailed_edits = 0
                 for edit in filtered_edits:
-                    orig_start, orig_end, error_type, cor_tok, cor_start, cor_end = edit
-                    num_detailed_edits += orig_end - orig_start
-                    num_detailed_edits += cor_end - cor_start
+                    num_detailed_edits += edit.orig_end - edit.orig_start
+                    num_detailed_edits += edit.cor_end - edit.cor_start
 
                 detailed_edits.append(num_detailed_edits / num_tokens)
             else:
@@ -34,6 +30,38 @@ def get_edits_info(m2_pattern):
     return simple_edits, detailed_edits
 
 
+def get_sentence_edits_info(orig_tokens, cor_tokens):
+    '''
+    Returns simple and detailed edits ratio (as get_edits_info does for each M2 sentence) of a sentence whose edits are not annotated, but
+    given by aligning its original tokens to the corrected ones. Each maximal span of differing tokens is a single edit.
+    '''
+    edit_spans = [(orig_end - orig_start) + (cor_end - cor_start) for tag, orig_start, orig_end, cor_start, cor_end in
+                  SequenceMatcher(None, orig_tokens, cor_tokens, autojunk=False).get_opcodes() if tag != 'equal']
+    num_tokens = max(len(orig_tokens), 1)
+    return len(edit_spans) / num_tokens, sum(edit_spans) / num_tokens
+
+
+def get_aligned_edits_info(m2_pattern):
+    '''
+    Returns simple and detailed edits ratios of M2 sentences as get_edits_info, but with edits given by aligning the original tokens to the
+    corrected ones (see get_sentence_edits_info) instead of the annotated edits, so that they are comparable with the ratios of noised
+    sentences (the alignment merges adjacent annotated edits into one edit).
+    '''
+    simple_edits, detailed_edits = [], []
+    for f in glob.glob(m2_pattern + "*"):
+        for sentence in apply_m2_edits.readM2(f):
+            simple_edits_ratio, detailed_edits_ratio = get_sentence_edits_info(sentence.orig, sentence.cor) if sentence.coders else (0, 0)
+            simple_edits.append(simple_edits_ratio)
+            detailed_edits.append(detailed_edits_ratio)
+
+    return simple_edits, detailed_edits
+
+
+def get_error_rate(simple_edits, detailed_edits):
+    # custom-metric to select best matching alpha: weighted average of edits ratios reported in percentages
+    return 100 * ((8 * np.mean(simple_edits) + np.mean(detailed_edits)) / 9)
+
+
 if __name__ == "__main__":
     # Define and parse program input
     parser = argparse.ArgumentParser()
@@ -52,7 +80,7 @@ if __name__ == "__main__":
     print(np.std(simple_edits))
 
     # custom-metric to select best matching alpha
-    print(100 * ((8 * simple_edits_ratio + detailed_edits_ratio) / 9))  # weighted average reported in percentages
+    print(get_error_rate(simple_edits, detailed_edits))
 
     if args.vis_name:
         import matplotlib.pyplot as plt
@@ -1,10 +1,152 @@
 import argparse
 import json
 import time
+from concurrent.futures import ProcessPoolExecutor
 from glob import glob
-import re
 
 from aspects import Casing, WordOrder, Whitespace, CommonOther, SuffixPrefix, Spelling, Punctuation, Diacritics
+from aspects import apply_m2_edits
+
+# aspects whose probabilities are estimated (in the order in which they are stored in the profile) together with their names for logging
+ESTIMATED_ASPECTS = [('Diacritics', Diacritics), ('Spelling', Spelling), ('Casing', Casing), ('Whitespace', Whitespace),
+                     ('Punctuation', Punctuation), ('Word-order', WordOrder), ('Suffix/prefix', SuffixPrefix), ('Common other', CommonOther)]
+
+# state of a process that estimates probabilities (either the main process, or a worker of the process pool)
+_estimation_state = {}
+
+
+def load_m2_records(m2_pattern):
+    '''
+    Loads M2 files matching m2_pattern (asterisk is appended to it) and parses each sentence only once for all the estimators. Returns list of
+    parsed files, each a list of apply_m2_edits.M2Sentence for its sentences. The raw text of the files is not kept in memory, but all the
+    parsed sentences are (every aspect iterates over them), so memory needed by the estimation still grows with the size of the corpus (and
+    each worker of accumulate_profile_counts holds its own copy).
+    '''
+    return [list(apply_m2_edits.readM2(f)) for f in glob(m2_pattern + "*")]
+
+
+def _init_estimation_state(m2_records):
+    _estimation_state['m2_records'] = m2_records
+
+
+def _accumulate_aspect_counts(task):
+    aspect, shard_start, shard_end = task
+    start = time.time()
+    partial_counts = aspect.accumulate(_estimation_state['m2_records'][shard_start:shard_end])
+    return partial_counts, time.time() - start
+
+
+def _accumulate_occurences(task):
+    cor_toks, shard_start, shard_end = task
+    start = time.time()
+    partial_counts = CommonOther.accumulate_occurences(_estimation_state['m2_records'][shard_start:shard_end], cor_toks)
+    return partial_counts, time.time() - start
+
+
+def _count_previous_occurences(counts, previous_counts):
+    '''
+    Adds to Common other counts the occurences (in the previous data) of its phrases that are missing in previous counts, i.e. that appear
+    only in the new data. They can be counted only in the corrected sentences stored in previous counts, otherwise the phrases whose
+    probabilities are over-estimated (as only their occurences in the new data are known) are reported.
+    '''
+    missing_cor_toks = CommonOther.get_missing_occurences(counts, previous_counts)
+    if not missing_cor_toks:
+        return counts
+
+    if 'corrected_sentences' in previous_counts:
+        return CommonOther.merge([counts, CommonOther.count_stored_occurences(previous_counts, missing_cor_toks)])
+
+    affected_cor_toks = [cor_toks for cor_toks in missing_cor_toks if sum(counts['all_pairs'][cor_toks].values()) >= 3]
+    print('Warning: previous counts do not contain corrected sentences (they were not saved by --save-counts of this version), so the '
+          'occurences of {} Common other phrases not seen in previous data are counted only in the new data and their probabilities are '
+          'over-estimated: {}'.format(len(affected_cor_toks), ' | '.join(affected_cor_toks)))
+    return counts
+
+
+def accumulate_profile_counts(m2_records, workers=1, num_shards=None, previous_counts=None, keep_corrected_sentences=False):
+    '''
+    Counts statistics of all aspects in parsed M2 files (see load_m2_records), returns dict mapping aspect (class) name to its counts (which
+    are serializable to JSON). The files are split into num_shards (by default the number of workers) shards of whole files, whose counts
+    are accumulated independently (concurrently in a process pool, if more than one worker is used) and merged.
+
+    previous_counts (counts of other data returned by this function) are merged into the counts, so that adding new data to a profile
+    only costs counting the new data. Occurences of Common other phrases that appear only in the new data are counted in the previous data
+    using the corrected sentences stored in previous counts, so previous counts should be returned with keep_corrected_sentences (otherwise
+    only the occurences in the new data are used and the affected phrases are reported).
+    '''
+    aspects = [aspect for _, aspect in ESTIMATED_ASPECTS]
+    num_shards = max(1, min(num_shards or workers, len(m2_records)))
+    shards = [(i * len(m2_records) // num_shards, (i + 1) * len(m2_records) // num_shards) for i in range(num_shards)]
+
+    if workers <= 1:
+        _init_estimation_state(m2_records)
+        executor = None
+        map_function = map
+    else:
+        executor = ProcessPoolExecutor(workers, initializer=_init_estimation_state, initargs=(m2_records,))
+        map_function = executor.map
+
+    try:
+        accumulated = list(map_function(_accumulate_aspect_counts, [(aspect, *shard) for aspect in aspects for shard in shards]))
+
+        counts = {}
+        for aspect_ind, (aspect_name, aspect) in enumerate(ESTIMATED_ASPECTS):
+            start = time.time()
+            aspect_accumulated = accumulated[aspect_ind * num_shards:(aspect_ind + 1) * num_shards]
+            partial_counts = [partial_counts for partial_counts, _ in aspect_accumulated]
+            accumulation_time = sum(accumulation_time for _, accumulation_time in aspect_accumulated)
+            if previous_counts is not None:
+                partial_counts.append(previous_counts[aspect.__name__])
+            counts[aspect.__name__] = aspect.merge(partial_counts)
+
+            if aspect is CommonOther:
+                # count occurences of the phrases of other shards (and previous counts) in each shard
+                tasks = [(CommonOther.get_missing_occurences(counts[aspect.__name__], shard_counts), *shard)
+                         for shard_counts, shard in zip(partial_counts, shards)]
+                for occurence_counts, occurences_time in map_function(_accumulate_occurences, [task for task in tasks if task[0]]):
+                    counts[aspect.__name__] = aspect.merge([counts[aspect.__name__], occurence_counts])
+                    accumulation_time += occurences_time
+
+                if previous_counts is not None:
+                    counts[aspect.__name__] = _count_previous_occurences(counts[aspect.__name__], previous_counts[aspect.__name__])
+
+                # corrected sentences are kept only if they are known for all the counted data
+                counts[aspect.__name__].pop('corrected_sentences', None)
+                if keep_corrected_sentences and (previous_counts is None or 'corrected_sentences' in previous_counts[aspect.__name__]):
+                    corrected_sentences = [CommonOther.accumulate_corrected_sentences(m2_records)]
+                    if previous_counts is not None:
+                        corrected_sentences.append({'corrected_sentences': previous_counts[aspect.__name__]['corrected_sentences']})
+                    counts[aspect.__name__].update(aspect.merge(corrected_sentences))
+
+            print('{} counted in {} (merged in {})'.format(aspect_name, accumulation_time, time.time() - start))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return counts
+
+
+def estimate_profile_from_counts(counts):
+    '''
+    Estimates probabilities of all aspects from their counts (see accumulate_profile_counts).
+    '''
+    final_profile_statistics = {}
+    for aspect_name, aspect in ESTIMATED_ASPECTS:
+        start = time.time()
+        dict_key, values = aspect.finalize(counts[aspect.__name__])
+        final_profile_statistics[dict_key] = values
+        print('{} done in {}'.format(aspect_name, time.time() - start))
+
+    return final_profile_statistics
+
+
+def estimate_profile(m2_records, workers=1):
+    '''
+    Estimates probabilities of all aspects from parsed M2 files (see load_m2_records). If more than one worker is used, the counts of the
+    aspects are accumulated concurrently in a process pool, each worker receiving the parsed files only once.
+    '''
+    return estimate_profile_from_counts(accumulate_profile_counts(m2_records, workers))
+
 
 if __name__ == "__main__":
     # Define and parse program input
@@ -13,73 +155,32 @@ if __name__ == "__main__":
                         help="Pattern to M2 files (e.g. /tmp/m2_folder/ or /tmp/m2_folder/lang8). Asterisk is appended to pattern.",
                         type=str)
     parser.add_argument("out", help="Path to file to store computed statistics (in JSON format).", type=str)
+    parser.add_argument("--workers", default=1, type=int, help="Number of processes estimating probabilities of the aspects concurrently.")
+    parser.add_argument("--shards", default=None, type=int,
+                        help="Number of shards (of whole M2 files) counted independently, the number of workers by default.")
+    parser.add_argument("--save-counts", default=None, type=str,
+                        help="Path to file to store counts of all aspects (in JSON format), so that other data may be added to them later. "
+                             "They include all (lowercased) corrected sentences, in which the phrases of the added data are counted.")
+    parser.add_argument("--add-to-counts", default=None, type=str,
+                        help="Path to counts stored by --save-counts, M2 files are added to them and profile is estimated from all data.")
     args = parser.parse_args()
 
     start_m2load = time.time()
-    m2_files_loaded = []
-    for f in glob(args.m2_pattern + "*"):
-        m2_file = re.sub(r'\n\n+', '\n\n', open(f).read().strip()).split("\n\n")
-        m2_files_loaded.append(m2_file)
-    print('M2 files loaded in {}'.format(time.time() - start_m2load))
-    final_profile_statistics = {}
-
-    print('Processing {} files'.format(len(m2_files_loaded)))
-
-    # DIACRITICS
-    start_diacritics = time.time()
-    dict_key, values = Diacritics.estimate_probabilities(m2_files_loaded)
-
-    final_profile_statistics[dict_key] = values
-    print('Diacritics done in {}'.format(time.time() - start_diacritics))
-
-    # SPELLING
-    start_spelling = time.time()
-    dict_key, values = Spelling.estimate_probabilities(m2_files_loaded)
+    m2_files_loaded = load_m2_records(args.m2_pattern)
+    print('M2 files loaded and parsed in {}'.format(time.time() - start_m2load))
 
-    final_profile_statistics[dict_key] = values
-    print('Spelling done in {}'.format(time.time() - start_spelling))
+    previous_counts = None
+    if args.add_to_counts:
+        with open(args.add_to_counts) as counts_file:
+            previous_counts = json.load(counts_file)
 
-    # CASING
-    start_casing = time.time()
-    dict_key, values = Casing.estimate_probabilities(m2_files_loaded)
-
-    final_profile_statistics[dict_key] = values
-    print('Casing done in {}'.format(time.time() - start_casing))
-
-    # WHITESPACE
-    start_whitespace = time.time()
-    dict_key, values = Whitespace.estimate_probabilities(m2_files_loaded)
-
-    final_profile_statistics[dict_key] = values
-    print('Whitespace done in {}'.format(time.time() - start_whitespace))
-
-    # PUNCTUATION
-    start_punct = time.time()
-    dict_key, values = Punctuation.estimate_probabilities(m2_files_loaded)
-
-    final_profile_statistics[dict_key] = values
-    print('Punctuation done in {}'.format(time.time() - start_punct))
-
-    # WORD ORDER
-    start_wo = time.time()
-    dict_key, values = WordOrder.estimate_probabilities(m2_files_loaded)
-
-    final_profile_statistics[dict_key] = values
-    print('Word-order done in {}'.format(time.time() - start_wo))
-
-    # SUFFIX / PREFIX
-    start_xfix = time.time()
-    dict_key, values = SuffixPrefix.estimate_probabilities(m2_files_loaded)
-
-    final_profile_statistics[dict_key] = values
-    print('Suffix/prefix done in {}'.format(time.time() - start_xfix))
-
-    # OTHER COMMON ERRORS
-    start_other_common = time.time()
-    dict_key, values = CommonOther.estimate_probabilities(m2_files_loaded)
+    print('Processing {} files'.format(len(m2_files_loaded)))
+    counts = accumulate_profile_counts(m2_files_loaded, args.workers, args.shards, previous_counts, args.save_counts is not None)
+    if args.save_counts:
+        with open(args.save_counts, 'w') as counts_file:
+            json.dump(counts, counts_file)
 
-    final_profile_statistics[dict_key] = values
-    print('Common other done in {}'.format(time.time() - start_other_common))
+    final_profile_statistics = estimate_profile_from_counts(counts)
 
     # FINAL DUMP
 
@@ -25,6 +25,9 @@ elif [[ $lang == "ru" ]]; then
     tokenized=True
 fi
 
+# all runs noise the same head of the monolingual data, so it is tokenized only once and the tokenization reused
+tokenization_cache="/tmp/$(basename $monolingual_data)-tokenization-$BASHPID"
+
 ## COMPUTE REFERENCE ERROR RATE AND ERROR RATES FOR SPECIFIC ALPHAS
 
 echo "Computing error rate on reference M2 file: $reference_m2_files"
@@ -40,7 +43,7 @@ for alpha in ${array_alphas_to_measure_on[@]}; do
     monolingual_data_head="/tmp/$(basename $monolingual_data)-20000-$BASHPID.txt"
     monolingual_data_head_noised="/tmp/$(basename $monolingual_data)-20000-noised-$alpha-$BASHPID.txt"
     head -n 20000 $monolingual_data > $monolingual_data_head
-    /home/naplava/virtualenvs/aspell/bin/python ../scripts/introduce_errors.py $monolingual_data_head $monolingual_data_head_noised $profile_file --lang $lang --alpha $alpha
+    /home/naplava/virtualenvs/aspell/bin/python ../scripts/introduce_errors.py $monolingual_data_head $monolingual_data_head_noised $profile_file --lang $lang --tokenization-cache $tokenization_cache --alpha $alpha
 
     # create M2 file using Errant
     monolingual_data_head_m2="/tmp/$(basename $monolingual_data)-20000-$alpha-$BASHPID.m2"
@@ -121,7 +124,7 @@ for cur_std in ${array_stds_to_measure_on[@]}; do
     monolingual_data_head="/tmp/$(basename $monolingual_data)-20000-$BASHPID.txt"
     monolingual_data_head_noised="/tmp/$(basename $monolingual_data)-20000-noised-$reference_best_alpha-$BASHPID.txt"
     head -n 20000 $monolingual_data > $monolingual_data_head
-    /home/naplava/virtualenvs/aspell/bin/python ../scripts/introduce_errors.py $monolingual_data_head $monolingual_data_head_noised $profile_file --lang $lang --alpha $reference_best_alpha --alpha-std $cur_std --alpha-uniformity-prob 0
+    /home/naplava/virtualenvs/aspell/bin/python ../scripts/introduce_errors.py $monolingual_data_head $monolingual_data_head_noised $profile_file --lang $lang --tokenization-cache $tokenization_cache --alpha $reference_best_alpha --alpha-std $cur_std --alpha-uniformity-prob 0
 
     # create M2 file using Errant
     monolingual_data_head_m2="/tmp/$(basename $monolingual_data)-20000-$reference_best_alpha-$BASHPID.m2"
@@ -166,7 +169,7 @@ echo "Final"
 monolingual_data_head="/tmp/$(basename $monolingual_data)-40000-$BASHPID.txt"
 monolingual_data_head_noised="/tmp/$(basename $monolingual_data)-40000-noised-$reference_best_alpha-$BASHPID.txt"
 head -n 40000 $monolingual_data > $monolingual_data_head
-/home/naplava/virtualenvs/aspell/bin/python ../scripts/introduce_errors.py $monolingual_data_head $monolingual_data_head_noised $profile_file --lang $lang --alpha $reference_best_alpha --alpha-std $best_dif_std --alpha-uniformity-prob 0
+/home/naplava/virtualenvs/aspell/bin/python ../scripts/introduce_errors.py $monolingual_data_head $monolingual_data_head_noised $profile_file --lang $lang --tokenization-cache $tokenization_cache --alpha $reference_best_alpha --alpha-std $best_dif_std --alpha-uniformity-prob 0
 echo "Final M2"
 # create M2 file using Errant
 monolingual_data_head_m2="/tmp/$(basename $monolingual_data)-40000-$reference_best_alpha-$BASHPID.m2"
@@ -207,4 +210,4 @@ echo "no-error-sentence-boost;$no_error_sentence_boost_constant" >> $out_file
 
 rm $monolingual_data_head
 rm $monolingual_data_head_noised
-
+rm -r $tokenization_cache
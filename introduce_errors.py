@@ -1,10 +1,18 @@
 import argparse
+import hashlib
 import json
+import os
+import queue
+import threading
 import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
-import udpipe_tokenizer
+import regex_tokenizer
 from aspects import Casing, WordOrder, Whitespace, CommonOther, SuffixPrefix, Spelling, Punctuation, Diacritics
+from aspects import compiled_profile, utils
+from aspects.base import NoisedSentence
 from scipy.stats import truncnorm
 
 
@@ -17,13 +25,48 @@ def get_truncated_normal(mean=0, sd=1, low=0, upp=10):
 
 
 def get_aspects_generator(profile_file, lang, alpha_mean, beta, strip_all_diacritics, spelling_detailed_ratio, alpha_min=None,
-                          alpha_max=None, alpha_std=None, alpha_uniformity_prob=0, num_aspects=1000):
+                          alpha_max=None, alpha_std=None, alpha_uniformity_prob=0, num_aspects=1000, aspell_suggestions_cache_size=100000,
+                          aspell_suggestions_store=None, aspell_confusion_sets=None, aspell_speller=None):
     '''
-     Returns generator that when called, returns next aspect to be used for noising
+     Returns generator that when called, returns next aspect to be used for noising. If Aspell speller is given, it is used instead of
+     loading a new one (and the Aspell options are ignored).
     '''
+    # the (expensive) Aspell speller is created only once and shared by all aspects, so that they also share its suggestions cache
+    if aspell_speller is None:
+        aspell_speller = Spelling.load_aspell_speller(lang, aspell_suggestions_cache_size, aspell_suggestions_store, aspell_confusion_sets)
+
+    if compiled_profile.is_compiled_profile(profile_file):
+        # compiled profile is already smoothed with the alpha and beta it was compiled with
+        if alpha_std != 0:
+            raise ValueError("Compiled profile {} can be used only with the alpha it was compiled with (alpha-std must be 0)".format(
+                profile_file))
+
+        aspect, compiled_alpha, compiled_beta = compiled_profile.load_compiled_profile(profile_file, aspell_speller)
+        if alpha_mean != compiled_alpha or beta != compiled_beta:
+            raise ValueError("Compiled profile {} was compiled with alpha {} and beta {}, cannot be used with alpha {} and beta {}".format(
+                profile_file, compiled_alpha, compiled_beta, alpha_mean, beta))
+
+        configure_aspects(aspect, strip_all_diacritics, spelling_detailed_ratio)
+        return lambda: aspect
+
+    return get_profile_aspects_generator(load_profile(profile_file), lang, alpha_mean, beta, strip_all_diacritics, spelling_detailed_ratio,
+                                         aspell_speller, alpha_min, alpha_max, alpha_std, alpha_uniformity_prob, num_aspects)
+
+
+def get_profile_aspects_generator(profile, lang, alpha_mean, beta, strip_all_diacritics, spelling_detailed_ratio, aspell_speller=None,
+                                  alpha_min=None, alpha_max=None, alpha_std=None, alpha_uniformity_prob=0, num_aspects=1000,
+                                  prepared_aspects=None):
+    '''
+     Returns aspects generator (see get_aspects_generator) for already loaded profile. All the aspects share the given Aspell speller and
+     the alpha-independent structures of the profile (see prepare_aspects), so that generators for several alphas may be created without
+     loading the profile and Aspell again.
+    '''
+    if prepared_aspects is None:
+        prepared_aspects = prepare_aspects(profile, lang)
 
     if alpha_std == 0:
-        aspect = load_basic_aspects(profile_file, lang, alpha_mean, beta, strip_all_diacritics, spelling_detailed_ratio)
+        aspect = create_aspects(profile, lang, alpha_mean, beta, strip_all_diacritics, spelling_detailed_ratio, aspell_speller,
+                                prepared_aspects)
         return lambda: aspect
 
     # if alpha_min / alpha_max are not specified, set them to cover most of the probability mass
@@ -34,229 +77,559 @@ def get_aspects_generator(profile_file, lang, alpha_mean, beta, strip_all_diacri
 
     # divide into num_chunks in [alpha_min, alpha_max]
     chunk_size = (alpha_max - alpha_min) / (num_aspects - 1)
+    alphas = np.array([alpha_min + i * chunk_size for i in range(num_aspects)])
 
-    alphas = []
+    # the profile is parsed and prepared only once and shared by all alphas; aspects for a given alpha (which only smooth the shared
+    # profile) are only created once this alpha is sampled for the first time
     aspects = {}
-    for i in range(num_aspects):
-        cur_alpha = alpha_min + i * chunk_size
-        aspects[cur_alpha] = load_basic_aspects(profile_file, lang, cur_alpha, beta, strip_all_diacritics, spelling_detailed_ratio)
-        alphas.append(cur_alpha)
+
+    def get_aspects_for_alpha(alpha_ind):
+        if alpha_ind not in aspects:
+            aspects[alpha_ind] = create_aspects(profile, lang, alphas[alpha_ind], beta, strip_all_diacritics, spelling_detailed_ratio,
+                                                aspell_speller, prepared_aspects)
+        return aspects[alpha_ind]
 
     if alpha_uniformity_prob < 1:
-        # if uniform is not used always, instantiate generator of truncated normal values
-        trunc_norm_alpha_generator = get_truncated_normal(alpha_mean, alpha_std, alpha_min, alpha_max)
+        # if uniform is not used always, compute truncated normal distribution function at the midpoints between the alphas: the closest
+        # alpha to the one sampled (by inverse transform sampling, as scipy does) is given by the midpoints the uniform sample lies between
+        alpha_midpoints_cdf = get_truncated_normal(alpha_mean, alpha_std, alpha_min, alpha_max).cdf((alphas[1:] + alphas[:-1]) / 2)
 
     def get_next_aspect():
-        if np.random.uniform(0, 1) < alpha_uniformity_prob:
+        if utils.uniform() < alpha_uniformity_prob:
             # select aspect (alpha) uniformly from whole interval
-            return np.random.choice(list(aspects.values()))
+            return get_aspects_for_alpha(utils.randint(0, num_aspects))
         else:
             # sample alpha according to (truncated) normal normal distribution and return aspect with closest alpha
-            sampled_alpha = trunc_norm_alpha_generator.rvs()
-            closest_alpha = min(alphas, key=lambda x: abs(x - sampled_alpha))
-            return aspects[closest_alpha]
+            return get_aspects_for_alpha(int(np.searchsorted(alpha_midpoints_cdf, np.random.uniform())))
 
     return get_next_aspect
 
 
-def load_basic_aspects(profile_file, lang, alpha, beta, strip_all_diacritics, spelling_detailed_ratio):
+def load_profile(profile_file):
     with open(profile_file, 'r') as f:
-        profile = json.load(f)
+        return json.load(f)
+
+
+def load_basic_aspects(profile_file, lang, alpha, beta, strip_all_diacritics, spelling_detailed_ratio):
+    return create_aspects(load_profile(profile_file), lang, alpha, beta, strip_all_diacritics, spelling_detailed_ratio)
+
+
+def prepare_aspects(profile, lang):
+    '''
+     Prepares the structures of all aspects that do not depend on alpha and beta (see Aspect.prepare) for already loaded profile, so that
+     sets of aspects for several alphas share them.
+    '''
+    return {aspect_name: aspect_class.prepare(profile, lang) for aspect_name, aspect_class in compiled_profile.ASPECT_CLASSES.items()}
+
+
+def create_aspects(profile, lang, alpha, beta, strip_all_diacritics, spelling_detailed_ratio, aspell_speller=None, prepared_aspects=None):
+    '''
+     Creates all aspects for already loaded profile. Aspell speller and prepared aspects (see prepare_aspects) may be shared among several
+     sets of aspects (e.g. with different alphas) as they are costly to create, creating the aspects themselves then only smooths the
+     probabilities of the profile.
+    '''
+    if prepared_aspects is None:
+        prepared_aspects = prepare_aspects(profile, lang)
 
     aspects = {
-        'casing': Casing(profile, lang, alpha, beta),
-        'common_other': CommonOther(profile, lang, alpha, beta),
-        'diacritics': Diacritics(profile, lang, alpha, beta),
-        'punctuation': Punctuation(profile, lang, alpha, beta),
-        'spelling': Spelling(profile, lang, alpha, beta),
-        'suffix_prefix': SuffixPrefix(profile, lang, alpha, beta),
-        'whitespace': Whitespace(profile, lang, alpha, beta),
-        'word_order': WordOrder(profile, lang, alpha, beta)
+        'casing': Casing(profile, lang, alpha, beta, prepared_aspects['casing']),
+        'common_other': CommonOther(profile, lang, alpha, beta, prepared_aspects['common_other']),
+        'diacritics': Diacritics(profile, lang, alpha, beta, prepared_aspects['diacritics']),
+        'punctuation': Punctuation(profile, lang, alpha, beta, prepared_aspects['punctuation']),
+        'spelling': Spelling(profile, lang, alpha, beta, aspell_speller, prepared_aspects['spelling']),
+        'suffix_prefix': SuffixPrefix(profile, lang, alpha, beta, prepared_aspects['suffix_prefix']),
+        'whitespace': Whitespace(profile, lang, alpha, beta, prepared_aspects['whitespace']),
+        'word_order': WordOrder(profile, lang, alpha, beta, prepared_aspects['word_order'])
     }
 
+    configure_aspects(aspects, strip_all_diacritics, spelling_detailed_ratio)
+
+    return aspects
+
+
+def configure_aspects(aspects, strip_all_diacritics, spelling_detailed_ratio):
     if strip_all_diacritics:
         aspects['diacritics'].all_wo_diacritics_perc = 1
 
     aspects['spelling'].spelling_detailed_ratio = spelling_detailed_ratio
 
-    return aspects
-
 
-def load_tokenizer(lang):
+def _load_udpipe_tokenizer(lang):
+    # udpipe is imported only when needed, so that it does not have to be installed when using other tokenizers
+    import udpipe_tokenizer
     return udpipe_tokenizer.UDPipeTokenizer(lang)
 
 
+# tokenizers selectable by name, each created for a given language; UDPipe is the most accurate, regex one the fastest
+TOKENIZERS = {
+    'udpipe': _load_udpipe_tokenizer,
+    'regex': regex_tokenizer.RegexTokenizer,
+    'whitespace': regex_tokenizer.WhitespaceTokenizer,
+}
+
+
+def load_tokenizer(lang, tokenizer='udpipe'):
+    if tokenizer not in TOKENIZERS:
+        raise ValueError("Unknown tokenizer {}, choose one of {}".format(tokenizer, ", ".join(TOKENIZERS)))
+
+    return TOKENIZERS[tokenizer](lang)
+
+
 def _tokenize_line_and_get_whitespace_info(line, tokenizer):
     # tokenize input line and store space mapping
 
     if tokenizer is None:
         tokens = line.split(' ')
         text_whitespace_info = [True] * (len(tokens) - 1)
-        return line, text_whitespace_info
-
-    tokens = []
-    for sentence_tokens in tokenizer.tokenize(line):
-        for token in sentence_tokens:
-            tokens.append(token.string.replace(' ', ''))
-
-    text_whitespace_info = [True] * (
-        len(tokens) - 1)  # stores information on whether there was space between adjacent tokens in text
-    current_status = tokens[0]
-    for i in range(len(tokens) - 1):
-        if line.startswith(current_status + tokens[i + 1]):  # no space in between
-            text_whitespace_info[i] = False
-            current_status += tokens[i + 1]
-        else:
-            current_status += " " + tokens[i + 1]
+        return tokens, text_whitespace_info
 
-    tokenized_line = " ".join(tokens)
+    return _get_tokens_and_whitespace_info(tokenizer.tokenize(line))
 
-    return tokenized_line, text_whitespace_info
 
+def tokenize_lines(lines, tokenizer):
+    '''
+     Returns (tokens, whitespace info) of each line, as noising functions tokenize them. Tokenizers able to tokenize many lines at once do so.
+    '''
+    if tokenizer is None or not hasattr(tokenizer, 'tokenize_many'):
+        return [_tokenize_line_and_get_whitespace_info(line, tokenizer) for line in lines]
 
-def introduce_errors_in_line(line, tokenizer, aspects, no_diacritics, no_spelling, no_casing, no_whitespace, no_punctuation, no_word_order,
-                             no_suffix_prefix, no_common_other, verbose=False, no_error_sentence_boost=0):
-    original_tokenized_line, original_text_whitespace_info = _tokenize_line_and_get_whitespace_info(line, tokenizer)
+    return [_get_tokens_and_whitespace_info(tokenized_line) for tokenized_line in tokenizer.tokenize_many(lines)]
 
-    if verbose:
-        print('Incoming line: {}'.format(original_tokenized_line), flush=True)
 
-    assert len(original_text_whitespace_info) == len(original_tokenized_line.split(' ')) - 1
+def _get_tokens_and_whitespace_info(tokenized_sentences):
+    tokens = [token for sentence_tokens in tokenized_sentences for token in sentence_tokens]
 
-    num_iterations_done = 0
-    max_iterations_to_try = 500
-    random_number = np.random.uniform(0, 1)
-    while True:
-        tokenized_line = original_tokenized_line
-        text_whitespace_info = original_text_whitespace_info
-        line_changes = []
+    # stores information on whether there was space between adjacent tokens in text, as given by the token offsets
+    text_whitespace_info = [tokens[i].end < tokens[i + 1].start for i in range(len(tokens) - 1)]
 
-        if not no_common_other:
-            tokenized_line, changes, text_whitespace_info = aspects['common_other'].apply(tokenized_line, text_whitespace_info)
-            line_changes.extend(changes)
+    return [token.string.replace(' ', '') for token in tokens], text_whitespace_info
 
-        assert len(text_whitespace_info) == len(tokenized_line.split(' ')) - 1
 
-        if not no_suffix_prefix:
-            tokenized_line, changes, text_whitespace_info = aspects['suffix_prefix'].apply(tokenized_line, text_whitespace_info)
-            line_changes.extend(changes)
+# number of times noising of a line that must contain an error was retried by the original implementation, the probability of all the
+# retries failing is kept (see utils.sample_with_at_least_one_trigger)
+MAX_ERROR_ATTEMPTS = 500
 
-        assert len(text_whitespace_info) == len(tokenized_line.split(' ')) - 1
+# aspects in the order in which they are applied
+ASPECTS_ORDER = ['common_other', 'suffix_prefix', 'spelling', 'word_order', 'diacritics', 'casing', 'whitespace', 'punctuation']
 
-        if not no_spelling:
-            tokenized_line, changes, text_whitespace_info = aspects['spelling'].apply(tokenized_line, text_whitespace_info)
-            line_changes.extend(changes)
 
-        assert len(text_whitespace_info) == len(tokenized_line.split(' ')) - 1
+def get_disabled_aspects(no_diacritics, no_spelling, no_casing, no_whitespace, no_punctuation, no_word_order, no_suffix_prefix,
+                         no_common_other):
+    '''
+     Returns set of names of the aspects that should not be applied.
+    '''
+    return {aspect_name for aspect_name, disabled in [
+        ('common_other', no_common_other), ('suffix_prefix', no_suffix_prefix), ('spelling', no_spelling), ('word_order', no_word_order),
+        ('diacritics', no_diacritics), ('casing', no_casing), ('whitespace', no_whitespace), ('punctuation', no_punctuation)] if disabled}
 
-        if not no_word_order:
-            tokenized_line, changes, text_whitespace_info = aspects['word_order'].apply(tokenized_line, text_whitespace_info)
-            line_changes.extend(changes)
 
-        assert len(text_whitespace_info) == len(tokenized_line.split(' ')) - 1
+def _introduce_errors_into_sentences(sentences, aspects, disabled_aspects, checked=False):
+    # sentences are passed through each aspect together, so that aspects processing whole batches at once can do so
+    for aspect_name in ASPECTS_ORDER:
+        if aspect_name in disabled_aspects:
+            continue
 
-        if not no_diacritics:
-            tokenized_line, changes, text_whitespace_info = aspects['diacritics'].apply(tokenized_line, text_whitespace_info)
-            line_changes.extend(changes)
+        aspects[aspect_name].apply_batch(sentences)
 
-        assert len(text_whitespace_info) == len(tokenized_line.split(' ')) - 1
+        if checked:
+            for sentence in sentences:
+                sentence.check(aspect_name)
 
-        if not no_casing:
-            tokenized_line, changes, text_whitespace_info = aspects['casing'].apply(tokenized_line, text_whitespace_info)
-            line_changes.extend(changes)
 
-        assert len(text_whitespace_info) == len(tokenized_line.split(' ')) - 1
+def _introduce_errors_into_sentence(original_sentence, aspects, disabled_aspects, checked=False):
+    # aspects modify the sentence in place, keep the original one intact
+    sentence = original_sentence.copy()
+    _introduce_errors_into_sentences([sentence], aspects, disabled_aspects, checked)
+    return sentence
 
-        if not no_whitespace:
-            tokenized_line, changes, text_whitespace_info = aspects['whitespace'].apply(tokenized_line, text_whitespace_info)
-            line_changes.extend(changes)
 
-        assert len(text_whitespace_info) == len(tokenized_line.split(' ')) - 1
+def _get_noised_sentence_with_error(original_sentence, aspects, disabled_aspects, checked=False):
+    # instead of retrying until some error is introduced, the sentence is noised conditioned on at least one of the decisions to introduce
+    # an error succeeding; it stays intact with the probability that none of MAX_ERROR_ATTEMPTS retries would introduce an error
+    sentence = utils.sample_with_at_least_one_trigger(
+        lambda: _introduce_errors_into_sentence(original_sentence, aspects, disabled_aspects, checked), MAX_ERROR_ATTEMPTS)
+    return sentence if sentence is not None else original_sentence
 
-        if not no_punctuation:
-            tokenized_line, changes, text_whitespace_info = aspects['punctuation'].apply(tokenized_line, text_whitespace_info)
-            line_changes.extend(changes)
 
-        assert len(text_whitespace_info) == len(tokenized_line.split(' ')) - 1
+def _detokenize(sentence, tokenizer):
+    # if no tokenizer was provided, the text should be in a tokenized form and space should be in-between all tokens
+    return sentence.detokenize() if tokenizer else sentence.text()
 
-        num_iterations_done += 1
-        if num_iterations_done < max_iterations_to_try and no_error_sentence_boost < 0 and len(line_changes) == 0 and abs(
-                no_error_sentence_boost) < random_number:
-            # we did not introduce any error but should have, try again
-            continue
 
-        if no_error_sentence_boost > 0 and len(line_changes) != 0 and random_number < no_error_sentence_boost:
-            # we introduced some errors but to make the distribution more similar to reference, we remove the errors from the sentence
-            tokenized_line, text_whitespace_info = original_tokenized_line, original_text_whitespace_info
+def introduce_errors_in_line(line, tokenizer, aspects, no_diacritics, no_spelling, no_casing, no_whitespace, no_punctuation, no_word_order,
+                             no_suffix_prefix, no_common_other, verbose=False, no_error_sentence_boost=0, checked=False, tokenized=None):
+    '''
+    Noises line, returns the noised line and list of the introduced changes. Aspects are applied to NoisedSentence holding the tokens and
+    whitespace info; if checked, the consistency of these is verified after each aspect. If the line was already tokenized by the tokenizer
+    (e.g. it comes from tokenization cache), its (tokens, whitespace info) may be passed as tokenized and the tokenizer is not used.
+    '''
+    disabled_aspects = get_disabled_aspects(no_diacritics, no_spelling, no_casing, no_whitespace, no_punctuation, no_word_order,
+                                            no_suffix_prefix, no_common_other)
+    return _noise_line(line, tokenizer, aspects, disabled_aspects, verbose, no_error_sentence_boost, checked, tokenized)
 
-        # detokenize text
-        # if no tokenizer was provided, the text should be in a tokenized form and space should be in-between all tokens
-        if not tokenizer:
-            text_whitespace_info = [True] * len(text_whitespace_info)
 
-        detokenized_line = ''
-        for i in range(len(tokenized_line.split())):
-            detokenized_line += tokenized_line.split(' ')[i]
+def _noise_line(line, tokenizer, aspects, disabled_aspects, verbose=False, no_error_sentence_boost=0, checked=False, tokenized=None):
+    if tokenized is None:
+        original_sentence = NoisedSentence(*_tokenize_line_and_get_whitespace_info(line, tokenizer))
+    else:
+        original_sentence = NoisedSentence(*tokenized)
 
-            if i < len(text_whitespace_info) and text_whitespace_info[i]:
-                detokenized_line += " "
+    if verbose:
+        print('Incoming line: {}'.format(original_sentence.text()), flush=True)
 
-        break
+    if checked:
+        original_sentence.check('tokenizer')
 
-    return detokenized_line, line_changes
+    random_number = utils.uniform()
+    if no_error_sentence_boost < 0 and abs(no_error_sentence_boost) < random_number:
+        # at least one error must be introduced
+        sentence = _get_noised_sentence_with_error(original_sentence, aspects, disabled_aspects, checked)
+    else:
+        sentence = _introduce_errors_into_sentence(original_sentence, aspects, disabled_aspects, checked)
 
+    if no_error_sentence_boost > 0 and len(sentence.changes) != 0 and random_number < no_error_sentence_boost:
+        # we introduced some errors but to make the distribution more similar to reference, we remove the errors from the sentence
+        sentence = NoisedSentence(original_sentence.tokens, original_sentence.whitespace_info, sentence.changes)
 
-def introduce_errors_into_file(infile, outfile, profile_file, lang, debug, alpha, beta, save_input, strip_all_diacritics, no_diacritics,
-                               no_spelling, no_casing, no_whitespace, no_punctuation, no_word_order, no_suffix_prefix, no_common_other,
-                               spelling_detailed_ratio, verbose=False, random_seed=42, alpha_min=None, alpha_max=None, alpha_std=0,
-                               alpha_uniformity_prob=0, no_error_sentence_boost=0):
-    np.random.seed(random_seed)
+    return _detokenize(sentence, tokenizer or tokenized is not None), sentence.changes
 
-    aspects_generator = get_aspects_generator(profile_file, lang, alpha, beta, strip_all_diacritics, spelling_detailed_ratio, alpha_min,
-                                              alpha_max, alpha_std, alpha_uniformity_prob)
 
-    tokenizer = load_tokenizer(lang)
+def noise_batch(lines, seed, aspects_generator, tokenizer, disabled_aspects=(), no_error_sentence_boost=0, checked=False):
+    '''
+    Noises a batch of lines in a single call, returns list of noised lines and list of the changes introduced into each of them. Random
+    generator is seeded once for the whole batch and the aspects for all lines are drawn at once. Lines that got the same aspects are then
+    passed through each aspect together, so that aspects with batch implementation (e.g. Diacritics) process them at once. Empty lines are
+    returned as they are.
+
+    The result is given by the seed and the whole batch (it differs from noising the lines one by one with introduce_errors_in_line).
+    :param aspects_generator: generator returned by get_aspects_generator
+    :param disabled_aspects: names of aspects that are not applied, see get_disabled_aspects
+    '''
+    utils.seed(seed)
+
+    line_inds = [i for i, line in enumerate(lines) if line.strip()]
+    line_aspects = [aspects_generator() for _ in line_inds]
+    random_numbers = utils.uniforms(len(line_inds))
+
+    original_sentences = [NoisedSentence(tokens, text_whitespace_info) for tokens, text_whitespace_info in
+                          tokenize_lines([lines[i] for i in line_inds], tokenizer)]
+    if checked:
+        for original_sentence in original_sentences:
+            original_sentence.check('tokenizer')
+
+    # sentences that must contain an error are noised one by one, the other ones are grouped by their aspects
+    error_required = [no_error_sentence_boost < 0 and abs(no_error_sentence_boost) < random_number for random_number in random_numbers]
+    sentences = [original_sentence.copy() for original_sentence in original_sentences]
+    sentences_per_aspects = {}
+    for sentence, aspects, required in zip(sentences, line_aspects, error_required):
+        if not required:
+            sentences_per_aspects.setdefault(id(aspects), (aspects, []))[1].append(sentence)
+
+    for aspects, aspects_sentences in sentences_per_aspects.values():
+        _introduce_errors_into_sentences(aspects_sentences, aspects, disabled_aspects, checked)
+
+    for j, required in enumerate(error_required):
+        if required:
+            sentences[j] = _get_noised_sentence_with_error(original_sentences[j], line_aspects[j], disabled_aspects, checked)
+
+    noised_lines = list(lines)
+    changes = [[] for _ in lines]
+    for i, original_sentence, sentence, random_number in zip(line_inds, original_sentences, sentences, random_numbers):
+        if no_error_sentence_boost > 0 and len(sentence.changes) != 0 and random_number < no_error_sentence_boost:
+            # we introduced some errors but to make the distribution more similar to reference, we remove the errors from the sentence
+            sentence = NoisedSentence(original_sentence.tokens, original_sentence.whitespace_info, sentence.changes)
+
+        noised_lines[i] = _detokenize(sentence, tokenizer)
+        changes[i] = sentence.changes
+
+    return noised_lines, changes
+
+
+def noise_lines(lines, aspects_generator, tokenizer, random_seed=42, disabled_aspects=(), no_error_sentence_boost=0, checked=False,
+                num_shards=1, shard_index=0, prefetch=0):
+    '''
+    Lazily noises iterable of lines (e.g. for on-the-fly noising in a training data pipeline), yields (noised line, changes) pairs. Empty
+    lines are yielded as they are.
+
+    Each line is noised with random generator seeded from random_seed and the line index (as in introduce_errors_into_file), so the
+    result does not depend on the process noising the line, nor on how far ahead the lines are noised. Several processes (e.g. data
+    loader workers) may share the same lines by each of them noising only one shard of them: the lines whose index modulo num_shards
+    equals shard_index. Each process must create its own aspects generator and tokenizer. Change random_seed (e.g. per epoch) to get
+    different noise for the same lines.
+    :param aspects_generator: generator returned by get_aspects_generator
+    :param disabled_aspects: names of aspects that are not applied, see get_disabled_aspects
+    :param prefetch: if positive, the lines are noised in a background thread, keeping up to prefetch noised lines ahead of the consumer;
+        numpy global random generator must not be used by other threads meanwhile
+    '''
+    def _noise_lines():
+        for line_ind, line in enumerate(lines):
+            if line_ind % num_shards != shard_index:
+                continue
 
-    time_stats = []
-    with open(infile, 'r', encoding='utf-8') as infile, open(outfile, 'w', encoding='utf-8') as outfile:
-        line_ind = 0
-        for line in infile:
-            if not line.strip():  # if empty line, just copy it
-                outfile.write("\n")
+            if not line.strip():
+                yield line, []
                 continue
 
-            line_ind += 1
-            start_line_time = time.time()
+            utils.seed([random_seed, line_ind])
+            yield _noise_line(line, tokenizer, aspects_generator(), disabled_aspects, no_error_sentence_boost=no_error_sentence_boost,
+                              checked=checked)
+
+    if prefetch > 0:
+        return _prefetch(_noise_lines(), prefetch)
+    return _noise_lines()
+
+
+def _prefetch(items, buffer_size):
+    '''
+     Yields items of iterator that is consumed in a background thread, keeping up to buffer_size items ahead. Exceptions raised in the
+     background thread are re-raised when reached; the thread is stopped once the consumer closes the generator.
+    '''
+    buffer = queue.Queue(buffer_size)
+    stopped = threading.Event()
+    end = object()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+            put((end, None))
+        except Exception as exception:
+            put((end, exception))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, exception = buffer.get()
+            if exception is not None:
+                raise exception
+            if item is end:
+                return
+            yield item
+    finally:
+        stopped.set()
+        thread.join()
+
+
+# state of a process that noises lines (either the main process, or a worker of the process pool)
+_noising_state = {}
+
+
+def _init_noising_state(aspects_generator_args, lang, tokenizer_name, noising_args):
+    _noising_state['aspects_generator'] = get_aspects_generator(*aspects_generator_args)
+    _noising_state['lang'] = lang
+    _noising_state['tokenizer_name'] = tokenizer_name
+    _noising_state['tokenizer'] = None
+    _noising_state['noising_args'] = noising_args
+
+
+def _get_noising_tokenizer():
+    # the tokenizer is loaded only when some line was not tokenized in advance (by tokenization cache)
+    if _noising_state['tokenizer'] is None:
+        _noising_state['tokenizer'] = load_tokenizer(_noising_state['lang'], _noising_state['tokenizer_name'])
+
+    return _noising_state['tokenizer']
+
+
+def _introduce_errors_into_chunk(random_seed, chunk, return_tokenized=False):
+    '''
+     Noises chunk of (line index, line, tokenized line or None) triples. Random generator is seeded for each line from random_seed and the
+     line index, so that the output does not depend on how the lines were split into chunks and processes. Empty lines are not noised (None
+     is returned). If return_tokenized, the tokenized line is returned with each noised line (to be stored in tokenization cache).
+    '''
+    results = []
+    for line_ind, line, tokenized in chunk:
+        if not line.strip():
+            results.append(None)
+            continue
+
+        start_line_time = time.time()
+        if tokenized is None:
+            tokenized = _tokenize_line_and_get_whitespace_info(line, _get_noising_tokenizer())
+
+        utils.seed([random_seed, line_ind])
+
+        cur_aspects = _noising_state['aspects_generator']()
+        noised_line, line_changes = introduce_errors_in_line(line, _noising_state['tokenizer'], cur_aspects,
+                                                             *_noising_state['noising_args'], tokenized=tokenized)
+        results.append((noised_line, line_changes, time.time() - start_line_time, tokenized if return_tokenized else None))
+
+    return results
+
+
+def _read_chunks(lines, lines_per_chunk, tokenized_lines=None):
+    chunk = []
+    for line_ind, line in enumerate(lines):
+        chunk.append((line_ind, line, next(tokenized_lines, None) if tokenized_lines is not None else None))
+        if len(chunk) == lines_per_chunk:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
 
-            cur_aspects = aspects_generator()
-            noised_line, line_changes = introduce_errors_in_line(line, tokenizer, cur_aspects, no_diacritics, no_spelling, no_casing,
-                                                                 no_whitespace, no_punctuation, no_word_order, no_suffix_prefix,
-                                                                 no_common_other, verbose, no_error_sentence_boost)
 
-            if save_input:
-                outfile.write(line.strip() + "\t" + noised_line.strip() + "\n")
+def _introduce_errors_into_chunks(chunks, random_seed, workers, init_args, return_tokenized=False):
+    '''
+     Yields (chunk, noised chunk) pairs in the original order. If more than one worker is used, chunks are noised in a process pool in
+     which each worker holds its own aspects and tokenizer.
+    '''
+    if workers <= 1:
+        _init_noising_state(*init_args)
+        for chunk in chunks:
+            yield chunk, _introduce_errors_into_chunk(random_seed, chunk, return_tokenized)
+        return
+
+    with ProcessPoolExecutor(workers, initializer=_init_noising_state, initargs=init_args) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append((chunk, executor.submit(_introduce_errors_into_chunk, random_seed, chunk, return_tokenized)))
+
+            # do not read whole input into memory, keep only a few chunks per worker in flight
+            if len(pending) >= 2 * workers:
+                chunk, future = pending.popleft()
+                yield chunk, future.result()
+
+        while pending:
+            chunk, future = pending.popleft()
+            yield chunk, future.result()
+
+
+def get_tokenization_cache_file(tokenization_cache, infile, lang, tokenizer='udpipe'):
+    '''
+     Returns path of the file in tokenization_cache directory storing tokenization of infile. The file is keyed by SHA-256 hash of the input
+     (and the tokenizer and its language), so that it is reused by all runs over the same text, regardless of the input file name.
+    '''
+    input_hash = hashlib.sha256()
+    with open(infile, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            input_hash.update(block)
+
+    return os.path.join(tokenization_cache, '{}.{}.{}.tokenized.jsonl'.format(input_hash.hexdigest(), tokenizer, lang))
+
+
+def _read_tokenization_cache(tokenization_cache_file, lang, tokenizer):
+    '''
+     Yields (tokens, whitespace info) of each line stored in tokenization cache file (None for empty lines). The file starts with JSON
+     header, each following line holds JSON list of tokens and whitespace info of one input line, whitespace info being string of 0 and 1.
+    '''
+    with open(tokenization_cache_file, 'r', encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        if (header.get('lang'), header.get('tokenizer')) != (lang, tokenizer):
+            raise ValueError("Tokenization cache {} was created by {} tokenizer for language {}, not by {} for {}".format(
+                tokenization_cache_file, header.get('tokenizer'), header.get('lang'), tokenizer, lang))
+
+        for line in f:
+            tokenized = json.loads(line)
+            if tokenized is None:
+                yield None
             else:
-                outfile.write(noised_line + "\n")
+                tokens, whitespace_info = tokenized
+                yield tokens, [flag == '1' for flag in whitespace_info]
 
-            if debug:
-                print(line_changes)
-                outfile.write(";".join([";".join(x) for x in line_changes]))
-                outfile.write("\n")
 
-            time_stats.append(time.time() - start_line_time)
+def _format_tokenized_line(tokenized):
+    if tokenized is None:
+        return 'null\n'
 
-            if verbose:
-                if line_ind % 100 == 0:
-                    print("{} processed. 1 line took on average {}".format(line_ind, np.mean(time_stats)), flush=True)
+    tokens, whitespace_info = tokenized
+    return json.dumps([tokens, ''.join('1' if flag else '0' for flag in whitespace_info)], ensure_ascii=False) + '\n'
 
-                    time_stats = []
+
+def introduce_errors_into_file(infile, outfile, profile_file, lang, debug, alpha, beta, save_input, strip_all_diacritics, no_diacritics,
+                               no_spelling, no_casing, no_whitespace, no_punctuation, no_word_order, no_suffix_prefix, no_common_other,
+                               spelling_detailed_ratio, verbose=False, random_seed=42, alpha_min=None, alpha_max=None, alpha_std=0,
+                               alpha_uniformity_prob=0, no_error_sentence_boost=0, workers=1, lines_per_chunk=1000,
+                               aspell_suggestions_cache_size=100000, aspell_suggestions_store=None, aspell_confusion_sets=None,
+                               checked=False, tokenization_cache=None, tokenizer='udpipe'):
+    '''
+    Noises infile into outfile, tokenized by the tokenizer of the given name (see TOKENIZERS). If tokenization_cache directory is given,
+    tokenization of infile is stored in it by the first run and read by all the following runs over the same text (e.g. when sweeping over
+    alphas), which then do not tokenize at all.
+    '''
+    aspects_generator_args = (profile_file, lang, alpha, beta, strip_all_diacritics, spelling_detailed_ratio, alpha_min, alpha_max,
+                              alpha_std, alpha_uniformity_prob, 1000, aspell_suggestions_cache_size, aspell_suggestions_store,
+                              aspell_confusion_sets)
+    noising_args = (no_diacritics, no_spelling, no_casing, no_whitespace, no_punctuation, no_word_order, no_suffix_prefix,
+                    no_common_other, verbose, no_error_sentence_boost, checked)
+
+    tokenization_cache_file, tokenized_lines, tokenization_cache_out = None, None, None
+    if tokenization_cache:
+        os.makedirs(tokenization_cache, exist_ok=True)
+        tokenization_cache_file = get_tokenization_cache_file(tokenization_cache, infile, lang, tokenizer)
+        if os.path.exists(tokenization_cache_file):
+            tokenized_lines = _read_tokenization_cache(tokenization_cache_file, lang, tokenizer)
+        else:
+            # written under temporary name and renamed when complete, so that failed or interrupted runs leave no partial cache behind
+            tokenization_cache_out = open('{}.{}.tmp'.format(tokenization_cache_file, os.getpid()), 'w', encoding='utf-8')
+            tokenization_cache_out.write(json.dumps({'lang': lang, 'tokenizer': tokenizer}) + "\n")
+
+    # the temporary tokenization cache file is renamed only if noising succeeds, otherwise it is removed
+    completed = False
+    try:
+        time_stats = []
+        with open(infile, 'r', encoding='utf-8') as infile, open(outfile, 'w', encoding='utf-8') as outfile:
+            line_ind = 0
+            init_args = (aspects_generator_args, lang, tokenizer, noising_args)
+            noised_chunks = _introduce_errors_into_chunks(_read_chunks(infile, lines_per_chunk, tokenized_lines), random_seed, workers,
+                                                          init_args, tokenization_cache_out is not None)
+            for chunk, noised_chunk in noised_chunks:
+                for (_, line, _), noised in zip(chunk, noised_chunk):
+                    if tokenization_cache_out is not None:
+                        tokenization_cache_out.write(_format_tokenized_line(noised[3] if noised is not None else None))
+
+                    if noised is None:  # if empty line, just copy it
+                        outfile.write("\n")
+                        continue
+
+                    line_ind += 1
+                    noised_line, line_changes, line_time, _ = noised
+
+                    if save_input:
+                        outfile.write(line.strip() + "\t" + noised_line.strip() + "\n")
+                    else:
+                        outfile.write(noised_line + "\n")
+
+                    if debug:
+                        print(line_changes)
+                        outfile.write(";".join([";".join(x) for x in line_changes]))
+                        outfile.write("\n")
+
+                    time_stats.append(line_time)
+
+                    if verbose:
+                        if line_ind % 100 == 0:
+                            print("{} processed. 1 line took on average {}".format(line_ind, np.mean(time_stats)), flush=True)
+
+                            time_stats = []
+
+        completed = True
+    finally:
+        if tokenization_cache_out is not None:
+            tokenization_cache_out.close()
+            if completed:
+                os.replace(tokenization_cache_out.name, tokenization_cache_file)
+            else:
+                os.remove(tokenization_cache_out.name)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("infile", type=str, help="Path to file with text to be noised.")
     parser.add_argument("outfile", type=str, help="Path to file to store noised text.")
-    parser.add_argument("profile_file", type=str, help="Path to file storing precomputed error statistics")
+    parser.add_argument("profile_file", type=str,
+                        help="Path to file storing precomputed error statistics. Either JSON profile, or profile compiled with "
+                             "compile_profile.py (it can be used only with the alpha and beta it was compiled with).")
     parser.add_argument("lang", type=str, help="Language. E.g. cs, en, de, ru.")
 
     parser.add_argument("--debug", action='store_true', default=False,
@@ -314,8 +687,27 @@ if __name__ == '__main__':
                              "with 0.3 chance and the second method with 1 - 0.3 = 0.7 chance).")
 
     parser.add_argument("--verbose", action='store_true', default=False, help="Verbose mode")
-
-    parser.add_argument("--seed", default=42, type=int, help="Random seed.")
+    parser.add_argument("--checked", action='store_true', default=False,
+                        help="Check consistency of tokens and whitespace information after each aspect (slower, for debugging).")
+
+    parser.add_argument("--seed", default=42, type=int,
+                        help="Random seed. Each line is noised with a seed derived from this seed and the line index.")
+    parser.add_argument("--workers", default=1, type=int,
+                        help="Number of processes to noise the input with. The output does not depend on the number of workers.")
+    parser.add_argument("--aspell-suggestions-cache-size", default=100000, type=int,
+                        help="Number of words whose Aspell suggestions are cached (in each worker).")
+    parser.add_argument("--aspell-suggestions-store", default=None, type=str,
+                        help="Path to SQLite file persistently storing Aspell suggestions (per language and Aspell dictionary). It is "
+                             "created if it does not exist and may be shared by several runs.")
+    parser.add_argument("--aspell-confusion-sets", default=None, type=str,
+                        help="Path to confusion sets built by build_confusion_sets.py. If given, Aspell suggestions are taken from them "
+                             "instead of Aspell (words missing in the confusion sets are not replaced by other valid words).")
+    parser.add_argument("--tokenizer", default='udpipe', choices=sorted(TOKENIZERS),
+                        help="Tokenizer of the input. UDPipe is the most accurate, regex tokenizer (splitting words and punctuation) is "
+                             "much faster and whitespace tokenizer only splits already tokenized text on whitespace.")
+    parser.add_argument("--tokenization-cache", default=None, type=str,
+                        help="Directory with tokenizations of input files (keyed by hash of their content). Tokenization of the input is "
+                             "stored there by the first run and reused by all following runs over the same text.")
 
     args = parser.parse_args()
 
@@ -323,4 +715,8 @@ if __name__ == '__main__':
                                args.save_input, args.strip_all_diacritics, args.no_diacritics, args.no_spelling, args.no_casing,
                                args.no_whitespace, args.no_punctuation, args.no_word_order, args.no_suffix_prefix, args.no_common_other,
                                args.spelling_detailed_ratio, args.verbose, args.seed, args.alpha_min, args.alpha_max, args.alpha_std,
-                               args.alpha_uniformity_prob, args.no_error_sentence_boost)
+                               args.alpha_uniformity_prob, args.no_error_sentence_boost, args.workers,
+                               aspell_suggestions_cache_size=args.aspell_suggestions_cache_size,
+                               aspell_suggestions_store=args.aspell_suggestions_store,
+                               aspell_confusion_sets=args.aspell_confusion_sets, checked=args.checked,
+                               tokenization_cache=args.tokenization_cache, tokenizer=args.tokenizer)
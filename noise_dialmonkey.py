@@ -1,7 +1,7 @@
 import argparse
 import json
 
-from introduce_errors import get_aspects_generator, load_tokenizer, introduce_errors_in_line
+from introduce_errors import TOKENIZERS, get_aspects_generator, load_tokenizer, introduce_errors_in_line
 from introduce_errors_levels import level_to_operations
 
 if __name__ == '__main__':
@@ -40,6 +40,7 @@ if __name__ == '__main__':
                              "If this parameter is of negative value, then "
                              "anytime a sentence without error is to be outputted, than it is with this probability outputted with some "
                              " error.")
+    parser.add_argument("--tokenizer", default='udpipe', choices=sorted(TOKENIZERS), help="Tokenizer of the texts to be noised.")
 
     args = parser.parse_args()
 
@@ -49,7 +50,7 @@ if __name__ == '__main__':
     aspects_generator = get_aspects_generator(args.profile_file, args.lang, args.alpha, args.beta, strip_all_diacritics, 0.3,
                                               args.alpha_min, args.alpha_max, args.alpha_std, args.alpha_uniformity_prob)
 
-    tokenizer = load_tokenizer(args.lang)
+    tokenizer = load_tokenizer(args.lang, args.tokenizer)
 
     num_items_per_line = 0
     with open(args.infile, 'r') as reader:
@@ -1,7 +1,7 @@
 import argparse
 import json
 
-from introduce_errors import get_aspects_generator, load_tokenizer, introduce_errors_in_line
+from introduce_errors import TOKENIZERS, get_aspects_generator, load_tokenizer, introduce_errors_in_line
 from introduce_errors_levels import level_to_operations
 
 
@@ -60,6 +60,7 @@ if __name__ == '__main__':
                              " error.")
 
     parser.add_argument("--seed", default=42, type=int, help="Random seed.")
+    parser.add_argument("--tokenizer", default='udpipe', choices=sorted(TOKENIZERS), help="Tokenizer of the texts to be noised.")
 
     args = parser.parse_args()
 
@@ -76,7 +77,7 @@ if __name__ == '__main__':
     aspects_generator = get_aspects_generator(args.profile_file, args.lang, args.alpha, args.beta, strip_all_diacritics, 0.3,
                                               args.alpha_min, args.alpha_max, args.alpha_std, args.alpha_uniformity_prob)
 
-    tokenizer = load_tokenizer(args.lang)
+    tokenizer = load_tokenizer(args.lang, args.tokenizer)
 
     noised_squad = {}
     with open(args.infile, 'r') as reader:
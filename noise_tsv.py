@@ -1,8 +1,8 @@
 import argparse
 import csv
 
-import numpy as np
-from introduce_errors import get_aspects_generator, load_tokenizer, introduce_errors_in_line
+from aspects import utils
+from introduce_errors import TOKENIZERS, get_aspects_generator, load_tokenizer, introduce_errors_in_line
 from introduce_errors_levels import level_to_operations
 
 if __name__ == '__main__':
@@ -46,10 +46,11 @@ if __name__ == '__main__':
     parser.add_argument("--seed", default=42, type=int, help="Random seed.")
     parser.add_argument("--ignore-check", action='store_true', default=False, help="TODO")
     parser.add_argument("--verbose", action='store_true', default=False, help="Verbose mode")
+    parser.add_argument("--tokenizer", default='udpipe', choices=sorted(TOKENIZERS), help="Tokenizer of the texts to be noised.")
 
     args = parser.parse_args()
 
-    np.random.seed(args.seed)
+    utils.seed(args.seed)
 
     strip_all_diacritics, no_diacritics, no_spelling, no_casing, no_whitespace, no_punctuation, no_word_order, no_suffix_prefix, no_common_other = level_to_operations(
         args.level)
@@ -57,7 +58,7 @@ if __name__ == '__main__':
     aspects_generator = get_aspects_generator(args.profile_file, args.lang, args.alpha, args.beta, strip_all_diacritics, 0.3,
                                               args.alpha_min, args.alpha_max, args.alpha_std, args.alpha_uniformity_prob)
 
-    tokenizer = load_tokenizer(args.lang)
+    tokenizer = load_tokenizer(args.lang, args.tokenizer)
 
     with open(args.infile, 'r') as f, open(args.outfile, 'w') as writer:
         tsv_reader = csv.reader(f, delimiter="\t", quotechar='\x07')  # MRPC does have some bad lines -> quotechar cannot be "
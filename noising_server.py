@@ -0,0 +1,288 @@
+'''
+Long-running noising server keeping aspects, Aspell spellers and tokenizers loaded, so that noising small inputs does not pay for loading
+them again. It listens on localhost (or a Unix socket) only and noises the lines of each request in a pool of worker processes.
+
+Request is a POST with JSON body:
+    {"profile": profile_file, "lang": lang, "lines": [...], optionally "alpha", "beta", "seed", "disabled_aspects",
+     "no_error_sentence_boost", "spelling_detailed_ratio", "strip_all_diacritics"}
+where profile_file and lang must be one of the pairs the server was started with. Alpha and beta default to 1 and 0, for compiled
+profile to the alpha and beta it was compiled with (other values are rejected). Lines are noised as by introduce_errors.py (line i with
+random generator seeded from seed and i), so the same input gives the same output. Response is JSON
+    {"lines": [...], "changes": [...], "latency": seconds}
+'''
+import argparse
+import http.client
+import http.server
+import json
+import os
+import socket
+import socketserver
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from aspects import compiled_profile
+from aspects.spelling import Spelling
+from introduce_errors import (ASPECTS_ORDER, TOKENIZERS, get_aspects_generator, get_profile_aspects_generator, load_profile,
+                              load_tokenizer, noise_lines, prepare_aspects)
+
+DEFAULT_PORT = 8000
+
+# number of aspects generators (i.e. sets of aspects for distinct request options) kept by each worker, the least recently used are dropped
+ASPECTS_GENERATORS_CACHE_SIZE = 16
+
+# state of a worker process: Aspell spellers and tokenizers (per lang), loaded JSON profiles with their alpha-independent structures (per
+# profile and lang) and the recently used aspects generators (per profile, lang and the options the aspects are created with)
+_worker_state = {}
+
+
+def _init_worker(profiles, aspell_options, tokenizer_name):
+    _worker_state['aspell_options'] = aspell_options
+    _worker_state['tokenizer_name'] = tokenizer_name
+    _worker_state['aspects_generators'] = OrderedDict()
+    _worker_state['aspell_spellers'] = {}
+    _worker_state['prepared_profiles'] = {}
+    _worker_state['tokenizers'] = {}
+    _worker_state['default_smoothing'] = {}
+
+    # the Aspell spellers and the aspects for the default options are loaded in advance
+    for profile_file, lang in profiles:
+        _get_aspell_speller(lang)
+        default_alpha, default_beta = _get_default_smoothing(profile_file)
+        _get_aspects_generator(profile_file, lang, default_alpha, default_beta, False, 0.3)
+        _get_tokenizer(lang)
+
+
+def _get_aspects_generator(profile_file, lang, alpha, beta, strip_all_diacritics, spelling_detailed_ratio):
+    key = (profile_file, lang, alpha, beta, strip_all_diacritics, spelling_detailed_ratio)
+    aspects_generators = _worker_state['aspects_generators']
+    if key in aspects_generators:
+        aspects_generators.move_to_end(key)
+        return aspects_generators[key]
+
+    # all aspects of a worker share the Aspell speller of their language, aspects of JSON profile also the structures prepared from it
+    if compiled_profile.is_compiled_profile(profile_file):
+        aspects_generator = get_aspects_generator(profile_file, lang, alpha, beta, strip_all_diacritics, spelling_detailed_ratio,
+                                                  alpha_std=0, aspell_speller=_get_aspell_speller(lang))
+    else:
+        profile, prepared_aspects = _get_prepared_profile(profile_file, lang)
+        aspects_generator = get_profile_aspects_generator(profile, lang, alpha, beta, strip_all_diacritics, spelling_detailed_ratio,
+                                                          _get_aspell_speller(lang), alpha_std=0, prepared_aspects=prepared_aspects)
+
+    aspects_generators[key] = aspects_generator
+    if len(aspects_generators) > ASPECTS_GENERATORS_CACHE_SIZE:
+        aspects_generators.popitem(last=False)
+
+    return aspects_generator
+
+
+def _get_aspell_speller(lang):
+    if lang not in _worker_state['aspell_spellers']:
+        aspell_suggestions_cache_size, aspell_suggestions_store, aspell_confusion_sets = _worker_state['aspell_options']
+        _worker_state['aspell_spellers'][lang] = Spelling.load_aspell_speller(lang, aspell_suggestions_cache_size, aspell_suggestions_store,
+                                                                              aspell_confusion_sets)
+
+    return _worker_state['aspell_spellers'][lang]
+
+
+def _get_prepared_profile(profile_file, lang):
+    key = (profile_file, lang)
+    if key not in _worker_state['prepared_profiles']:
+        profile = load_profile(profile_file)
+        _worker_state['prepared_profiles'][key] = profile, prepare_aspects(profile, lang)
+
+    return _worker_state['prepared_profiles'][key]
+
+
+def _get_compiled_smoothing(profile_file):
+    # alpha and beta a compiled profile was compiled with (and must be used with), None for JSON profile
+    if compiled_profile.is_compiled_profile(profile_file):
+        return tuple(compiled_profile.get_compiled_profile_smoothing(profile_file))
+
+    return None
+
+
+def _get_default_smoothing(profile_file):
+    if profile_file not in _worker_state['default_smoothing']:
+        _worker_state['default_smoothing'][profile_file] = _get_compiled_smoothing(profile_file) or (1., 0.)
+
+    return _worker_state['default_smoothing'][profile_file]
+
+
+def _get_tokenizer(lang):
+    if lang not in _worker_state['tokenizers']:
+        _worker_state['tokenizers'][lang] = load_tokenizer(lang, _worker_state['tokenizer_name'])
+
+    return _worker_state['tokenizers'][lang]
+
+
+def _noise_request(request):
+    default_alpha, default_beta = _get_default_smoothing(request['profile'])
+    aspects_generator = _get_aspects_generator(request['profile'], request['lang'], float(request.get('alpha', default_alpha)),
+                                               float(request.get('beta', default_beta)), bool(request.get('strip_all_diacritics', False)),
+                                               float(request.get('spelling_detailed_ratio', 0.3)))
+    noised = list(noise_lines(request['lines'], aspects_generator, _get_tokenizer(request['lang']), int(request.get('seed', 42)),
+                              set(request.get('disabled_aspects', [])), float(request.get('no_error_sentence_boost', 0))))
+    return [noised_line for noised_line, _ in noised], [changes for _, changes in noised]
+
+
+def _is_number(value):
+    # JSON booleans are parsed as bool, which is a subclass of int
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _validate_request(request, profiles):
+    '''
+    Raises ValueError if the request is malformed. profiles maps the served (profile_file, lang) pairs to the alpha and beta of compiled
+    profiles (None for JSON profiles).
+    '''
+    if not isinstance(request, dict):
+        raise ValueError("Request must be a JSON object")
+    if (request.get('profile'), request.get('lang')) not in profiles:
+        raise ValueError("Profile {} for language {} is not served".format(request.get('profile'), request.get('lang')))
+    if not isinstance(request.get('lines'), list) or not all(isinstance(line, str) for line in request['lines']):
+        raise ValueError("Lines must be a list of strings")
+    disabled_aspects = request.get('disabled_aspects', [])
+    if not isinstance(disabled_aspects, list) or not all(isinstance(aspect, str) for aspect in disabled_aspects):
+        raise ValueError("Disabled aspects must be a list of strings")
+    if not set(disabled_aspects).issubset(ASPECTS_ORDER):
+        raise ValueError("Unknown aspects to disable: {}".format(set(disabled_aspects).difference(ASPECTS_ORDER)))
+    for field in ['alpha', 'beta', 'no_error_sentence_boost', 'spelling_detailed_ratio']:
+        if field in request and not _is_number(request[field]):
+            raise ValueError("{} must be a number".format(field))
+    seed = request.get('seed', 42)
+    if isinstance(seed, bool) or not isinstance(seed, int) or not 0 <= seed < 2 ** 32:
+        raise ValueError("seed must be an integer from [0, 2^32)")
+    if 'strip_all_diacritics' in request and not isinstance(request['strip_all_diacritics'], bool):
+        raise ValueError("strip_all_diacritics must be a boolean")
+
+    compiled_smoothing = profiles[(request['profile'], request['lang'])]
+    if compiled_smoothing is not None:
+        alpha, beta = request.get('alpha', compiled_smoothing[0]), request.get('beta', compiled_smoothing[1])
+        if (alpha, beta) != compiled_smoothing:
+            raise ValueError("Compiled profile {} was compiled with alpha {} and beta {}, cannot be used with alpha {} and beta {}".format(
+                request['profile'], compiled_smoothing[0], compiled_smoothing[1], alpha, beta))
+
+
+class NoisingRequestHandler(http.server.BaseHTTPRequestHandler):
+    # set by serve()
+    executor = None
+    profiles = None
+
+    def do_POST(self):
+        start_time = time.time()
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+            _validate_request(request, self.profiles)
+        except ValueError as e:
+            self._send_json(400, {'error': str(e)})
+            return
+
+        try:
+            noised_lines, changes = self.executor.submit(_noise_request, request).result()
+        except Exception as e:
+            self._send_json(500, {'error': '{}: {}'.format(type(e).__name__, e)})
+            return
+
+        latency = time.time() - start_time
+        self.log_message("noised %d lines (%s, %s) in %.3f s", len(noised_lines), request['profile'], request['lang'], latency)
+        self._send_json(200, {'lines': noised_lines, 'changes': changes, 'latency': latency})
+
+    def _send_json(self, status, content):
+        body = json.dumps(content, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # clients connected through Unix socket have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(profiles, port=DEFAULT_PORT, unix_socket=None, workers=1, aspell_suggestions_cache_size=100000, aspell_suggestions_store=None,
+          aspell_confusion_sets=None, tokenizer='udpipe'):
+    '''
+    Serve noising requests until interrupted. Each worker process loads the aspects of all the given (profile_file, lang) pairs when the
+    server starts, aspects with other options (e.g. alpha) are loaded by the first request needing them. All languages are tokenized by
+    the tokenizer of the given name (see TOKENIZERS in introduce_errors.py).
+    '''
+    profiles = [tuple(profile) for profile in profiles]
+    aspell_options = (aspell_suggestions_cache_size, aspell_suggestions_store, aspell_confusion_sets)
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(profiles, aspell_options, tokenizer)) as executor:
+        # make the workers load everything before accepting requests
+        for _ in executor.map(int, range(workers)):
+            pass
+
+        NoisingRequestHandler.executor = executor
+        NoisingRequestHandler.profiles = {(profile_file, lang): _get_compiled_smoothing(profile_file) for profile_file, lang in profiles}
+        if unix_socket:
+            server = _UnixHTTPServer(unix_socket, NoisingRequestHandler)
+        else:
+            server = http.server.ThreadingHTTPServer(('localhost', port), NoisingRequestHandler)
+
+        with server:
+            print("Serving on {}".format(unix_socket or 'localhost:{}'.format(port)), file=sys.stderr, flush=True)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                if unix_socket:
+                    os.remove(unix_socket)
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, unix_socket):
+        super().__init__('localhost')
+        self.unix_socket = unix_socket
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.unix_socket)
+
+
+def request_noising(lines, profile_file, lang, port=DEFAULT_PORT, unix_socket=None, **options):
+    '''
+    Noise lines by a running noising server, returns list of noised lines and list of their changes. Options are the optional request
+    fields (e.g. alpha, seed).
+    '''
+    connection = _UnixHTTPConnection(unix_socket) if unix_socket else http.client.HTTPConnection('localhost', port)
+    try:
+        body = json.dumps(dict(options, profile=profile_file, lang=lang, lines=list(lines))).encode('utf-8')
+        connection.request('POST', '/', body, {'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        content = json.loads(response.read().decode('utf-8'))
+    finally:
+        connection.close()
+
+    if response.status != 200:
+        raise RuntimeError("Noising server failed with status {}: {}".format(response.status, content.get('error')))
+
+    return content['lines'], content['changes']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--profile", nargs=2, action='append', required=True, metavar=('PROFILE_FILE', 'LANG'),
+                        help="Profile (JSON or compiled) and its language to serve, may be given several times.")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Port on localhost to listen on.")
+    parser.add_argument("--unix-socket", type=str, default=None, help="Listen on this Unix socket instead of a localhost port.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes noising the requests.")
+    parser.add_argument("--aspell-suggestions-cache-size", default=100000, type=int,
+                        help="Number of words whose Aspell suggestions are cached (in each worker).")
+    parser.add_argument("--aspell-suggestions-store", default=None, type=str,
+                        help="Path to SQLite file persistently storing Aspell suggestions.")
+    parser.add_argument("--aspell-confusion-sets", default=None, type=str,
+                        help="Path to confusion sets built by build_confusion_sets.py, used instead of Aspell.")
+    parser.add_argument("--tokenizer", default='udpipe', choices=sorted(TOKENIZERS), help="Tokenizer of the lines to be noised.")
+    args = parser.parse_args()
+
+    serve(args.profile, args.port, args.unix_socket, args.workers, args.aspell_suggestions_cache_size, args.aspell_suggestions_store,
+          args.aspell_confusion_sets, args.tokenizer)
@@ -5,6 +5,8 @@ import numpy as np
 import unidecode
 import string
 
+from aspects.apply_m2_edits import readM2Blocks
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -12,9 +14,9 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
-    m2_file = open(args.infile).read().strip().split("\n\n")
+    m2_file = open(args.infile)
 
-    for info in m2_file:
+    for info in readM2Blocks(m2_file):
         info = info.split('\n')
         sentence = info[0].strip()[2:]
         print(f"S {sentence}")
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+import re
+
+
+class RegexTokenizer:
+    '''
+    Fast tokenizer splitting text by regular expression, offering the interface of UDPipeTokenizer. Words (sequences of Unicode letters and
+    digits, numbers possibly with decimal separators) and runs of the same punctuation character (e.g. "...") are tokens; token offsets
+    give whitespace between them. It does not need any model, but it does not know abbreviations etc. the UDPipe tokenizer does.
+    '''
+    TOKEN_RE = re.compile(r"\d+(?:[.,]\d+)+|\w+|([^\w\s])\1*")
+
+    class Token:
+        def __init__(self, string, start, end):
+            self.string = string
+            self.start = start
+            self.end = end
+
+    def __init__(self, lang):
+        self.lang = lang
+
+    def tokenize(self, text):
+        """ Return tokenized text as a list of sentences (the whole text is a single sentence), each a list of tokens. """
+
+        tokens = [self.Token(match.group(), match.start(), match.end()) for match in self.TOKEN_RE.finditer(text)]
+        return [tokens] if tokens else []
+
+
+class WhitespaceTokenizer(RegexTokenizer):
+    '''
+    Tokenizer for already tokenized text, tokens are the sequences of non-whitespace characters.
+    '''
+    TOKEN_RE = re.compile(r"\S+")
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("lang", type=str, help="Language to use")
+    parser.add_argument("--whitespace", action='store_true', default=False, help="Split on whitespace only")
+    args = parser.parse_args()
+
+    tokenizer = WhitespaceTokenizer(args.lang) if args.whitespace else RegexTokenizer(args.lang)
+
+    for line in sys.stdin:
+        for sentence in tokenizer.tokenize(line):
+            print(*[token.string for token in sentence])
@@ -10,6 +10,9 @@ class UDPipeTokenizer:
         "ru": ""
     }
 
+    # texts tokenized at once by tokenize_many are separated by an empty line, which always ends a sentence
+    TEXTS_SEPARATOR = "\n\n"
+
     class Token:
         def __init__(self, string, start, end):
             self.string = string
@@ -19,19 +22,20 @@ class UDPipeTokenizer:
     def __init__(self, lang):
         self._model = ufal.udpipe.Model.load(self.MODELS[lang])
 
-    def tokenize(self, text):
-        """ Return tokenized text as a list of sentences, each a list of tokens. """
-
-        tokenizer = self._model.newTokenizer(self._model.TOKENIZER_RANGES)
-        if not tokenizer:
+        # the tokenizer is created only once and reused for all texts (note that it is therefore not thread-safe)
+        self._tokenizer = self._model.newTokenizer(self._model.TOKENIZER_RANGES)
+        if not self._tokenizer:
             raise RuntimeError("The model does not have a tokenizer")
 
-        tokenizer.setText(text)
+    def tokenize(self, text):
+        """ Return tokenized text as a list of sentences, each a list of tokens. Token start and end are character offsets in text. """
+
+        self._tokenizer.setText(text)
         error = ufal.udpipe.ProcessingError()
         sentences = []
 
         sentence = ufal.udpipe.Sentence()
-        while tokenizer.nextSentence(sentence, error):
+        while self._tokenizer.nextSentence(sentence, error):
             sentences.append([])
 
             multiword_token = 0
@@ -52,6 +56,36 @@ class UDPipeTokenizer:
 
         return sentences
 
+    def tokenize_many(self, texts):
+        """
+        Tokenize several texts at once, return list of tokenized texts (each as returned by tokenize). The texts are passed to the
+        tokenizer together, separated by empty lines (so that no sentence spans two texts), and the tokens are then assigned back to the
+        texts according to their offsets.
+        """
+
+        texts = list(texts)
+        text_starts = []
+        offset = 0
+        for text in texts:
+            text_starts.append(offset)
+            offset += len(text) + len(self.TEXTS_SEPARATOR)
+
+        tokenized_texts = [[] for _ in texts]
+        text_ind = 0
+        for sentence in self.tokenize(self.TEXTS_SEPARATOR.join(texts)):
+            last_text_ind = None
+            for token in sentence:
+                while text_ind + 1 < len(texts) and token.start >= text_starts[text_ind + 1]:
+                    text_ind += 1
+                if text_ind != last_text_ind:
+                    tokenized_texts[text_ind].append([])
+                    last_text_ind = text_ind
+
+                text_start = text_starts[text_ind]
+                tokenized_texts[text_ind][-1].append(self.Token(token.string, token.start - text_start, token.end - text_start))
+
+        return tokenized_texts
+
 
 if __name__ == "__main__":
     import argparse